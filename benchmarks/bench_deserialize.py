@@ -0,0 +1,74 @@
+"""Notification deserialization throughput, before and after the decoder registry."""
+
+import argparse
+import time
+
+from marshmallow import EXCLUDE
+from O365 import MSGraphProtocol
+
+from O365_notifications.base import O365BaseNotification, O365Notification
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.decoders import O365NotificationDecoder
+
+
+def notification(ns):
+    return {
+        "@odata.type": ns.O365NotificationType.NOTIFICATION.value,
+        "Id": "null",
+        "SubscriptionId": "RUM4OEJFNUItNkQ3Ny00QjMzLTk2NTYtMzlFQTc0RkY3NTdD",
+        "SubscriptionExpirationDateTime": "2023-01-01T10:00:00.1234567Z",
+        "SequenceNumber": 1,
+        "ChangeType": O365EventType.CREATED.value,
+        "Resource": "https://graph.microsoft.com/beta/me/Messages('XYZ')",
+        "ResourceData": {
+            "@odata.type": ns.O365ResourceDataType.MESSAGE.value,
+            "@odata.id": "https://graph.microsoft.com/beta/me/Messages('XYZ')",
+            "@odata.etag": 'W/"CQAAABYAAADnDMLOxkE/RqDsw0YbXG7FAAAHeZ3y"',
+            "Id": "XYZ",
+        },
+    }
+
+
+def two_pass(ns):
+    """The original approach: peek at the type, then load the concrete schema."""
+    opts = {"namespace": ns, "unknown": EXCLUDE}
+
+    def decode(data):
+        base = O365BaseNotification.deserialize(data, **opts)
+        if base.type == ns.O365NotificationType.NOTIFICATION:
+            return O365Notification.deserialize(data, **opts)
+
+    return decode
+
+
+def registry(ns, validate):
+    decoder = O365NotificationDecoder(namespace=ns, validate=validate)
+    decoder.register(ns.O365NotificationType.NOTIFICATION, O365Notification)
+    return decoder.decode
+
+
+def run(decode, data, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        decode(data)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20000, help="notifications per run")
+    args = parser.parse_args()
+
+    ns = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+    data = notification(ns)
+    decoders = {
+        "two-pass marshmallow": two_pass(ns),
+        "registry (validating)": registry(ns, validate=True),
+        "registry (fast path)": registry(ns, validate=False),
+    }
+    for name, decode in decoders.items():
+        print(f"{name:<24}{run(decode, data, args.n):>12,.0f} notifications/sec")
+
+
+if __name__ == "__main__":
+    main()
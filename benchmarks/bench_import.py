@@ -0,0 +1,82 @@
+"""
+Cold start of the package: time to import its modules, in fresh interpreters.
+
+Exits with an error when the core, i.e. what notification handling processes
+import, exceeds its budget or pulls in ``O365`` or ``marshmallow``::
+
+    python benchmarks/bench_import.py --budget 50
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CORE = (
+    "O365_notifications.constants",
+    "O365_notifications.decoders",
+    "O365_notifications.notifications",
+    "O365_notifications.stream",
+    "O365_notifications.dedup",
+    "O365_notifications.dispatch",
+    "O365_notifications.routing",
+)
+SCENARIOS = {
+    "package": ("O365_notifications",),
+    "core": CORE,
+    "push": ("O365_notifications.push",),
+    "streaming": ("O365_notifications.streaming",),
+}
+HEAVY = ("O365", "marshmallow", "requests")
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+
+def probe(modules: tuple) -> tuple[float, list]:
+    """Import modules in a fresh interpreter: seconds taken, heavy imports."""
+    code = _PROBE.format(modules=modules, heavy=HEAVY)
+    out = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    elapsed, heavy = json.loads(out)
+    return elapsed, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10, help="imports per scenario")
+    parser.add_argument(
+        "--budget", type=float, default=50.0, help="core import budget, in ms"
+    )
+    args = parser.parse_args()
+
+    failures = []
+    for name, modules in SCENARIOS.items():
+        results = [probe(modules) for _ in range(args.runs)]
+        times = sorted(elapsed * 1e3 for elapsed, _ in results)
+        heavy = results[0][1]
+        print(
+            f"{name:>10}: median {statistics.median(times):7.1f} ms, "
+            f"min {times[0]:7.1f} ms, imports {', '.join(heavy) or '-'}"
+        )
+        if name == "core":
+            if heavy:
+                failures.append(f"core imports {', '.join(heavy)}")
+            if statistics.median(times) > args.budget:
+                failures.append(f"core import exceeds {args.budget} ms")
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
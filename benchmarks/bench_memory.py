@@ -0,0 +1,63 @@
+"""Memory held per queued notification, for each raw payload retention."""
+
+import argparse
+import collections
+import json
+import tracemalloc
+
+from O365 import MSGraphProtocol
+
+from O365_notifications.constants import O365EventType, O365KeepRaw, O365Namespace
+from O365_notifications.decoders import O365NotificationDecoder
+from O365_notifications.base import O365Notification
+
+
+def frame(ns, i):
+    data = {
+        "@odata.type": ns.O365NotificationType.NOTIFICATION.value,
+        "Id": "null",
+        "SubscriptionId": f"RUM4OEJFNUItNkQ3Ny00QjMzLTk2NTYtMzlFQTc0RkY3NTd{i % 4}",
+        "SubscriptionExpirationDateTime": "2023-01-01T10:00:00.1234567Z",
+        "SequenceNumber": i,
+        "ChangeType": O365EventType.CREATED.value,
+        "Resource": f"https://graph.microsoft.com/beta/me/Messages('{i:012}')",
+        "ResourceData": {
+            "@odata.type": ns.O365ResourceDataType.MESSAGE.value,
+            "@odata.id": f"https://graph.microsoft.com/beta/me/Messages('{i:012}')",
+            "@odata.etag": f'W/"CQAAABYAAADnDMLOxkE/RqDsw0YbXG7FAAA{i:08}"',
+            "Id": f"{i:012}",
+        },
+    }
+    return json.dumps(data).encode()
+
+
+def measure(ns, n, keep_raw):
+    decoder = O365NotificationDecoder(namespace=ns, keep_raw=keep_raw)
+    decoder.register(ns.O365NotificationType.NOTIFICATION, O365Notification)
+
+    queue = collections.deque()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        f = frame(ns, i)  # as read off the stream
+        queue.append(decoder.decode(json.loads(f), frame=f))
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return held / len(queue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20000, help="queued notifications")
+    args = parser.parse_args()
+
+    ns = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+    for keep_raw in O365KeepRaw:
+        per_notification = measure(ns, args.n, keep_raw)
+        print(
+            f"keep_raw={keep_raw.value:<8}{per_notification:>10,.0f} bytes/notification"
+        )
+
+
+if __name__ == "__main__":
+    main()
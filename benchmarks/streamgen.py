@@ -0,0 +1,220 @@
+"""Synthetic GetNotifications streams, and a stand-in connection serving them."""
+
+import itertools
+import json
+import random
+import time
+import uuid
+
+from O365_notifications.constants import O365EventType
+
+# strings meant to trip up naive json framing
+ADVERSARIAL = ["}{", '"}]', "\\", '{"value": [', "]}", '\\"}', "é☃"]
+
+
+class SyntheticStream:
+    """
+    The body of a GetNotifications response, split into chunks.
+
+    :param count: number of notifications, keep-alives excluded
+    :param namespace: the namespace the notifications belong to
+    :param subscription_ids: ids the notifications are spread over
+    :param payload_size: approximate size in bytes of each notification
+    :param keep_alive_ratio: keep-alives sent per notification
+    :param chunk_size: chunk size in bytes, or a (min, max) range to pick sizes
+        at random from, or None to cut chunks at notification boundaries
+    :param adversarial: pad notifications with strings made of json delimiters
+    :param rate: notifications per second, or None for as fast as possible
+    :param seed: seed for the random choices, for reproducible streams
+    """
+
+    def __init__(
+        self,
+        *,
+        count: int,
+        namespace,
+        subscription_ids: list = None,
+        payload_size: int = 600,
+        keep_alive_ratio: float = 0.0,
+        chunk_size=None,
+        adversarial: bool = False,
+        rate: float = None,
+        seed: int = 0,
+    ):
+        self.count = count
+        self.namespace = namespace
+        self.subscription_ids = subscription_ids or [str(uuid.UUID(int=seed))]
+        self.payload_size = payload_size
+        self.keep_alive_ratio = keep_alive_ratio
+        self.chunk_size = chunk_size
+        self.adversarial = adversarial
+        self.rate = rate
+        self.seed = seed
+        self.keep_alives = 0
+        self._frames = None
+        self._body = None
+
+    def notification(self, i: int, rng: random.Random) -> dict:
+        ns = self.namespace
+        url = f"https://graph.microsoft.com/beta/Users('foo')/Messages('{i:016}')"
+        data = {
+            "@odata.type": ns.O365NotificationType.NOTIFICATION.value,
+            "Id": "null",
+            "SubscriptionId": self.subscription_ids[i % len(self.subscription_ids)],
+            "SubscriptionExpirationDateTime": "2030-01-01T10:00:00.1234567Z",
+            "SequenceNumber": i // len(self.subscription_ids) + 1,
+            "ChangeType": O365EventType.CREATED.value,
+            "Resource": url,
+            "ResourceData": {
+                "@odata.type": ns.O365ResourceDataType.MESSAGE.value,
+                "@odata.id": url,
+                "@odata.etag": f'W/"CQAAABYAAADnDMLOxkE/RqDsw0YbXG7FAAA{i:08}"',
+                "Id": f"{i:016}",
+            },
+        }
+        padding = self.payload_size - len(json.dumps(data)) - len(', "Padding": ""')
+        if padding > 0:
+            if self.adversarial:
+                pieces = itertools.cycle(rng.sample(ADVERSARIAL, len(ADVERSARIAL)))
+                text = ""
+                while len(json.dumps(text)) < padding:
+                    text += next(pieces)
+            else:
+                text = "x" * padding
+            data["Padding"] = text
+        return data
+
+    def keep_alive(self) -> dict:
+        ns = self.namespace
+        return {
+            "@odata.type": ns.O365NotificationType.KEEP_ALIVE_NOTIFICATION.value,
+            "Status": "OK",
+        }
+
+    def frames(self) -> list[bytes]:
+        """The body, split at notification boundaries."""
+        if self._frames is None:
+            rng = random.Random(self.seed)
+            frames = [b'{"@odata.context": "$metadata#Notifications", "value": [']
+            elements = []
+            credit = 0.0
+            for i in range(self.count):
+                elements.append(json.dumps(self.notification(i, rng)).encode())
+                credit += self.keep_alive_ratio
+                while credit >= 1:
+                    elements.append(json.dumps(self.keep_alive()).encode())
+                    self.keep_alives += 1
+                    credit -= 1
+            for i, element in enumerate(elements):
+                frames.append(element if i == 0 else b", " + element)
+            frames.append(b"]}")
+            self._frames = frames
+        return self._frames
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = b"".join(self.frames())
+        return self._body
+
+    def chunks(self):
+        """Yield the body in chunks, paced to the configured rate."""
+        total = len(self.body)
+        start = time.perf_counter()
+        sent = 0
+        for chunk in self._split():
+            if self.rate is not None:
+                # approximate the notifications sent by the bytes sent
+                due = start + sent * self.count / total / self.rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent += len(chunk)
+            yield chunk
+
+    def _split(self):
+        if self.chunk_size is None:
+            yield from self.frames()
+            return
+        rng = random.Random(self.seed)
+        body, pos = self.body, 0
+        while pos < len(body):
+            size = self.chunk_size
+            if isinstance(size, tuple):
+                size = rng.randint(*size)
+            yield body[pos : pos + size]
+            pos += size
+
+
+class StreamResponse:
+    """Stand-in for the streamed ``requests`` response of GetNotifications."""
+
+    def __init__(self, stream: SyntheticStream):
+        self.stream = stream
+
+    def __bool__(self):
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def iter_content(self, chunk_size=None):
+        return self.stream.chunks()
+
+    def close(self):
+        pass
+
+
+class JsonResponse:
+    def __init__(self, data: dict):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class SyntheticConnection:
+    """
+    Stand-in for the O365 connection of a subscriber.
+
+    Subscription requests answer after ``rtt`` seconds; GetNotifications
+    requests are answered with the next stream from ``streams``.
+    """
+
+    def __init__(self, *, namespace, rtt: float = 0.0, streams=()):
+        self.namespace = namespace
+        self.rtt = rtt
+        self.streams = iter(streams)
+        self.requests = 0
+
+    def _subscription(self, data: dict, id: str = None) -> dict:
+        ns = self.namespace
+        return {
+            "@odata.type": ns.O365SubscriptionType.STREAMING_SUBSCRIPTION.value,
+            "Id": id or uuid.uuid4().hex,
+            "Resource": "https://graph.microsoft.com/beta/me/mailfolders/Messages",
+            "ChangeType": data.get("ChangeType", O365EventType.CREATED.value),
+            "SubscriptionExpirationDateTime": "2030-01-01T10:00:00Z",
+        }
+
+    def post(self, url: str, data: dict = None, **kwargs):
+        self.requests += 1
+        if url.endswith("/GetNotifications"):
+            try:
+                return StreamResponse(next(self.streams))
+            except StopIteration:
+                return None  # ends the streaming
+        time.sleep(self.rtt)
+        return JsonResponse(self._subscription(data or {}))
+
+    def patch(self, url: str, data: dict = None, **kwargs):
+        self.requests += 1
+        time.sleep(self.rtt)
+        return JsonResponse(self._subscription({}, id=url.rsplit("/", 1)[-1]))
+
+    def delete(self, url: str, **kwargs):
+        self.requests += 1
+        time.sleep(self.rtt)
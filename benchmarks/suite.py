@@ -0,0 +1,259 @@
+"""
+Benchmark suite of the streaming hot path, over synthetic GetNotifications streams.
+
+Results are written as json, and compared against a previous run with
+``--compare``::
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --output after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from O365 import MSGraphProtocol
+from streamgen import SyntheticConnection, SyntheticStream
+
+from O365_notifications.base import O365BaseNotificationsHandler
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.stream import NotificationStreamDecoder
+from O365_notifications.streaming import O365StreamingSubscriber
+
+PROTOCOL = MSGraphProtocol(api_version="beta")
+NAMESPACE = O365Namespace.from_protocol(protocol=PROTOCOL)
+
+
+class NoopHandler(O365BaseNotificationsHandler):
+    def __init__(self):
+        self.count = 0
+
+    def process(self, notification):
+        self.count += 1
+
+
+class QueueHandler(O365BaseNotificationsHandler):
+    def __init__(self):
+        self.queue = []
+
+    def process(self, notification):
+        self.queue.append(notification)
+
+
+def subscriber(con) -> O365StreamingSubscriber:
+    sub = O365StreamingSubscriber(
+        con=con, protocol=PROTOCOL, main_resource="foo@bar.com"
+    )
+    sub.subscribe(resource="inbox", events=[O365EventType.CREATED])
+    return sub
+
+
+def stream(args, **kwargs) -> SyntheticStream:
+    return SyntheticStream(
+        count=args.notifications,
+        namespace=NAMESPACE,
+        payload_size=args.payload_size,
+        keep_alive_ratio=args.keep_alive_ratio,
+        chunk_size=args.chunk_size,
+        adversarial=args.adversarial,
+        **kwargs,
+    )
+
+
+def prepared(args, *, rate=None):
+    """A subscriber about to stream a synthetic stream, generated up front."""
+    synthetic = stream(args, rate=rate)
+    synthetic.body
+    con = SyntheticConnection(namespace=NAMESPACE, streams=[synthetic])
+    return subscriber(con), synthetic
+
+
+def bench_throughput(args) -> dict:
+    handler = NoopHandler()
+    sub, synthetic = prepared(args, rate=args.rate)
+    start = time.perf_counter()
+    sub.start_streaming(notification_handler=handler)
+    elapsed = time.perf_counter() - start
+
+    expected = synthetic.count + synthetic.keep_alives
+    if handler.count != expected:
+        raise AssertionError(f"decoded {handler.count} of {expected} notifications")
+    return {
+        "notifications_per_second": synthetic.count / elapsed,
+        "megabytes_per_second": len(synthetic.body) / elapsed / 1e6,
+        "seconds": elapsed,
+    }
+
+
+def bench_decode_cpu(args) -> dict:
+    sub, synthetic = prepared(args)
+    chunks = list(synthetic.chunks())
+    decoder = NotificationStreamDecoder()
+    decoded = 0
+    start = time.process_time()
+    for chunk in chunks:
+        for frame in decoder.feed_frames(chunk):
+            sub.notification_factory(decoder.loads(frame), frame=frame)
+            decoded += 1
+    cpu = time.process_time() - start
+    if not decoder.done or decoded != synthetic.count + synthetic.keep_alives:
+        raise AssertionError("synthetic stream decoded incorrectly")
+    return {
+        "cpu_microseconds_per_notification": cpu / decoded * 1e6,
+        "cpu_seconds": cpu,
+    }
+
+
+def bench_peak_memory(args) -> dict:
+    results = {}
+    for name, handler in (("streaming", NoopHandler()), ("queued", QueueHandler())):
+        sub, _ = prepared(args)
+        tracemalloc.start()
+        sub.start_streaming(notification_handler=handler)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[f"{name}_peak_bytes"] = peak
+        if name == "queued":
+            results["queued_bytes_per_notification"] = current / len(handler.queue)
+    return results
+
+
+def bench_subscriptions(args) -> dict:
+    results = {}
+    for n in args.subscriptions:
+        sub = O365StreamingSubscriber(
+            con=SyntheticConnection(namespace=NAMESPACE, rtt=args.rtt),
+            protocol=PROTOCOL,
+            main_resource="foo@bar.com",
+        )
+        start = time.perf_counter()
+        for i in range(n):
+            sub.subscribe(resource=f"folder-{i}", events=[O365EventType.CREATED])
+        subscribed = time.perf_counter()
+        sub.renew_subscriptions()
+        renewed = time.perf_counter()
+        for subscription in list(sub.subscriptions):
+            sub.renew_subscription(subscription)
+        extended = time.perf_counter()
+        results[str(n)] = {
+            "subscribe_seconds": subscribed - start,
+            "renew_subscriptions_seconds": renewed - subscribed,
+            "renew_subscription_seconds": extended - renewed,
+        }
+    return results
+
+
+BENCHMARKS = {
+    "throughput": bench_throughput,
+    "decode_cpu": bench_decode_cpu,
+    "peak_memory": bench_peak_memory,
+    "subscriptions": bench_subscriptions,
+}
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict):
+    before = flatten(baseline["results"])
+    after = flatten(results["results"])
+    print(f"{'metric':<64}{'before':>14}{'after':>14}{'change':>10}")
+    for key, value in after.items():
+        if key not in before or not isinstance(value, (int, float)):
+            continue
+        change = f"{(value - before[key]) / before[key]:+.1%}" if before[key] else ""
+        print(f"{key:<64}{before[key]:>14.6g}{value:>14.6g}{change:>10}")
+
+
+def chunk_size(value: str):
+    """A size, a 'min-max' range, or 'frames'."""
+    if value == "frames":
+        return None
+    if "-" in value:
+        low, high = value.split("-")
+        return int(low), int(high)
+    return int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--notifications", type=int, default=20000)
+    parser.add_argument("--payload-size", type=int, default=600, help="in bytes")
+    parser.add_argument("--keep-alive-ratio", type=float, default=0.1)
+    parser.add_argument(
+        "--chunk-size",
+        type=chunk_size,
+        default=(1, 8192),
+        help="bytes per chunk, a 'min-max' range or 'frames' (default: 1-8192)",
+    )
+    parser.add_argument("--adversarial", action="store_true")
+    parser.add_argument(
+        "--rate", type=float, help="notifications per second for throughput"
+    )
+    parser.add_argument("--subscriptions", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument(
+        "--rtt", type=float, default=0.005, help="subscription request rtt, in s"
+    )
+    parser.add_argument(
+        "--only", choices=BENCHMARKS, nargs="+", default=list(BENCHMARKS)
+    )
+    parser.add_argument("--output", help="json results file, '-' for stdout")
+    parser.add_argument("--compare", help="json results of a previous run")
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            k: v for k, v in vars(args).items() if k not in ("output", "compare")
+        },
+        "results": {},
+    }
+    for name in args.only:
+        print(f"running {name} ...", file=sys.stderr)
+        results["results"][name] = BENCHMARKS[name](args)
+
+    text = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(text)
+    elif args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    elif args.output != "-":
+        for key, value in flatten(results["results"]).items():
+            print(f"{key:<64}{value:>14.6g}")
+
+
+if __name__ == "__main__":
+    main()
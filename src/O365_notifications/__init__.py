@@ -1,3 +1,52 @@
-from importlib import metadata
+import importlib
 
-__version__ = metadata.version("O365-notifications")
+# public names, imported from their module on first access: importing the package
+# loads neither 'O365' nor 'marshmallow', see 'O365_notifications.notifications'
+_exports = {
+    "constants": ("O365EventType", "O365KeepRaw", "O365Namespace"),
+    "decoders": ("O365NotificationDecoder",),
+    "notifications": (
+        "O365BaseNotification",
+        "O365BaseNotificationsHandler",
+        "O365KeepAliveNotification",
+        "O365Notification",
+        "O365NotificationBatcher",
+        "O365NotificationHandler",
+        "O365WrappingHandler",
+    ),
+    "base": ("O365BaseSubscription", "O365Subscriber"),
+    "push": (
+        "O365PushNotification",
+        "O365PushReceiver",
+        "O365PushSubscription",
+        "O365PushSubscriber",
+    ),
+    "streaming": (
+        "O365StreamWatchdog",
+        "O365StreamingSubscription",
+        "O365StreamingSubscriber",
+    ),
+    "planner": ("O365StreamPlanner",),
+    "aio": ("O365AsyncStreamingSubscriber",),
+}
+_modules = {name: module for module, names in _exports.items() for name in names}
+
+__all__ = tuple(_modules)
+
+
+def __getattr__(name: str):
+    if name == "__version__":
+        from importlib import metadata
+
+        value = metadata.version("O365-notifications")
+    elif name in _modules:
+        module = importlib.import_module(f"{__name__}.{_modules[name]}")
+        value = getattr(module, name)
+    else:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    globals()[name] = value  # looked up once
+    return value
+
+
+def __dir__():
+    return sorted({*globals(), *__all__, "__version__"})
@@ -0,0 +1,465 @@
+import asyncio
+import inspect
+import itertools
+import logging
+import threading
+import time
+import typing
+
+import aiohttp
+from O365.utils import ApiComponent
+
+from O365_notifications.base import (
+    O365BaseNotificationsHandler,
+    O365BaseSubscription,
+    O365NotificationBatcher,
+    O365NotificationHandler,
+    O365SubscribeResult,
+)
+from O365_notifications.constants import O365EventType
+from O365_notifications.stream import NotificationStreamDecoder
+from O365_notifications.streaming import O365StreamingSubscriber, _time_keep_alive
+
+__all__ = ("O365AsyncStreamingSubscriber",)
+
+logger = logging.getLogger(__name__)
+
+
+def _batches(handler: O365BaseNotificationsHandler) -> bool:
+    """Whether a handler processes batches in a method of its own."""
+    return type(handler).process_batch is not O365BaseNotificationsHandler.process_batch
+
+
+class _Wakeup:
+    """
+    Wakes up a streaming running on an event loop, from any thread.
+
+    Stands in for the events queue of the threaded streaming loop, which
+    ``stop_streaming`` puts a sentinel on: the open response is closed instead,
+    interrupting the pending read, and backoff sleeps are cut short.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.response = None  # the open stream, if any
+
+    def put_nowait(self, item):
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self.event.set()
+        if self.response is not None:
+            self.response.close()
+
+    async def sleep(self, delay: float):
+        try:
+            await asyncio.wait_for(self.event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+class O365AsyncStreamingSubscriber(O365StreamingSubscriber):
+    """
+    Streaming subscriber running on an asyncio event loop.
+
+    Subscribers of many mailboxes can stream concurrently on a single event loop,
+    sharing the connection pool of a common ``aiohttp.ClientSession``. Handlers
+    may implement ``process`` and ``process_batch`` either as regular or as
+    coroutine functions; coroutine handlers can't be wrapped by the handlers of
+    the package, which run them from regular functions.
+
+    The subscription methods and ``start_streaming`` are coroutines, so the
+    helpers driving subscribers from threads - renewal scheduler, stream planner
+    and sharded supervisor - refuse asynchronous subscribers.
+    """
+
+    asynchronous = True
+
+    def __init__(
+        self,
+        *,
+        parent=None,
+        con=None,
+        session: aiohttp.ClientSession = None,
+        **kwargs,
+    ):
+        super().__init__(parent=parent, con=con, **kwargs)
+        self.session = session
+        self._owns_session = session is None
+
+    async def close(self):
+        """Close the http session, unless it was provided by the caller."""
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _headers(self) -> dict:
+        backend = self.con.token_backend
+        token = backend.token or backend.get_token()
+        if not token:
+            raise RuntimeError("No auth token found. Authentication Flow needed")
+        return {
+            **(getattr(self.con, "default_headers", None) or {}),
+            "Authorization": f"Bearer {token['access_token']}",
+        }
+
+    async def request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """
+        Authenticated request to the api provider.
+
+        The token is refreshed once if the api provider responds with 401.
+
+        :param method: the http method
+        :param url: the request url
+        :param kwargs: extra params to send to ``aiohttp.ClientSession.request``
+        :return: the response
+        :raises aiohttp.ClientResponseError: for 4XX and 5XX responses
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        response = await self.session.request(
+            method, url, headers=self._headers(), **kwargs
+        )
+        if response.status == 401:
+            response.release()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.con.refresh_token)
+            response = await self.session.request(
+                method, url, headers=self._headers(), **kwargs
+            )
+        response.raise_for_status()
+        return response
+
+    async def _timed_request(
+        self, operation: str, method: str, url: str, **kwargs
+    ) -> aiohttp.ClientResponse:
+        """Send a subscription request, timing it when instrumented."""
+        if self.instrumentation is None:
+            return await self.request(method, url, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await self.request(method, url, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.instrumentation.request_completed(operation, elapsed)
+
+    async def subscribe(
+        self, *, resource: ApiComponent, events: list[O365EventType]
+    ) -> O365BaseSubscription:
+        """
+        Subscription to a given resource.
+
+        :param resource: the resource to subscribe to
+        :param events: events type for the resource subscription
+        :return: the registered subscription
+        """
+        req = self.subscription_factory(resource=resource, events=events).serialize()
+
+        url = self.build_url(self._endpoints.get("subscriptions"))
+        response = await self._timed_request("subscribe", "POST", url, json=req)
+        async with response:
+            raw = await response.json(content_type=None)
+        return self.register_subscription(resource=resource, events=events, raw=raw)
+
+    async def subscribe_many(
+        self,
+        resources: typing.Iterable[ApiComponent],
+        events: list[O365EventType],
+        *,
+        max_workers: int = 8,
+    ) -> list[O365SubscribeResult]:
+        """
+        Subscribe to many resources on the same events, concurrently.
+
+        See ``O365Subscriber.subscribe_many``; requests share the http session.
+
+        :param resources: the resources to subscribe to
+        :param events: events type for the resource subscriptions
+        :param max_workers: max number of concurrent requests
+        :return: the outcome per resource, in order
+        """
+        template, url_key = self.subscription_template(events)
+        url = self.build_url(self._endpoints.get("subscriptions"))
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def subscribe(resource) -> O365SubscribeResult:
+            req = {**template, url_key: self.resource_url(resource)}
+            try:
+                async with semaphore:
+                    response = await self._timed_request(
+                        "subscribe", "POST", url, json=req
+                    )
+                    async with response:
+                        raw = await response.json(content_type=None)
+                subscription = self.register_subscription(
+                    resource=resource, events=events, raw=raw
+                )
+            except Exception as e:
+                logger.warning(f"Failed subscribing to resource '{resource}': {e!r}")
+                return O365SubscribeResult(resource, error=e)
+            return O365SubscribeResult(resource, subscription)
+
+        return list(await asyncio.gather(*(subscribe(r) for r in resources)))
+
+    async def unsubscribe(self, subscription: O365BaseSubscription):
+        """
+        Delete a subscription.
+
+        :param subscription: the subscription to delete
+        """
+        endpoint = self._endpoints.get("subscription").format(id=subscription.id)
+        try:
+            response = await self._timed_request(
+                "unsubscribe", "DELETE", self.build_url(endpoint)
+            )
+            response.release()
+        except aiohttp.ClientResponseError as e:
+            # the subscription is gone already
+            if e.status != 404:
+                raise e
+        self.subscriptions.remove(subscription)
+        self.expirations.pop(subscription.id, None)
+        logger.debug(f"Unsubscribed from resource '{subscription.resource}'")
+
+    async def renew_subscription(
+        self, subscription: O365BaseSubscription
+    ) -> O365BaseSubscription:
+        """
+        Extend the lifetime of a subscription, keeping its id.
+
+        :param subscription: the subscription to renew
+        :return: the renewed subscription
+        """
+        endpoint = self._endpoints.get("subscription").format(id=subscription.id)
+        body = self.renewal_request(subscription)
+        try:
+            response = await self._timed_request(
+                "renew", "PATCH", self.build_url(endpoint), json=body
+            )
+        except aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise e
+            logger.debug(f"Subscription '{subscription.id}' no longer exists.")
+            return await self.subscribe(
+                resource=subscription.resource, events=subscription.events
+            )
+        async with response:
+            raw = await response.json(content_type=None)
+        return self.register_subscription(
+            resource=subscription.resource, events=subscription.events, raw=raw
+        )
+
+    async def renew_subscriptions(
+        self, *, max_workers: int = 4
+    ) -> list[O365BaseSubscription]:
+        """
+        Subscribe anew to every subscribed resource, concurrently.
+
+        :param max_workers: max number of concurrent requests
+        :return: the renewed subscriptions
+        """
+        names = ", ".join(f"'{s.resource}'" for s in self.subscriptions)
+        logger.info(f"Renewing subscriptions for {names} ...")
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def renew(sub):
+            async with semaphore:
+                return await self.subscribe(resource=sub.resource, events=sub.events)
+
+        renewed = await asyncio.gather(*(renew(s) for s in list(self.subscriptions)))
+        logger.info("Subscriptions renewed.")
+        return list(renewed)
+
+    async def _deliver(self, handler: O365BaseNotificationsHandler, item):
+        instrumentation = self.instrumentation
+        start = time.perf_counter() if instrumentation is not None else None
+        if isinstance(item, list) and not _batches(handler):
+            for notification in item:  # in order, as 'process_batch' does
+                result = handler.process(notification)
+                if inspect.isawaitable(result):
+                    await result
+        else:
+            result = self.handover(handler, item)
+            if inspect.isawaitable(result):
+                await result
+        if instrumentation is not None:
+            count = len(item) if isinstance(item, list) else 1
+            instrumentation.notifications_handled(count, time.perf_counter() - start)
+
+    async def start_streaming(
+        self,
+        *,
+        notification_handler: O365BaseNotificationsHandler = None,
+        connection_timeout: int = 120,  # equivalent to 2 hours
+        keep_alive_interval: int = 5,  # in seconds
+        refresh_after_expire: bool = False,
+        missed_keep_alives: int = 3,
+        stop: threading.Event = None,
+    ):
+        """
+        Start a new streaming connection.
+
+        A connection missing ``missed_keep_alives`` keep-alives in a row is flagged
+        as dead, and a new one is opened after a jittered exponential backoff.
+        ``stop_streaming`` closes the connection, from the event loop or any other
+        thread, and batched notifications are handed over before returning.
+
+        :param notification_handler: the notification's handler
+        :param connection_timeout: time in minutes in which connection closes
+        :param keep_alive_interval: time interval in seconds in which a message is sent
+        :param refresh_after_expire: refresh when http connection expires
+        :param missed_keep_alives: keep-alives missed before reconnecting, or 0 to
+            wait on the connection indefinitely
+        :param stop: stops this streaming only, once set by ``stop_streaming``
+        :raises ValueError: if no subscription is provided
+        :raises aiohttp.ClientError: if streaming error occurs
+        """
+        if not self.subscriptions:
+            raise ValueError("can't start a streaming connection without subscription.")
+
+        notification_handler = notification_handler or O365NotificationHandler()
+        url = self.build_url(self._endpoints.get("notifications"))
+
+        request_schema = self.streaming_request(
+            connection_timeout=connection_timeout,
+            keep_alive_interval=keep_alive_interval,
+        )
+        # the stream is long-lived, but must not go silent
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_read=keep_alive_interval * missed_keep_alives or None
+        )
+        wakeup = _Wakeup(asyncio.get_running_loop())
+        stopping = stop if stop is not None else threading.Event()
+        with self._lock:
+            if self._stopping.is_set():  # stopped before it started
+                self._stopping.clear()
+                stopping.set()
+            self._running.append((wakeup, stopping))
+        try:
+            await self._stream(
+                notification_handler,
+                url,
+                request_schema,
+                timeout,
+                refresh_after_expire,
+                wakeup,
+                stopping,
+            )
+        finally:
+            with self._lock:
+                self._running.remove((wakeup, stopping))
+
+        logger.info("Cancel streaming: connection closed.")
+
+    async def _stream(
+        self,
+        notification_handler: O365BaseNotificationsHandler,
+        url: str,
+        request_schema: dict,
+        timeout: aiohttp.ClientTimeout,
+        refresh_after_expire: bool,
+        wakeup: _Wakeup,
+        stopping: threading.Event,
+    ):
+        failures = 0  # consecutive dead connections
+
+        instrumentation = self.instrumentation
+        logger.info("Open new events channel ...")
+        for cycle in itertools.count():
+            if stopping.is_set():
+                break
+            if instrumentation is not None:
+                if cycle:
+                    instrumentation.reconnected()
+            if failures:
+                await wakeup.sleep(self._backoff(failures - 1))
+                if stopping.is_set():
+                    break
+            # pick up subscription ids swapped by renewals
+            request_schema["SubscriptionIds"] = [s.id for s in self.subscriptions]
+            try:
+                response = await self.request(
+                    "POST", url, json=request_schema, timeout=timeout
+                )
+                logger.debug("Start streaming cycle ...")
+
+            # Renew subscriptions if 404 is raised
+            except aiohttp.ClientResponseError as e:
+                if e.status == 404:
+                    logger.debug("Expired subscription.")
+                    if instrumentation is not None:
+                        instrumentation.not_found_renewal()
+                    await self.renew_subscriptions()
+                    continue
+                # raise for any other error
+                raise e
+
+            dead = False
+            wakeup.response = response
+            if stopping.is_set():  # stopped while connecting
+                response.close()
+            async with response:
+                decoder = NotificationStreamDecoder()
+                batcher = O365NotificationBatcher(notification_handler)
+                last_keep_alive = None  # of this connection
+                read = None
+                try:
+                    while True:
+                        if read is None:
+                            read = asyncio.ensure_future(response.content.readany())
+                        # wake up for the lingering batch, if any
+                        await asyncio.wait({read}, timeout=batcher.remaining())
+                        if read.done():
+                            chunk, read = read.result(), None
+                            if not chunk:
+                                break  # end of the stream
+                            if instrumentation is not None:
+                                instrumentation.bytes_read(len(chunk))
+                            for frame in decoder.feed_frames(chunk):
+                                failures = 0
+                                notification = self.notification_factory(
+                                    decoder.loads(frame), frame=frame
+                                )
+                                if instrumentation is not None:
+                                    last_keep_alive = _time_keep_alive(
+                                        instrumentation, notification, last_keep_alive
+                                    )
+                                for item in batcher.add(notification):
+                                    await self._deliver(notification_handler, item)
+                        for item in batcher.poll():
+                            await self._deliver(notification_handler, item)
+                        if decoder.done:
+                            break  # Connection timed out
+                except aiohttp.ClientPayloadError as e:
+                    # Same as requests.exceptions.ChunkedEncodingError on the
+                    # synchronous subscriber: restart the streaming
+                    logger.warning(f"Exception suppressed: {e}")
+                    if instrumentation is not None:
+                        instrumentation.error_suppressed(e)
+                except asyncio.TimeoutError as e:
+                    logger.warning(f"No keep-alive for {timeout.sock_read}s.")
+                    if instrumentation is not None:
+                        instrumentation.error_suppressed(e)
+                    dead = True
+                except aiohttp.ClientConnectionError:
+                    if not stopping.is_set():
+                        raise
+                    # closed by 'stop_streaming'
+                finally:
+                    if read is not None:
+                        read.cancel()
+                for item in batcher.flush():
+                    await self._deliver(notification_handler, item)
+            wakeup.response = None
+
+            # Reconnect dead connections, and refresh them after they expire
+            if stopping.is_set():
+                break
+            elif dead:
+                failures += 1
+            elif refresh_after_expire:
+                logger.debug("Refreshing connection ...")
+            else:
+                break
@@ -1,91 +1,42 @@
 import datetime
 import logging
-from abc import ABC, abstractmethod
+import time
+import typing
+from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
-from marshmallow import Schema, fields, post_load, pre_dump
+import requests
 from O365.utils import ApiComponent
 
-from O365_notifications.constants import O365EventType, O365Namespace
-from O365_notifications.utils import DeserializerMixin, build_url
+from O365_notifications.constants import O365EventType, O365KeepRaw, O365Namespace
+from O365_notifications.decoders import O365NotificationDecoder
+from O365_notifications.fetch import O365ResourceFetcher
+from O365_notifications.metrics import O365Instrumentation
+from O365_notifications.notifications import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365Notification,
+    O365NotificationBatcher,
+    O365NotificationHandler,
+)
+from O365_notifications.registry import O365SubscriptionRegistry
+from O365_notifications.utils import DeserializerMixin, build_url, lazy_schema
 
 __all__ = (
     "O365BaseNotification",
     "O365BaseNotificationsHandler",
     "O365BaseSubscription",
     "O365Notification",
+    "O365NotificationBatcher",
     "O365NotificationHandler",
+    "O365SubscribeResult",
     "O365Subscriber",
 )
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class O365BaseNotification(DeserializerMixin, ABC):
-    type: O365Namespace.O365NotificationType
-
-    class BaseO365NotificationSchema(DeserializerMixin.DeserializerSchema):
-        type = fields.Str(data_key="@odata.type")
-
-        def __init__(self, **kwargs):
-            self.namespace = kwargs.pop("namespace", None)
-            super().__init__(**kwargs)
-
-        @post_load
-        def convert_types(self, data, **_):
-            data["type"] = self.namespace.O365NotificationType(data["type"])
-            return data
-
-    schema = BaseO365NotificationSchema  # alias
-
-
-@dataclass
-class O365Notification(O365BaseNotification):
-    id: str
-    subscription_id: str
-    subscription_expire: datetime
-    sequence: int
-    event: O365EventType
-
-    @dataclass
-    class O365ResourceData:
-        type: O365Namespace.O365ResourceDataType
-        url: str
-        etag: str
-        id: str
-
-    class O365NotificationSchema(O365BaseNotification.schema):
-        id = fields.Str(data_key="Id")
-        subscription_id = fields.Str(data_key="SubscriptionId")
-        subscription_expire = fields.DateTime(data_key="SubscriptionExpirationDateTime")
-        sequence = fields.Int(data_key="SequenceNumber")
-        event = fields.Str(data_key="ChangeType")
-        resource = fields.Nested(
-            Schema.from_dict(
-                {
-                    "type": fields.Str(data_key="@odata.type"),
-                    "url": fields.Url(data_key="@odata.id"),
-                    "etag": fields.Str(data_key="@odata.etag"),
-                    "id": fields.Str(data_key="Id"),
-                }
-            ),
-            data_key="ResourceData",
-        )
-
-        @post_load
-        def convert_types(self, data, **_):
-            ns = self.namespace
-            data["type"] = ns.O365NotificationType.NOTIFICATION
-            data["event"] = O365EventType(data["event"])
-            data["resource"]["type"] = ns.O365ResourceDataType(data["resource"]["type"])
-            data["resource"] = O365Notification.O365ResourceData(**data["resource"])
-            return data
-
-    resource: O365ResourceData
-    schema = O365NotificationSchema  # alias
-
-
 @dataclass
 class O365BaseSubscription(DeserializerMixin, ABC):
     type: O365Namespace.O365SubscriptionType
@@ -93,44 +44,86 @@ class O365BaseSubscription(DeserializerMixin, ABC):
     resource: ApiComponent
     resource_url: str = None
     id: str = None
-
-    class BaseO365SubscriptionSchema(DeserializerMixin.DeserializerSchema):
-        id = fields.Str(data_key="Id", load_only=True)
-        type = fields.Str(data_key="@odata.type")
-        resource_url = fields.Str(data_key="Resource")
-        events = fields.Str(data_key="ChangeType")
-
-        def __init__(self, **kwargs):
-            self.resource = kwargs.pop("resource", None)
-            self.namespace = kwargs.pop("namespace", None)
-            super().__init__(**kwargs)
-
-        @pre_dump
-        def serialize(self, obj, **_):
-            data = obj.__dict__
-            data["type"] = data["type"].value
-            data["events"] = ",".join(e.value for e in data["events"])
-            data["resource_url"] = (build_url(data["resource"]),)
-            return data
-
-        @post_load
-        def convert_types(self, data, **_):
-            data["type"] = self.namespace.O365SubscriptionType(data["type"])
-            data["events"] = [O365EventType(e) for e in data["events"].split(",")]
-            data["resource"] = self.resource
-            return data
-
-    schema = BaseO365SubscriptionSchema  # alias
+    expiration: datetime.datetime = None
+
+    @lazy_schema
+    def schema():
+        from marshmallow import fields, post_load, pre_dump
+
+        class BaseO365SubscriptionSchema(DeserializerMixin.schema):
+            id = fields.Str(data_key="Id", load_only=True)
+            type = fields.Str(data_key="@odata.type")
+            resource_url = fields.Str(data_key="Resource")
+            events = fields.Str(data_key="ChangeType")
+            expiration = fields.DateTime(
+                data_key="SubscriptionExpirationDateTime", load_only=True
+            )
+
+            def __init__(self, **kwargs):
+                self.resource = kwargs.pop("resource", None)
+                self.namespace = kwargs.pop("namespace", None)
+                super().__init__(**kwargs)
+
+            @pre_dump
+            def serialize(self, obj, **_):
+                data = dict(obj.__dict__)  # the subscription is left untouched
+                data["type"] = data["type"].value
+                data["events"] = ",".join(e.value for e in data["events"])
+                if data["resource_url"] is None:
+                    data["resource_url"] = build_url(data["resource"])
+                return data
+
+            @post_load
+            def convert_types(self, data, **_):
+                data["type"] = self.namespace.O365SubscriptionType(data["type"])
+                data["events"] = [O365EventType(e) for e in data["events"].split(",")]
+                data["resource"] = self.resource
+                return data
+
+        return BaseO365SubscriptionSchema
 
     def serialize(self, **kwargs):
+        kwargs.setdefault("namespace", O365Namespace.from_type(self.type.value))
         return self.schema(**kwargs).dump(self)
 
 
+@dataclass
+class O365SubscribeResult:
+    """Outcome of subscribing to one of the resources given to ``subscribe_many``."""
+
+    resource: ApiComponent
+    subscription: O365BaseSubscription = None
+    error: Exception = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
 class O365Subscriber(ApiComponent, ABC):
-    _endpoints = {"subscriptions": "/subscriptions"}
+    _endpoints = {
+        "subscriptions": "/subscriptions",
+        "subscription": "/subscriptions/{id}",
+    }
     subscription_cls = O365BaseSubscription
+    notification_classes = {"NOTIFICATION": O365Notification}
+    asynchronous = False  # whether its requests and streamings are coroutines
+
+    def __init__(
+        self,
+        *,
+        parent=None,
+        con=None,
+        keep_raw: O365KeepRaw = O365KeepRaw.FULL,
+        instrumentation: O365Instrumentation = None,
+        **kwargs,
+    ):
+        """
+        Subscriber of notifications.
 
-    def __init__(self, *, parent=None, con=None, **kwargs):
+        :param keep_raw: what notifications keep of their raw payload
+        :param instrumentation: hooks observing the subscriber at work
+        """
         protocol = kwargs.get("protocol", getattr(parent, "protocol", None))
         main_resource = kwargs.get(
             "main_resource", getattr(parent, "main_resource", None)
@@ -140,52 +133,239 @@ class O365Subscriber(ApiComponent, ABC):
 
         self.con = getattr(parent, "con", con)  # communication with the api provider
         self.namespace = O365Namespace.from_protocol(protocol=protocol)
-        self.subscriptions = []
+        self.subscriptions = O365SubscriptionRegistry()
+        self.expirations = {}  # subscription expiration, as seen on notifications
+        self.fetcher = O365ResourceFetcher(self)  # resources notified about
+        self.instrumentation = instrumentation
+
+        self.decoder = O365NotificationDecoder(
+            namespace=self.namespace, keep_raw=keep_raw
+        )
+        for name, cls in self.notification_classes.items():
+            self.decoder.register(self.namespace.O365NotificationType[name], cls)
 
     def subscription_factory(self, **kwargs) -> O365BaseSubscription:
         return self.subscription_cls(**{**kwargs, "raw": kwargs})
 
+    def resource_url(self, resource: ApiComponent) -> typing.Optional[str]:
+        """The url subscriptions refer to a resource by."""
+        return build_url(resource)
+
+    def renewal_request(self, subscription: O365BaseSubscription) -> dict:
+        """The request extending the lifetime of a subscription."""
+        return {"@odata.type": subscription.type.value}
+
+    def notification_factory(
+        self, data: dict, *, frame: bytes = None
+    ) -> O365BaseNotification:
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            notification = self.decoder.decode(data, frame=frame)
+        else:
+            start = time.perf_counter()
+            notification = self.decoder.decode(data, frame=frame)
+            instrumentation.notification_decoded(
+                notification.type.name, time.perf_counter() - start
+            )
+        subscription_id = getattr(notification, "subscription_id", None)
+        if subscription_id is not None:
+            notification.subscription = self.subscriptions.get(subscription_id)
+            self.expirations[subscription_id] = notification.subscription_expire
+        return notification
+
+    @staticmethod
+    def handover(handler: "O365BaseNotificationsHandler", item):
+        """Hand over an item released by an ``O365NotificationBatcher``."""
+        if isinstance(item, list):
+            return handler.process_batch(item)
+        return handler.process(item)
+
+    def deliver(self, handler: "O365BaseNotificationsHandler", item):
+        """Hand over an item, timing the handler when instrumented."""
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self.handover(handler, item)
+        start = time.perf_counter()
+        try:
+            return self.handover(handler, item)
+        finally:
+            count = len(item) if isinstance(item, list) else 1
+            instrumentation.notifications_handled(count, time.perf_counter() - start)
+
+    def _timed(self, operation: str, request, *args, **kwargs):
+        """Send a subscription request, timing it when instrumented."""
+        if self.instrumentation is None:
+            return request(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.instrumentation.request_completed(operation, elapsed)
+
     def subscribe(self, *, resource: ApiComponent, events: list[O365EventType]):
         """
         Subscription to a given resource.
 
         :param resource: the resource to subscribe to
         :param events: events type for the resource subscription
+        :return: the registered subscription
         """
         req = self.subscription_factory(resource=resource, events=events).serialize()
 
         url = self.build_url(self._endpoints.get("subscriptions"))
-        response = self.con.post(url, req)
-        raw = response.json()
+        response = self._timed("subscribe", self.con.post, url, req)
+        return self.register_subscription(
+            resource=resource, events=events, raw=response.json()
+        )
 
-        # register subscription
+    def subscription_template(self, events: list[O365EventType]) -> tuple[dict, str]:
+        """
+        The subscription request on given events, for any resource.
+
+        :param events: events type for the resource subscriptions
+        :return: the request, and the key the resource url is to be set at
+        """
+        schema = self.subscription_cls.schema(namespace=self.namespace)
+        template = schema.dump(self.subscription_factory(resource=None, events=events))
+        return template, schema.fields["resource_url"].data_key
+
+    def subscribe_many(
+        self,
+        resources: typing.Iterable[ApiComponent],
+        events: list[O365EventType],
+        *,
+        max_workers: int = 8,
+    ) -> list[O365SubscribeResult]:
+        """
+        Subscribe to many resources on the same events, concurrently.
+
+        The subscription request is serialized once, and only the url of each
+        resource is set into a copy of it. Requests are sent over the pooled
+        connection, ``max_workers`` at a time, which should not exceed its pool
+        size. A failed subscription doesn't prevent the others.
+
+        :param resources: the resources to subscribe to
+        :param events: events type for the resource subscriptions
+        :param max_workers: max number of concurrent requests
+        :return: the outcome per resource, in order
+        """
+        template, url_key = self.subscription_template(events)
+        url = self.build_url(self._endpoints.get("subscriptions"))
+
+        def subscribe(resource) -> O365SubscribeResult:
+            req = {**template, url_key: self.resource_url(resource)}
+            try:
+                response = self._timed("subscribe", self.con.post, url, req)
+                subscription = self.register_subscription(
+                    resource=resource, events=events, raw=response.json()
+                )
+            except Exception as e:
+                logger.warning(f"Failed subscribing to resource '{resource}': {e!r}")
+                return O365SubscribeResult(resource, error=e)
+            return O365SubscribeResult(resource, subscription)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(subscribe, resources))
+        failed = sum(not r.ok for r in results)
+        logger.info(
+            f"Subscribed to {len(results) - failed} resources, {failed} failed."
+        )
+        return results
+
+    def register_subscription(
+        self, *, resource: ApiComponent, events: list[O365EventType], raw: dict
+    ) -> O365BaseSubscription:
+        """
+        Keep track of a subscription created by the api provider.
+
+        :param resource: the subscribed resource
+        :param events: events type for the resource subscription
+        :param raw: the subscription payload returned by the api provider
+        :return: the registered subscription
+        """
         subscription = self.subscription_cls.deserialize(
             data=raw, resource=resource, namespace=self.namespace
         )
 
-        update = next((s for s in self.subscriptions if s.resource == resource), None)
-        if update:
-            update.id = subscription.id
-            update.events = events
-            update.raw = raw
-        else:
-            self.subscriptions.append(subscription)
+        subscription = self.subscriptions.upsert(subscription)
         logger.debug(f"Subscribed to resource '{resource}' on events: '{events}'")
+        return subscription
 
-    def renew_subscriptions(self):
+    def unsubscribe(self, subscription: O365BaseSubscription):
+        """
+        Delete a subscription.
+
+        :param subscription: the subscription to delete
+        """
+        endpoint = self._endpoints.get("subscription").format(id=subscription.id)
+        try:
+            self._timed("unsubscribe", self.con.delete, self.build_url(endpoint))
+        except requests.exceptions.HTTPError as e:
+            # the subscription is gone already
+            if e.response is None or e.response.status_code != requests.codes.not_found:
+                raise e
+        self.subscriptions.remove(subscription)
+        self.expirations.pop(subscription.id, None)
+        logger.debug(f"Unsubscribed from resource '{subscription.resource}'")
+
+    def renew_subscription(
+        self, subscription: O365BaseSubscription
+    ) -> O365BaseSubscription:
+        """
+        Extend the lifetime of a subscription, keeping its id.
+
+        Running streams are thus unaffected. A new subscription is created instead
+        if the subscription no longer exists.
+
+        :param subscription: the subscription to renew
+        :return: the renewed subscription
+        """
+        endpoint = self._endpoints.get("subscription").format(id=subscription.id)
+        try:
+            response = self._timed(
+                "renew",
+                self.con.patch,
+                self.build_url(endpoint),
+                self.renewal_request(subscription),
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != requests.codes.not_found:
+                raise e
+            logger.debug(f"Subscription '{subscription.id}' no longer exists.")
+            return self.subscribe(
+                resource=subscription.resource, events=subscription.events
+            )
+        return self.register_subscription(
+            resource=subscription.resource,
+            events=subscription.events,
+            raw=response.json(),
+        )
+
+    def renew_subscriptions(self, *, max_workers: int = 4):
+        """
+        Subscribe anew to every subscribed resource, concurrently.
+
+        :param max_workers: max number of concurrent requests
+        :return: the renewed subscriptions
+        """
         names = ", ".join(f"'{s.resource}'" for s in self.subscriptions)
         logger.info(f"Renewing subscriptions for {names} ...")
-        for sub in self.subscriptions:
-            self.subscribe(resource=sub.resource, events=sub.events)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            renewed = list(
+                executor.map(
+                    lambda s: self.subscribe(resource=s.resource, events=s.events),
+                    list(self.subscriptions),
+                )
+            )
         logger.info("Subscriptions renewed.")
+        return renewed
 
 
-class O365BaseNotificationsHandler(ABC):
-    @abstractmethod
-    def process(self, notification: O365BaseNotification):
-        pass
-
-
-class O365NotificationHandler(O365BaseNotificationsHandler):
-    def process(self, notification: O365BaseNotification):
-        logger.debug(vars(notification))
+def _require_synchronous(subscriber: O365Subscriber, user: str):
+    """Refuse subscribers whose methods are coroutines, for ``user`` to call."""
+    if subscriber.asynchronous:
+        raise TypeError(
+            f"'{user}' calls the subscriber from threads, which can't run the "
+            f"coroutines of '{type(subscriber).__name__}'."
+        )
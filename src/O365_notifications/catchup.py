@@ -0,0 +1,361 @@
+import json
+import logging
+import os
+import threading
+import typing
+
+import O365.mailbox
+import requests
+
+from O365_notifications.base import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365BaseSubscription,
+    O365Notification,
+    O365Subscriber,
+)
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.dedup import O365DedupFilter, _change_key
+from O365_notifications.notifications import O365WrappingHandler
+from O365_notifications.registry import O365SubscriptionRegistry
+from O365_notifications.utils import build_url
+
+__all__ = ("O365CatchUpHandler", "O365DeltaQuery", "O365DeltaTokenStore")
+
+logger = logging.getLogger(__name__)
+
+
+class O365DeltaTokenStore:
+    """
+    Delta links of subscribed resources, optionally persisted to a json file.
+
+    Links are kept per subscribed resource, rather than per subscription id, so
+    they outlive subscriptions created anew, e.g. after a 404 renewal.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._links = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._links = json.load(f)
+
+    @staticmethod
+    def key(subscription: O365BaseSubscription) -> str:
+        return str(O365SubscriptionRegistry.resource_key(subscription.resource))
+
+    def get(self, subscription: O365BaseSubscription) -> typing.Optional[str]:
+        """The link to resume the delta query of a subscription from, if any."""
+        return self._links.get(self.key(subscription))
+
+    def set(self, subscription: O365BaseSubscription, link: typing.Optional[str]):
+        """Store the link to resume from, or forget it if None."""
+        with self._lock:
+            if link is None:
+                self._links.pop(self.key(subscription), None)
+            else:
+                self._links[self.key(subscription)] = link
+            if self.path is not None:
+                with open(f"{self.path}.tmp", "w") as f:
+                    json.dump(self._links, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(f"{self.path}.tmp", self.path)
+
+
+class O365DeltaQuery:
+    """
+    Pages through the delta endpoint of subscribed folders.
+
+    Changes are read lazily, one page at a time, and turned into notifications as
+    if sent by the stream: changed messages are reported as ``Updated`` (or
+    ``Created``, to subscriptions only listening to creations) and removed ones as
+    ``Deleted``; events a subscription does not listen to are left out. Being
+    synthesized, these notifications carry no sequence number.
+
+    The link to resume from is stored once every change of a page was consumed, so
+    an interrupted catch-up resumes where it left off.
+
+    Delta queries are a Microsoft Graph feature: the sync flow of the Outlook REST
+    api (``Prefer: odata.track-changes``) is not supported.
+    """
+
+    def __init__(
+        self,
+        subscriber: O365Subscriber,
+        *,
+        store: O365DeltaTokenStore = None,
+        page_size: int = 100,
+    ):
+        """
+        :param subscriber: the subscriber of the folders
+        :param store: the delta links, kept in memory by default
+        :param page_size: max changes per page
+        :raises ValueError: if the subscriber is not on Microsoft Graph
+        """
+        graph = O365Namespace.O365Protocol.MSGraphProtocol.value
+        if subscriber.namespace.base != graph:
+            raise ValueError("delta queries require the Microsoft Graph protocol.")
+        self.subscriber = subscriber
+        self.store = store if store is not None else O365DeltaTokenStore()
+        self.page_size = page_size
+
+    @staticmethod
+    def supports(subscription: O365BaseSubscription) -> bool:
+        return isinstance(subscription.resource, O365.mailbox.Folder)
+
+    def prime(self, subscription: O365BaseSubscription):
+        """
+        Page through the current state of a folder, to track changes from now on.
+
+        :param subscription: the subscription of the folder
+        """
+        self.store.set(subscription, None)
+        for _ in self._pages(subscription):
+            pass
+
+    def pages(
+        self, subscription: O365BaseSubscription
+    ) -> typing.Iterator[list[O365Notification]]:
+        """
+        Changes to a folder since the delta query was last run, page by page.
+
+        A folder never queried before is primed instead, and yields no change.
+
+        :param subscription: the subscription of the folder
+        :raises ValueError: if the subscribed resource is not a folder
+        """
+        if not self.supports(subscription):
+            raise ValueError(f"no delta query for resource '{subscription.resource}'")
+        if self.store.get(subscription) is None:
+            logger.debug(f"Priming delta query of '{subscription.resource}' ...")
+            self.prime(subscription)
+            return
+
+        for page in self._pages(subscription):
+            notifications = (self.notification(subscription, i) for i in page)
+            yield [n for n in notifications if n is not None]
+
+    def changes(
+        self, subscription: O365BaseSubscription
+    ) -> typing.Iterator[O365Notification]:
+        """
+        Changes to a folder since the delta query was last run.
+
+        :param subscription: the subscription of the folder
+        :raises ValueError: if the subscribed resource is not a folder
+        """
+        for page in self.pages(subscription):
+            yield from page
+
+    def notification(
+        self, subscription: O365BaseSubscription, item: dict
+    ) -> typing.Optional[O365Notification]:
+        """Synthesize the notification of a change, unless not subscribed to."""
+        events = subscription.events
+        if "@removed" in item:
+            event = O365EventType.DELETED if O365EventType.DELETED in events else None
+        elif O365EventType.UPDATED in events:
+            event = O365EventType.UPDATED
+        else:
+            event = O365EventType.CREATED if O365EventType.CREATED in events else None
+        if event is None:
+            return None
+
+        ns = self.subscriber.namespace
+        resource_id = item.get("id", item.get("Id"))
+        url = item.get("@odata.id") or subscription.resource.build_url(
+            f"/messages/{resource_id}"
+        )
+        return O365Notification(
+            raw=item,
+            type=ns.O365NotificationType.NOTIFICATION,
+            id=None,
+            subscription_id=subscription.id,
+            subscription_expire=self.subscriber.expirations.get(
+                subscription.id, subscription.expiration
+            ),
+            sequence=None,
+            event=event,
+            resource=O365Notification.O365ResourceData(
+                type=ns.O365ResourceDataType.MESSAGE,
+                url=url,
+                etag=item.get("@odata.etag"),
+                id=resource_id,
+            ),
+            subscription=subscription,
+        )
+
+    def _pages(self, subscription: O365BaseSubscription) -> typing.Iterator[list]:
+        link = self.store.get(subscription)
+        params = None
+        if link is None:
+            link = f"{build_url(subscription.resource)}/delta"
+            params = {"$select": "id"}
+        prefer = f"odata.maxpagesize={self.page_size}"
+
+        while link is not None:
+            try:
+                response = self.subscriber.con.get(
+                    link, params=params, headers={"Prefer": prefer}
+                )
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != requests.codes.gone:
+                    raise e
+                # the delta token expired: changes since then are lost
+                logger.warning(
+                    f"Delta token of '{subscription.resource}' expired, priming anew."
+                )
+                self.prime(subscription)
+                return
+            data = response.json()
+            yield data.get("value", [])
+            delta_link = data.get("@odata.deltaLink")
+            link = data.get("@odata.nextLink")
+            self.store.set(subscription, link or delta_link)
+            params = None  # carried by the links
+
+
+class O365CatchUpHandler(O365WrappingHandler):
+    """
+    Handler catching up on changes missed while the stream was down.
+
+    Changes are read off the delta query of each subscribed folder, and handed over
+    to ``handler`` along with the live notifications. A catch-up runs in the
+    background:
+
+    * on ``catch_up``, e.g. when starting after a crash;
+    * on ``Missed`` notifications, for their subscription;
+    * when subscriptions were created anew, e.g. after a 404 renewal, as noticed
+      on the next notification or keep-alive.
+
+    Changes already delivered, live or caught up, are identified by resource id
+    and etag among the last ``capacity`` ones, and delivered once. Catching up
+    requires the Microsoft Graph protocol, see ``O365DeltaQuery``.
+    """
+
+    def __init__(
+        self,
+        handler: O365BaseNotificationsHandler,
+        *,
+        subscriber: O365Subscriber,
+        store: O365DeltaTokenStore = None,
+        capacity: int = 100000,
+    ):
+        super().__init__(handler)
+        self.subscriber = subscriber
+        self.query = O365DeltaQuery(subscriber, store=store)
+        self.filter = O365DedupFilter(capacity=capacity)
+        self._lock = threading.RLock()  # serializes deliveries to the handler
+        self._known_ids = {s.id for s in subscriber.subscriptions}
+        self._running = {}  # resource key -> catch-up thread
+
+    def _accept(self, notification: O365BaseNotification) -> bool:
+        if not isinstance(notification, O365Notification):
+            return True
+        return not self.filter.seen(_change_key(notification))
+
+    def process(self, notification: O365BaseNotification):
+        with self._lock:
+            if self._accept(notification):
+                self.handler.process(notification)
+        self._observe(notification)
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        with self._lock:
+            accepted = [n for n in notifications if self._accept(n)]
+            if accepted:
+                self.handler.process_batch(accepted)
+        for notification in notifications:
+            self._observe(notification)
+
+    def _observe(self, notification: O365BaseNotification):
+        event = getattr(notification, "event", None)
+        if event == O365EventType.MISSED:
+            subscription = self.subscriber.subscriptions.get(
+                notification.subscription_id
+            )
+            if subscription is not None:
+                logger.warning(f"Missed notifications on '{subscription.resource}'.")
+                self.catch_up([subscription])
+        elif event is not None:
+            return  # subscriptions are checked for renewals on keep-alives only
+
+        subscriptions = list(self.subscriber.subscriptions)
+        ids = {s.id for s in subscriptions}
+        if ids != self._known_ids:
+            renewed = [s for s in subscriptions if s.id not in self._known_ids]
+            self._known_ids = ids
+            if renewed:
+                self.catch_up(renewed)
+
+    def catch_up(
+        self, subscriptions: list[O365BaseSubscription] = None, *, wait: bool = False
+    ) -> list[threading.Thread]:
+        """
+        Catch up on the changes to subscribed folders, in the background.
+
+        Folders being caught up already are skipped; other resources are ignored.
+
+        :param subscriptions: the subscriptions to catch up, every one by default
+        :param wait: wait for the catch-up to complete
+        :return: the catch-up threads started
+        """
+        if subscriptions is None:
+            subscriptions = list(self.subscriber.subscriptions)
+
+        threads = []
+        for subscription in subscriptions:
+            if not self.query.supports(subscription):
+                continue
+            key = self.query.store.key(subscription)
+            with self._lock:
+                running = self._running.get(key)
+                if running is not None and running.is_alive():
+                    continue
+                thread = threading.Thread(
+                    target=self._catch_up,
+                    args=(subscription,),
+                    name="O365CatchUp",
+                    daemon=True,
+                )
+                self._running[key] = thread
+            thread.start()
+            threads.append(thread)
+        if wait:
+            for thread in threads:
+                thread.join()
+        return threads
+
+    def wait(self, timeout: float = None):
+        """Wait for running catch-ups to complete."""
+        with self._lock:
+            threads = list(self._running.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def _catch_up(self, subscription: O365BaseSubscription):
+        logger.info(f"Catching up on '{subscription.resource}' ...")
+        batch_size = max(self.handler.max_batch_size, 1)
+        count = 0
+        try:
+            # a page is delivered before the next one is read, as reading it on
+            # stores the link past the page
+            for page in self.query.pages(subscription):
+                for i in range(0, len(page), batch_size):
+                    count += self._deliver(page[i : i + batch_size])
+        except Exception:
+            logger.exception(f"Catching up on '{subscription.resource}' failed.")
+            return
+        logger.info(f"Caught up on '{subscription.resource}': {count} change(s).")
+
+    def _deliver(self, notifications: list[O365Notification]) -> int:
+        with self._lock:
+            accepted = [n for n in notifications if self._accept(n)]
+            if self.handler.max_batch_size > 1 and accepted:
+                self.handler.process_batch(accepted)
+            else:
+                for notification in accepted:
+                    self.handler.process(notification)
+        return len(accepted)
@@ -1,8 +1,11 @@
+import threading
+import typing
 from enum import Enum
 
-from O365 import Protocol
+if typing.TYPE_CHECKING:
+    from O365 import Protocol
 
-__all__ = ("O365Namespace", "O365EventType")
+__all__ = ("O365Namespace", "O365EventType", "O365KeepRaw")
 
 
 class O365Namespace:
@@ -23,15 +26,66 @@ class O365Namespace:
         EVENT = "{base}.Event"
         MESSAGE = "{base}.Message"
 
+    # namespaces are interned per protocol base, see __new__
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __new__(cls, base):
+        key = (cls, base)
+        try:
+            return cls._instances[key]
+        except KeyError:
+            pass
+        with cls._lock:
+            if key not in cls._instances:
+                namespace = super().__new__(cls)
+                namespace._build(base)
+                cls._instances[key] = namespace
+            return cls._instances[key]
+
     def __init__(self, base):
+        pass  # built once, when interned
+
+    def _build(self, base):
+        self.base = base
+        # payloads are keyed in camelCase on Microsoft Graph, PascalCase otherwise
+        self.camel_case = base == self.O365Protocol.MSGraphProtocol.value
+        self._index = {}
         attrs = (getattr(self, attr) for attr in dir(self))
         enums = (a for a in attrs if isinstance(a, type) and issubclass(a, Enum))
         for enum in enums:
+            if enum is self.O365Protocol:
+                continue
             kv = {e.name: e.value.format(base=base) for e in enum}
-            setattr(self, enum.__name__, Enum(enum.__name__, kv))
+            ns_enum = Enum(enum.__name__, kv)
+            setattr(self, enum.__name__, ns_enum)
+            self._index[enum.__name__] = {e.value: e for e in ns_enum}
+
+    def member(self, enum: str, value: str) -> Enum:
+        """
+        Look up an enum member by its value.
+
+        :param enum: the enum name, e.g. 'O365NotificationType'
+        :param value: the member value
+        :raises ValueError: if no member holds the value
+        """
+        try:
+            return self._index[enum][value]
+        except KeyError:
+            raise ValueError(f"{value!r} is not a valid {enum}") from None
+
+    def key(self, name: str) -> str:
+        """
+        A payload key, in the casing of the protocol.
+
+        :param name: the key, in PascalCase, e.g. 'ClientState'
+        """
+        if not self.camel_case or name.startswith("@"):
+            return name
+        return name[:1].lower() + name[1:]
 
     @classmethod
-    def from_protocol(cls, protocol: Protocol):
+    def from_protocol(cls, protocol: "Protocol"):
         base = cls.O365Protocol[protocol.__class__.__name__].value
         return cls(base=base)
 
@@ -49,3 +103,11 @@ class O365EventType(Enum):
     DELETED = "Deleted"
     MISSED = "Missed"
     UPDATED = "Updated"
+
+
+class O365KeepRaw(Enum):
+    """How much of the raw payload a notification keeps."""
+
+    OFF = "off"  # dropped once decoded
+    BYTES = "bytes"  # kept as json bytes, parsed on demand
+    FULL = "full"  # kept as received
@@ -0,0 +1,91 @@
+import json
+import logging
+from enum import Enum
+
+from O365_notifications.constants import O365KeepRaw
+
+__all__ = ("O365NotificationDecoder",)
+
+logger = logging.getLogger(__name__)
+
+
+class O365NotificationDecoder:
+    """
+    Registry of notification decoders keyed by the raw ``@odata.type`` string.
+
+    A raw notification is dispatched with a single dict lookup and loaded in a
+    single pass. Classes providing a ``fast_deserialize`` classmethod skip
+    marshmallow entirely; the schema remains the validating fallback whenever the
+    fast path rejects its input or when ``validate`` is set. Schema instances are
+    built on first use, so that only decoders falling back on them pay for it.
+
+    ``keep_raw`` sets what decoded notifications keep of their raw payload: the
+    payload itself, its json bytes (the stream frame when given, far smaller than
+    the dict) or nothing.
+    """
+
+    def __init__(
+        self,
+        *,
+        namespace,
+        validate: bool = False,
+        keep_raw: O365KeepRaw = O365KeepRaw.FULL,
+    ):
+        self.namespace = namespace
+        self.validate = validate
+        self.keep_raw = keep_raw
+        self._decoders = {}
+        self._schemas = {}  # notification class -> schema instance
+
+    def register(self, notification_type: Enum, cls):
+        """
+        Register the class in charge of a notification type.
+
+        :param notification_type: the notification type
+        :param cls: the notification class
+        """
+        fast = getattr(cls, "fast_deserialize", None)
+        self._decoders[notification_type.value] = (cls, fast)
+
+    def schema(self, cls):
+        """The schema instance validating notifications of a class."""
+        schema = self._schemas.get(cls)
+        if schema is None:
+            from marshmallow import EXCLUDE
+
+            schema = cls.schema(namespace=self.namespace, unknown=EXCLUDE)
+            self._schemas[cls] = schema
+        return schema
+
+    def decode(self, data: dict, *, frame: bytes = None):
+        """
+        Decode a raw notification.
+
+        :param data: the raw notification
+        :param frame: the json bytes the notification was parsed from, if any
+        :return: the notification instance
+        :raises ValueError: if the notification type is not registered
+        """
+        try:
+            cls, fast = self._decoders[data.get("@odata.type")]
+        except KeyError:
+            raise ValueError(f"unknown notification type: {data.get('@odata.type')}")
+
+        notification = None
+        if fast is not None and not self.validate:
+            try:
+                notification = fast(data, namespace=self.namespace)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.debug(f"Fast decoding failed, validating instead: {e!r}")
+        if notification is None:
+            notification = cls.deserialize(data, schema=self.schema(cls))
+
+        if self.keep_raw is O365KeepRaw.OFF:
+            notification.raw = None
+        elif self.keep_raw is O365KeepRaw.BYTES:
+            notification.raw = bytes(frame) if frame is not None else _dumps(data)
+        return notification
+
+
+def _dumps(data: dict) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode()
@@ -0,0 +1,203 @@
+import logging
+import threading
+import typing
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+from O365_notifications.notifications import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365Notification,
+    O365WrappingHandler,
+)
+from O365_notifications.constants import O365EventType
+
+__all__ = (
+    "O365DedupFilter",
+    "O365DedupHandler",
+    "O365DeliveryStats",
+    "O365SequenceTracker",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class O365DedupFilter:
+    """
+    Fixed-size memory of the most recently seen keys.
+
+    Keys are kept in a ring buffer backed by a set, so both membership tests and
+    insertions take constant time, and memory stays bounded by ``capacity``.
+    """
+
+    def __init__(self, capacity: int = 100000):
+        self.capacity = capacity
+        self._ring = deque()
+        self._keys = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def seen(self, key: typing.Hashable) -> bool:
+        """
+        Record a key.
+
+        :param key: the key to record
+        :return: whether the key was recorded already
+        """
+        if key in self._keys:
+            return True
+        if len(self._ring) >= self.capacity:
+            self._keys.discard(self._ring.popleft())
+        self._ring.append(key)
+        self._keys.add(key)
+        return False
+
+
+class O365SequenceTracker:
+    """
+    Tracks the last sequence number seen per subscription.
+
+    Only the ``capacity`` most recently notified subscriptions are tracked, so
+    subscriptions deleted or replaced over time are eventually forgotten.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self._last = OrderedDict()
+
+    def __len__(self):
+        return len(self._last)
+
+    def track(self, subscription_id: str, sequence: int) -> int:
+        """
+        Record the sequence number of a notification.
+
+        :param subscription_id: the subscription of the notification
+        :param sequence: the notification sequence number
+        :return: the number of skipped sequence numbers, or -1 if the sequence
+            number is not newer than the last one seen
+        """
+        last = self._last.get(subscription_id)
+        if last is not None:
+            self._last.move_to_end(subscription_id)
+            if sequence <= last:
+                return -1
+        elif len(self._last) >= self.capacity:
+            self._last.popitem(last=False)
+        self._last[subscription_id] = sequence
+        return 0 if last is None else sequence - last - 1
+
+    def forget(self, subscription_id: str):
+        self._last.pop(subscription_id, None)
+
+
+@dataclass
+class O365DeliveryStats:
+    delivered: int = 0
+    duplicates: int = 0
+    gaps: int = 0  # number of gaps detected
+    skipped: int = 0  # number of sequence numbers skipped over all gaps
+    missed: int = 0  # number of 'Missed' notifications
+
+
+def _change_key(notification: O365Notification) -> typing.Hashable:
+    """
+    Identify the change a notification is about, whichever its subscription.
+
+    Shared by every deduplication, so that changes match whether notified live,
+    over overlapping connections or caught up on. Deleted resources lose their etag
+    and are identified by id, while ``Missed`` notifications never match changes.
+    """
+    resource = notification.resource
+    if notification.event == O365EventType.DELETED:
+        return resource.id, O365EventType.DELETED
+    if notification.event == O365EventType.MISSED:
+        return resource.id, resource.etag, O365EventType.MISSED
+    return resource.id, resource.etag
+
+
+class O365DedupHandler(O365WrappingHandler):
+    """
+    Handler filtering out redelivered notifications and reporting lost ones.
+
+    Notifications are identified by ``key`` - by default their resource id and
+    resource etag - and those already seen among the last ``capacity``
+    ones are dropped, e.g. notifications delivered again after a stream restart.
+    Sequence numbers are tracked per subscription to detect gaps, which are
+    reported to ``on_gap`` along with ``Missed`` notifications, reported to
+    ``on_missed``. Keep-alives are passed on as they are.
+    """
+
+    def __init__(
+        self,
+        handler: O365BaseNotificationsHandler,
+        *,
+        capacity: int = 100000,
+        key: typing.Callable[[O365Notification], typing.Hashable] = _change_key,
+        on_gap: typing.Callable[[str, int, int], None] = None,
+        on_missed: typing.Callable[[O365Notification], None] = None,
+    ):
+        super().__init__(handler)
+        self.key = key
+        self.on_gap = on_gap
+        self.on_missed = on_missed
+        self.filter = O365DedupFilter(capacity=capacity)
+        self.tracker = O365SequenceTracker()
+        self.stats = O365DeliveryStats()
+        self._lock = threading.Lock()
+
+    def accept(self, notification: O365BaseNotification) -> bool:
+        """
+        Check a notification, recording it as seen.
+
+        :param notification: the notification to check
+        :return: whether the notification should be delivered
+        """
+        if not isinstance(notification, O365Notification):
+            return True
+
+        with self._lock:
+            if self.filter.seen(self.key(notification)):
+                self.stats.duplicates += 1
+                return False
+            skipped = 0  # unless synthesized, e.g. by a catch-up
+            if notification.sequence is not None:
+                skipped = self.tracker.track(
+                    notification.subscription_id, notification.sequence
+                )
+            if skipped > 0:
+                self.stats.gaps += 1
+                self.stats.skipped += skipped
+            if notification.event == O365EventType.MISSED:
+                self.stats.missed += 1
+            self.stats.delivered += 1
+
+        if skipped > 0:
+            expected = notification.sequence - skipped
+            logger.warning(
+                f"Sequence gap on subscription '{notification.subscription_id}': "
+                f"expected {expected}, received {notification.sequence}."
+            )
+            if self.on_gap:
+                self.on_gap(
+                    notification.subscription_id, expected, notification.sequence
+                )
+        if notification.event == O365EventType.MISSED:
+            subscription_id = notification.subscription_id
+            logger.warning(f"Missed notifications on subscription '{subscription_id}'.")
+            if self.on_missed:
+                self.on_missed(notification)
+        return True
+
+    def process(self, notification: O365BaseNotification):
+        if self.accept(notification):
+            self.handler.process(notification)
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        accepted = [n for n in notifications if self.accept(n)]
+        if accepted:
+            self.handler.process_batch(accepted)
@@ -0,0 +1,197 @@
+import itertools
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+
+from O365_notifications.notifications import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    _is_coroutine_handler,
+)
+
+__all__ = (
+    "O365DispatchStats",
+    "O365NotificationDispatcher",
+    "O365OverflowPolicy",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class O365OverflowPolicy(Enum):
+    BLOCK = "block"  # block the stream reader until there is room
+    DROP_KEEP_ALIVE = "drop_keep_alive"  # drop keep-alives, block otherwise
+    SPILL = "spill"  # keep accepting into an overflow buffer, block once it is full
+
+
+@dataclass
+class O365DispatchStats:
+    depths: list[int] = field(default_factory=list)  # current depth per worker
+    max_depth: int = 0
+    processed: int = 0
+    errors: int = 0
+    dropped: int = 0
+    spilled: int = 0
+    blocked: int = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(self.depths)
+
+
+class _Shard:
+    def __init__(self):
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+
+
+class O365NotificationDispatcher(O365BaseNotificationsHandler):
+    """
+    Handler decoupling the stream reader from a slow handler.
+
+    Notifications are queued and processed by a pool of worker threads, so the
+    stream keeps being read while the handler works. Notifications of the same
+    subscription always go to the same worker, which preserves their order
+    (i.e. their sequence numbers). Keep-alives go to any worker.
+
+    Usage::
+
+        with O365NotificationDispatcher(handler, workers=8) as dispatcher:
+            subscriber.start_streaming(notification_handler=dispatcher)
+    """
+
+    def __init__(
+        self,
+        handler: O365BaseNotificationsHandler,
+        *,
+        workers: int = 4,
+        max_queue_size: int = 1000,  # per worker
+        overflow: O365OverflowPolicy = O365OverflowPolicy.BLOCK,
+        max_spill_size: int = 100000,  # per worker, on top of 'max_queue_size'
+    ):
+        if workers < 1:
+            raise ValueError("at least one worker is required.")
+        if _is_coroutine_handler(handler):
+            raise TypeError("workers can't run the coroutines of the handler.")
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.max_spill_size = max_spill_size
+        self._shards = [_Shard() for _ in range(workers)]
+        self._next = itertools.count()
+        self._stats = O365DispatchStats()
+        self._stats_lock = threading.Lock()
+        self._closed = False
+        self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def start(self):
+        """Start the worker threads."""
+        if self._started:
+            return
+        self._started = True
+        for i, shard in enumerate(self._shards):
+            shard.thread = threading.Thread(
+                target=self._work, args=(shard,), name=f"O365Dispatcher-{i}"
+            )
+            shard.thread.daemon = True
+            shard.thread.start()
+
+    def close(self, *, wait: bool = True):
+        """
+        Stop accepting notifications.
+
+        :param wait: wait for the queued notifications to be processed
+        """
+        self._closed = True
+        for shard in self._shards:
+            with shard.cond:
+                if not wait:
+                    shard.items.clear()
+                shard.cond.notify_all()
+        if wait:
+            for shard in self._shards:
+                if shard.thread is not None:
+                    shard.thread.join()
+
+    def _shard_for(self, notification: O365BaseNotification) -> _Shard:
+        subscription_id = getattr(notification, "subscription_id", None)
+        if subscription_id is None:
+            index = next(self._next)
+        else:
+            index = hash(subscription_id)
+        return self._shards[index % len(self._shards)]
+
+    def receive(self, notification: O365BaseNotification):
+        self.handler.receive(notification)  # before waiting in the queues
+
+    def process(self, notification: O365BaseNotification):
+        """Queue a notification, applying the overflow policy when full."""
+        if self._closed:
+            raise RuntimeError("dispatcher is closed.")
+        self.start()
+
+        shard = self._shard_for(notification)
+        with shard.cond:
+            if len(shard.items) >= self.max_queue_size:
+                is_keep_alive = notification.type.name == "KEEP_ALIVE_NOTIFICATION"
+                limit = self.max_queue_size
+                if self.overflow is O365OverflowPolicy.SPILL:
+                    limit += self.max_spill_size
+                if len(shard.items) < limit:
+                    self._count("spilled")
+                elif self.overflow is O365OverflowPolicy.DROP_KEEP_ALIVE and (
+                    is_keep_alive
+                ):
+                    self._count("dropped")
+                    return
+                else:
+                    self._count("blocked")
+                    while len(shard.items) >= limit:
+                        shard.cond.wait()
+            shard.items.append(notification)
+            depth = len(shard.items)
+            shard.cond.notify_all()
+
+        if depth > self._stats.max_depth:
+            with self._stats_lock:
+                self._stats.max_depth = max(self._stats.max_depth, depth)
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self._stats, name, getattr(self._stats, name) + 1)
+
+    def _work(self, shard: _Shard):
+        while True:
+            with shard.cond:
+                while not shard.items and not self._closed:
+                    shard.cond.wait()
+                if not shard.items:
+                    return
+                notification = shard.items.popleft()
+                shard.cond.notify_all()
+            try:
+                self.handler.process(notification)
+            except Exception:
+                logger.exception("Notification handler failed.")
+                self._count("errors")
+            self._count("processed")
+
+    def stats(self) -> O365DispatchStats:
+        """A snapshot of the queue depths and counters."""
+        with self._stats_lock:
+            return O365DispatchStats(
+                **{
+                    **vars(self._stats),
+                    "depths": [len(shard.items) for shard in self._shards],
+                }
+            )
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+import requests
+
+__all__ = ("O365FetchStats", "O365ResourceFetcher")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class O365FetchStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0  # fetches joining a fetch already in flight
+    requests: int = 0  # http requests sent, batch or single
+
+
+class O365ResourceFetcher:
+    """
+    Fetches the resources notifications refer to, in batches.
+
+    Fetches are collected for up to ``linger`` seconds and sent together as Graph
+    ``$batch`` requests of up to ``batch_size`` resources; a single pending fetch,
+    or one outside of the Graph api, is sent as a plain GET instead. Fetching a
+    resource already in flight joins the pending fetch. Fetched resources are kept
+    in an LRU cache keyed by resource id and etag, so a cached resource is never
+    stale: any change brings a new etag. Resources notified without an etag are
+    fetched anew each time.
+
+    Resources which no longer exist are fetched as None.
+    """
+
+    _endpoints = {"batch": "$batch"}
+
+    def __init__(
+        self,
+        subscriber,
+        *,
+        cache_size: int = 1024,
+        batch_size: int = 20,  # max requests per $batch allowed by Graph
+        linger: float = 0.05,  # in seconds
+    ):
+        self.subscriber = subscriber
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.linger = linger
+        self.stats = O365FetchStats()
+        self._cache = OrderedDict()
+        self._pending = OrderedDict()  # key -> (url, future), not yet sent
+        self._in_flight = {}  # key -> future, pending or sent
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @staticmethod
+    def key(notification) -> tuple:
+        resource = notification.resource
+        return resource.id, resource.etag
+
+    def submit(self, notification) -> Future:
+        """
+        Schedule the fetch of a notification's resource.
+
+        :param notification: the notification
+        :return: a future resolving into the resource
+        """
+        key = self.key(notification)
+        with self._cond:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.stats.hits += 1
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+            if key in self._in_flight:
+                self.stats.coalesced += 1
+                return self._in_flight[key]
+
+            self.stats.misses += 1
+            future = self._in_flight[key] = Future()
+            self._pending[key] = (notification.resource.url, future)
+            self._ensure_thread()
+            self._cond.notify_all()
+        return future
+
+    def fetch(self, notification, timeout: float = None):
+        """
+        Fetch a notification's resource.
+
+        :param notification: the notification
+        :param timeout: max seconds to wait for the resource
+        :return: the resource payload
+        """
+        return self.submit(notification).result(timeout=timeout)
+
+    def fetch_many(self, notifications: list) -> list:
+        """
+        Fetch the resources of several notifications at once.
+
+        :param notifications: the notifications
+        :return: the resource payloads, in order
+        """
+        futures = [self.submit(n) for n in notifications]
+        self.flush()
+        return [f.result() for f in futures]
+
+    def flush(self):
+        """Send every pending fetch now."""
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return
+                batch = self._take()
+            self._send(batch)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="O365ResourceFetcher", daemon=True
+            )
+            self._thread.start()
+
+    def _take(self) -> list:
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            key, (url, future) = self._pending.popitem(last=False)
+            batch.append((key, url, future))
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.linger
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._pending:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take()
+            if batch:
+                self._send(batch)
+
+    def _absolute_url(self, url: str) -> str:
+        if url.startswith(("http://", "https://")):
+            return url
+        return f"{self.subscriber.protocol.service_url}{url.lstrip('/')}"
+
+    def _relative_url(self, url: str):
+        """The url relative to the Graph api root, if the url belongs to it."""
+        service_url = self.subscriber.protocol.service_url
+        url = self._absolute_url(url)
+        if "graph.microsoft.com" not in service_url or not url.startswith(service_url):
+            return None
+        return url[len(service_url) - 1 :]
+
+    def _send(self, batch: list):
+        singles, batchable = [], []
+        for key, url, future in batch:
+            relative_url = self._relative_url(url)
+            if relative_url is None:
+                singles.append((key, url, future))
+            else:
+                batchable.append((key, url, relative_url, future))
+        if len(batchable) == 1:
+            key, url, _, future = batchable.pop()
+            singles.append((key, url, future))
+
+        for key, url, future in singles:
+            self._count_request()
+            try:
+                response = self.subscriber.con.get(self._absolute_url(url))
+            except requests.exceptions.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    self._resolve(key, future, None)
+                else:
+                    self._fail(key, future, e)
+            except Exception as e:
+                self._fail(key, future, e)
+            else:
+                self._resolve(key, future, response.json())
+
+        if batchable:
+            self._send_batch(batchable)
+
+    def _send_batch(self, batch: list):
+        service_url = self.subscriber.protocol.service_url
+        body = {
+            "requests": [
+                {"id": str(i), "method": "GET", "url": relative_url}
+                for i, (_, _, relative_url, _) in enumerate(batch)
+            ]
+        }
+        self._count_request()
+        try:
+            response = self.subscriber.con.post(
+                f"{service_url}{self._endpoints['batch']}", body
+            )
+            responses = {r["id"]: r for r in response.json().get("responses", [])}
+        except Exception as e:
+            for key, _, _, future in batch:
+                self._fail(key, future, e)
+            return
+
+        for i, (key, url, _, future) in enumerate(batch):
+            result = responses.get(str(i), {})
+            status = result.get("status")
+            if status is not None and 200 <= status < 300:
+                self._resolve(key, future, result.get("body"))
+            elif status == 404:
+                self._resolve(key, future, None)
+            else:
+                error = RuntimeError(f"fetching '{url}' failed with status {status}")
+                self._fail(key, future, error)
+
+    def _count_request(self):
+        with self._cond:  # batches are sent by 'flush' callers too
+            self.stats.requests += 1
+
+    def _resolve(self, key, future: Future, resource):
+        with self._cond:
+            self._in_flight.pop(key, None)
+            if resource is not None and key[1] is not None:
+                self._cache[key] = resource
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        future.set_result(resource)
+
+    def _fail(self, key, future: Future, error: Exception):
+        logger.warning(f"Failed fetching resource '{key[0]}': {error}")
+        with self._cond:
+            self._in_flight.pop(key, None)
+        future.set_exception(error)
@@ -0,0 +1,470 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import typing
+import zlib
+from collections import deque
+
+from O365_notifications.constants import O365KeepRaw
+from O365_notifications.notifications import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365Notification,
+    O365WrappingHandler,
+)
+
+if typing.TYPE_CHECKING:
+    from O365_notifications.base import O365Subscriber
+
+__all__ = ("O365Journal", "O365JournalHandler")
+
+logger = logging.getLogger(__name__)
+
+# entry header: payload length and crc32
+_HEADER = struct.Struct("<II")
+_OFFSETS_FILE = "offsets.json"
+
+
+class _Segment:
+    """A log file holding consecutive entries, starting at offset ``first``."""
+
+    def __init__(self, path: str, first: int):
+        self.path = path
+        self.first = first
+        self.count = 0
+        self.size = 0  # bytes in use
+        self.map = None  # writable memory map, while active
+
+    @property
+    def end(self) -> int:
+        """The offset following the last entry."""
+        return self.first + self.count
+
+    def entries(self, buffer) -> typing.Iterator[tuple[int, int]]:
+        """Scan the (start, length) of the payloads, up to a torn or empty entry."""
+        pos = 0
+        while pos + _HEADER.size <= len(buffer):
+            length, crc = _HEADER.unpack_from(buffer, pos)
+            start = pos + _HEADER.size
+            if length == 0 or start + length > len(buffer):
+                return
+            if zlib.crc32(buffer[start : start + length]) != crc:
+                return
+            yield start, length
+            pos = start + length
+
+    def recover(self):
+        """Count the entries found on disk."""
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for start, length in self.entries(data):
+            self.count += 1
+            self.size = start + length
+
+    def open(self, capacity: int):
+        with open(self.path, "r+b") as f:
+            if os.fstat(f.fileno()).st_size < capacity:
+                f.truncate(capacity)  # preallocate
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.map[self.size :] = bytes(len(self.map) - self.size)  # torn tail
+
+    def seal(self):
+        """Flush and release the memory map, trimming the file to its entries."""
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        os.truncate(self.path, self.size)
+
+    def read(self) -> typing.Iterator[tuple[int, bytes]]:
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for i, (start, length) in enumerate(self.entries(buffer)):
+                    if i >= self.count:
+                        return  # appended after the read started
+                    yield self.first + i, buffer[start : start + length]
+
+
+class O365Journal:
+    """
+    Durable append-only log of raw notifications.
+
+    Entries are appended to memory-mapped segment files, each entry getting a
+    sequential offset. Consumers commit the offset up to which they processed
+    entries, so the uncommitted ones can be read again after a restart.
+
+    Appends are made durable in batches: segments are synced once ``sync_every``
+    entries are pending, or when ``sync_interval`` seconds have elapsed since the
+    last sync; committed offsets are persisted along. A crash may therefore lose
+    the entries of the last interval, which ``sync_interval=0`` prevents at the
+    cost of a sync per append.
+
+    Segments are rotated once they reach ``segment_size`` bytes. Rotated segments
+    are deleted when every consumer committed their entries, or when the journal
+    exceeds ``max_bytes`` or they are older than ``max_age`` seconds, in which
+    case their uncommitted entries are lost.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        segment_size: int = 64 * 1024 * 1024,  # in bytes
+        max_bytes: int = None,  # total budget, in bytes
+        max_age: float = None,  # in seconds
+        sync_every: int = 256,  # in entries
+        sync_interval: float = 0.05,  # in seconds
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._segments = deque()
+        self._offsets = {}
+        self._offsets_dirty = False
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.RLock()
+        self._closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def first(self) -> int:
+        """The offset of the oldest entry kept."""
+        return self._segments[0].first
+
+    @property
+    def end(self) -> int:
+        """The offset the next entry is appended at."""
+        return self._segments[-1].end
+
+    def _path(self, first: int) -> str:
+        return os.path.join(self.directory, f"{first:020d}.log")
+
+    def _load(self):
+        path = os.path.join(self.directory, _OFFSETS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                self._offsets = json.load(f)
+
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".log"))
+        for name in names:
+            segment = _Segment(os.path.join(self.directory, name), int(name[:-4]))
+            segment.recover()
+            self._segments.append(segment)
+        if self._segments:
+            self._segments[-1].open(self.segment_size)
+        else:
+            self._new_segment(first=0)
+        self.compact()
+
+    def _new_segment(self, *, first: int, capacity: int = None):
+        segment = _Segment(self._path(first), first)
+        open(segment.path, "wb").close()
+        segment.open(max(capacity or 0, self.segment_size))
+        self._sync_directory()
+        self._segments.append(segment)
+        return segment
+
+    def _sync_directory(self):
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def append(self, frame: bytes) -> int:
+        """
+        Append an entry.
+
+        :param frame: the raw notification
+        :return: the entry offset
+        """
+        if not frame:
+            raise ValueError("cannot journal an empty frame.")
+        entry_size = _HEADER.size + len(frame)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("journal is closed.")
+            segment = self._segments[-1]
+            if segment.size + entry_size > len(segment.map):
+                if segment.count:
+                    segment.seal()
+                    segment = self._new_segment(first=segment.end, capacity=entry_size)
+                    self.compact()
+                else:  # entry larger than a segment
+                    segment.map.close()
+                    segment.open(entry_size)
+
+            _HEADER.pack_into(segment.map, segment.size, len(frame), zlib.crc32(frame))
+            start = segment.size + _HEADER.size
+            segment.map[start : start + len(frame)] = frame
+            segment.size += entry_size
+            segment.count += 1
+
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self.sync()
+            else:
+                self.sync_pending()
+            return segment.end - 1
+
+    def sync_pending(self):
+        """Sync if the sync interval elapsed while changes are pending."""
+        with self._lock:
+            if not (self._unsynced or self._offsets_dirty):
+                return
+            if time.monotonic() - self._last_sync >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        """Make the appended entries and the committed offsets durable."""
+        with self._lock:
+            if self._unsynced:
+                self._segments[-1].map.flush()
+                self._unsynced = 0
+            if self._offsets_dirty:
+                path = os.path.join(self.directory, _OFFSETS_FILE)
+                with open(f"{path}.tmp", "w") as f:
+                    json.dump(self._offsets, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(f"{path}.tmp", path)
+                self._offsets_dirty = False
+            self._last_sync = time.monotonic()
+
+    def commit(self, name: str, offset: int):
+        """
+        Record the entries before an offset as processed by a consumer.
+
+        :param name: the consumer name
+        :param offset: the offset following the last processed entry
+        """
+        with self._lock:
+            if offset > self._offsets.get(name, 0):
+                self._offsets[name] = offset
+                self._offsets_dirty = True
+                self.sync_pending()
+
+    def committed(self, name: str) -> int:
+        """The offset following the last entry processed by a consumer."""
+        with self._lock:
+            return self._offsets.get(name, 0)
+
+    def read(self, start: int = 0) -> typing.Iterator[tuple[int, bytes]]:
+        """
+        Read the entries from an offset on.
+
+        :param start: the offset of the first entry read
+        :return: the entries offset and raw notification
+        """
+        with self._lock:
+            self.sync()
+            segments = [s for s in self._segments if s.end > start]
+        if start < self.first:
+            logger.warning(f"Journal entries {start} to {self.first} were deleted.")
+        for segment in segments:
+            if segment.map is not None:  # active: snapshot its entries
+                with self._lock:
+                    buffer = bytes(segment.map[: segment.size])
+                    first = segment.first
+                entries = (
+                    (first + i, buffer[s : s + n])
+                    for i, (s, n) in enumerate(segment.entries(buffer))
+                )
+            else:
+                entries = segment.read()
+            for offset, frame in entries:
+                if offset >= start:
+                    yield offset, frame
+
+    def compact(self):
+        """Delete the rotated segments no longer needed."""
+        with self._lock:
+            committed = min(self._offsets.values(), default=0)
+            total = sum(s.size for s in self._segments)
+            now = time.time()
+            while len(self._segments) > 1:
+                segment = self._segments[0]
+                consumed = self._offsets and segment.end <= committed
+                over_budget = self.max_bytes is not None and total > self.max_bytes
+                expired = (
+                    self.max_age is not None
+                    and now - os.path.getmtime(segment.path) > self.max_age
+                )
+                if not (consumed or over_budget or expired):
+                    break
+                if not consumed:
+                    logger.warning(
+                        f"Dropping uncommitted journal entries up to {segment.end}."
+                    )
+                os.remove(segment.path)
+                total -= segment.size
+                self._segments.popleft()
+
+    def close(self):
+        """Sync and release the journal."""
+        with self._lock:
+            if self._closed:
+                return
+            self.sync()
+            self._segments[-1].map.close()
+            self._segments[-1].map = None
+            self._closed = True
+
+
+class O365JournalHandler(O365WrappingHandler):
+    """
+    Handler journaling notifications before handing them over.
+
+    Every notification is appended to the journal as it is received, before it
+    waits in batches or in the queues of a
+    :class:`~O365_notifications.dispatch.O365NotificationDispatcher`, and committed
+    once processed. The journal handler must therefore be the outermost one, or
+    sit right behind the dispatcher; nested in another wrapping handler, it only
+    journals notifications as they are processed. Upon restart, ``replay`` hands
+    the notifications left uncommitted over to the handler again, before
+    streaming resumes. Notifications may then be processed twice, which
+    :class:`~O365_notifications.dedup.O365DedupHandler` can filter out.
+
+    Commits happen as the wrapped handler returns; with concurrent callers, the
+    committed offset only moves past entries whose predecessors are all done.
+    Notifications the handler fails on are committed as well, so that they don't
+    hold the journal back, and are appended to the ``dead_letters`` journal, if
+    any. The subscriber must keep the raw payload of notifications.
+
+    Usage::
+
+        with O365Journal("/var/lib/notifications") as journal:
+            handler = O365JournalHandler(handler, journal, subscriber=subscriber)
+            handler.replay()
+            subscriber.start_streaming(notification_handler=handler)
+    """
+
+    def __init__(
+        self,
+        handler: O365BaseNotificationsHandler,
+        journal: O365Journal,
+        *,
+        subscriber: "O365Subscriber",
+        name: str = "default",
+        dead_letters: O365Journal = None,
+    ):
+        if subscriber.decoder.keep_raw is O365KeepRaw.OFF:
+            raise ValueError("journaling requires notifications keeping raw payloads.")
+        super().__init__(handler)
+        self.journal = journal
+        self.subscriber = subscriber
+        self.name = name
+        self.dead_letters = dead_letters
+        self._in_flight = deque()  # journaled, in order
+        self._done = set()
+        self._received = {}  # offsets of the received notifications, by id
+        self._lock = threading.Lock()
+
+    def replay(self) -> int:
+        """
+        Hand the uncommitted notifications over to the handler.
+
+        :return: the number of notifications replayed
+        """
+        replayed = 0
+        for offset, frame in self.journal.read(self.journal.committed(self.name)):
+            notification = self.subscriber.notification_factory(
+                json.loads(frame), frame=frame
+            )
+            try:
+                self.handler.process(notification)
+            except Exception:
+                self._dead_letter([notification], [offset])
+                raise
+            finally:
+                self.journal.commit(self.name, offset + 1)
+            replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} journaled notification(s).")
+        return replayed
+
+    @staticmethod
+    def _frame(notification: O365Notification) -> bytes:
+        frame = notification.raw
+        if not isinstance(frame, (bytes, bytearray)):
+            frame = json.dumps(frame, separators=(",", ":")).encode()
+        return frame
+
+    def _append(self, notification: O365Notification) -> int:
+        frame = self._frame(notification)
+        with self._lock:
+            offset = self.journal.append(frame)
+            self._in_flight.append(offset)
+        return offset
+
+    def _offset(self, notification: O365Notification) -> int:
+        with self._lock:
+            offset = self._received.pop(id(notification), None)
+        if offset is None:  # not received through 'receive'
+            offset = self._append(notification)
+        return offset
+
+    def _ack(self, offsets: list[int]):
+        with self._lock:
+            self._done.update(offsets)
+            committed = None
+            while self._in_flight and self._in_flight[0] in self._done:
+                self._done.discard(committed := self._in_flight.popleft())
+            if committed is not None:
+                self.journal.commit(self.name, committed + 1)
+
+    def _dead_letter(self, notifications: list[O365Notification], offsets: list[int]):
+        logger.error(f"Failed processing journal entries {offsets}, skipped.")
+        if self.dead_letters is not None:
+            for notification in notifications:
+                self.dead_letters.append(self._frame(notification))
+
+    def receive(self, notification: O365BaseNotification):
+        if isinstance(notification, O365Notification):
+            offset = self._append(notification)
+            with self._lock:
+                self._received[id(notification)] = offset
+
+    def process(self, notification: O365BaseNotification):
+        if not isinstance(notification, O365Notification):
+            self.journal.sync_pending()  # idle stream: sync the last appends
+            self.handler.process(notification)
+            return
+        offset = self._offset(notification)
+        try:
+            self.handler.process(notification)
+        except Exception:
+            self._dead_letter([notification], [offset])
+            raise
+        finally:
+            self._ack([offset])
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        journaled = [n for n in notifications if isinstance(n, O365Notification)]
+        offsets = [self._offset(n) for n in journaled]
+        self.journal.sync_pending()
+        try:
+            self.handler.process_batch(notifications)
+        except Exception:
+            self._dead_letter(journaled, offsets)
+            raise
+        finally:
+            self._ack(offsets)
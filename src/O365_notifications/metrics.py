@@ -0,0 +1,298 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ("O365Instrumentation", "O365Metrics", "O365PrometheusExporter")
+
+logger = logging.getLogger(__name__)
+
+
+class O365Instrumentation:
+    """
+    Callbacks observing subscribers at work; override the ones of interest.
+
+    Subscribers call these hooks only when given an instrumentation, so there is
+    no cost otherwise. Hooks may be called from several threads at once.
+    """
+
+    def bytes_read(self, size: int):
+        """Bytes read off a notification stream."""
+
+    def notification_decoded(self, notification_type: str, seconds: float):
+        """A notification was decoded, given its type name."""
+
+    def notifications_handled(self, count: int, seconds: float):
+        """A handler processed one or a batch of notifications."""
+
+    def keep_alive(self, interval: float):
+        """A keep-alive arrived, ``interval`` s after the previous one on its stream."""
+
+    def reconnected(self):
+        """A notification stream was opened anew."""
+
+    def not_found_renewal(self):
+        """Subscriptions were renewed after the stream answered 404."""
+
+    def error_suppressed(self, error: Exception):
+        """A stream error was suppressed and the stream restarted."""
+
+    def request_completed(self, operation: str, seconds: float):
+        """A subscription request (subscribe, renew, unsubscribe) completed."""
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+_LATENCY_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+_INTERVAL_BUCKETS = (1.0, 2.0, 5.0, 10.0, 15.0, 30.0, 60.0, 120.0, 300.0)
+_REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class O365Metrics(O365Instrumentation):
+    """
+    Instrumentation keeping counters and histograms, rendered in the Prometheus
+    text exposition format.
+    """
+
+    _metrics = {
+        # name: (type, help, label, buckets)
+        "o365_stream_bytes_read_total": (
+            "counter",
+            "Bytes read off notification streams.",
+            None,
+            None,
+        ),
+        "o365_notifications_decoded_total": (
+            "counter",
+            "Notifications decoded, per type.",
+            "type",
+            None,
+        ),
+        "o365_decode_seconds": (
+            "histogram",
+            "Time spent decoding a notification.",
+            None,
+            _LATENCY_BUCKETS,
+        ),
+        "o365_handler_seconds": (
+            "histogram",
+            "Time spent by handlers per notification or batch.",
+            None,
+            _LATENCY_BUCKETS,
+        ),
+        "o365_notifications_handled_total": (
+            "counter",
+            "Notifications processed by handlers.",
+            None,
+            None,
+        ),
+        "o365_keep_alive_interval_seconds": (
+            "histogram",
+            "Time between consecutive keep-alives.",
+            None,
+            _INTERVAL_BUCKETS,
+        ),
+        "o365_stream_reconnects_total": (
+            "counter",
+            "Notification streams opened anew.",
+            None,
+            None,
+        ),
+        "o365_stream_not_found_renewals_total": (
+            "counter",
+            "Subscription renewals triggered by a 404 stream response.",
+            None,
+            None,
+        ),
+        "o365_stream_errors_suppressed_total": (
+            "counter",
+            "Stream errors suppressed by restarting the stream, per error.",
+            "error",
+            None,
+        ),
+        "o365_request_seconds": (
+            "histogram",
+            "Round-trip time of subscription requests, per operation.",
+            "operation",
+            _REQUEST_BUCKETS,
+        ),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {name: {} for name in self._metrics}  # name -> label -> value
+
+    def _inc(self, name: str, label: str = None, value: float = 1):
+        with self._lock:
+            values = self._values[name]
+            values[label] = values.get(label, 0) + value
+
+    def _observe(self, name: str, value: float, label: str = None):
+        with self._lock:
+            values = self._values[name]
+            if label not in values:
+                values[label] = _Histogram(self._metrics[name][3])
+            values[label].observe(value)
+
+    def bytes_read(self, size: int):
+        self._inc("o365_stream_bytes_read_total", value=size)
+
+    def notification_decoded(self, notification_type: str, seconds: float):
+        self._inc("o365_notifications_decoded_total", notification_type)
+        self._observe("o365_decode_seconds", seconds)
+
+    def notifications_handled(self, count: int, seconds: float):
+        self._inc("o365_notifications_handled_total", value=count)
+        self._observe("o365_handler_seconds", seconds)
+
+    def keep_alive(self, interval: float):
+        self._observe("o365_keep_alive_interval_seconds", interval)
+
+    def reconnected(self):
+        self._inc("o365_stream_reconnects_total")
+
+    def not_found_renewal(self):
+        self._inc("o365_stream_not_found_renewals_total")
+
+    def error_suppressed(self, error: Exception):
+        self._inc("o365_stream_errors_suppressed_total", type(error).__name__)
+
+    def request_completed(self, operation: str, seconds: float):
+        self._observe("o365_request_seconds", seconds, operation)
+
+    def value(self, name: str, label: str = None):
+        """The current value of a counter, or histogram (count, sum)."""
+        with self._lock:
+            value = self._values[name].get(label)
+            if isinstance(value, _Histogram):
+                return sum(value.counts), value.sum
+            return value or 0
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, label_name, _) in self._metrics.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                values = self._values[name]
+                if not values and label_name is None and kind == "counter":
+                    lines.append(f"{name} 0")
+                for label, value in sorted(values.items(), key=lambda kv: kv[0] or ""):
+                    labels = {} if label is None else {label_name: label}
+                    if kind == "counter":
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                        continue
+                    cumulative = 0
+                    bounds = [*map(_number, value.buckets), "+Inf"]
+                    for bound, count in zip(bounds, value.counts):
+                        cumulative += count
+                        bucket_labels = _labels({**labels, "le": bound})
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(value.sum)}")
+                    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class O365PrometheusExporter:
+    """
+    Serves metrics to Prometheus scrapes.
+
+    Either embed it as a WSGI application, or have it serve on its own::
+
+        metrics = O365Metrics()
+        subscriber = O365StreamingSubscriber(parent=account, instrumentation=metrics)
+        O365PrometheusExporter(metrics).start(port=9464)
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, metrics: O365Metrics):
+        self.metrics = metrics
+        self._server = None
+
+    def __call__(self, environ, start_response):
+        """The WSGI application."""
+        content = self.metrics.render().encode()
+        start_response(
+            "200 OK",
+            [
+                ("Content-Type", self.content_type),
+                ("Content-Length", str(len(content))),
+            ],
+        )
+        return [content]
+
+    def start(self, *, port: int, host: str = ""):
+        """
+        Serve the metrics on every path, in a background thread.
+
+        :param port: the port to listen on, 0 for any free port
+        :param host: the address to listen on, every one by default
+        :return: the address served
+        """
+        exporter = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = exporter.metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(
+            target=self._server.serve_forever, name="O365PrometheusExporter"
+        )
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address
+
+    def stop(self):
+        """Stop serving the metrics."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,309 @@
+"""
+Notification records and handlers.
+
+This module, along with ``constants`` and ``decoders``, makes the core of the
+package: it imports neither ``O365`` nor ``marshmallow``, so that processes only
+decoding and handling notifications, e.g. push-handling workers, start fast. The
+validating schemas of the records are built on first use.
+"""
+
+import datetime
+import functools
+import inspect
+import logging
+import sys
+import time
+import typing
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.utils import (
+    DeserializerMixin,
+    lazy_schema,
+    parse_datetime,
+    slotted,
+)
+
+if typing.TYPE_CHECKING:
+    from O365_notifications.base import O365BaseSubscription
+
+__all__ = (
+    "O365BaseNotification",
+    "O365BaseNotificationsHandler",
+    "O365KeepAliveNotification",
+    "O365Notification",
+    "O365NotificationBatcher",
+    "O365NotificationHandler",
+    "O365WrappingHandler",
+)
+
+logger = logging.getLogger(__name__)
+
+# subscriptions expire on a handful of distinct instants, shared by notifications
+_parse_expiration = functools.lru_cache(maxsize=256)(parse_datetime)
+
+
+@slotted
+@dataclass
+class O365BaseNotification(DeserializerMixin, ABC):
+    type: O365Namespace.O365NotificationType
+
+    @lazy_schema
+    def schema():
+        from marshmallow import fields, post_load
+
+        class BaseO365NotificationSchema(DeserializerMixin.schema):
+            type = fields.Str(data_key="@odata.type")
+
+            def __init__(self, **kwargs):
+                self.namespace = kwargs.pop("namespace", None)
+                super().__init__(**kwargs)
+
+            @post_load
+            def convert_types(self, data, **_):
+                data["type"] = self.namespace.O365NotificationType(data["type"])
+                return data
+
+        return BaseO365NotificationSchema
+
+
+@slotted
+@dataclass
+class O365Notification(O365BaseNotification):
+    id: str
+    subscription_id: str
+    subscription_expire: datetime
+    sequence: int  # None for notifications without sequence, e.g. on Graph
+    event: O365EventType
+
+    @slotted
+    @dataclass
+    class O365ResourceData:
+        type: O365Namespace.O365ResourceDataType
+        url: str
+        etag: str
+        id: str
+
+    resource: O365ResourceData
+    subscription: "O365BaseSubscription" = field(
+        default=None, compare=False, repr=False
+    )  # linked by the subscriber
+
+    @lazy_schema
+    def schema():
+        from marshmallow import Schema, fields, post_load
+
+        class O365NotificationSchema(O365BaseNotification.schema):
+            id = fields.Str(data_key="Id", allow_none=True, load_default=None)
+            subscription_id = fields.Str(data_key="SubscriptionId")
+            subscription_expire = fields.DateTime(
+                data_key="SubscriptionExpirationDateTime"
+            )
+            sequence = fields.Int(
+                data_key="SequenceNumber", allow_none=True, load_default=None
+            )
+            event = fields.Str(data_key="ChangeType")
+            resource = fields.Nested(
+                Schema.from_dict(
+                    {
+                        "type": fields.Str(data_key="@odata.type"),
+                        "url": fields.Url(data_key="@odata.id"),
+                        "etag": fields.Str(data_key="@odata.etag"),
+                        "id": fields.Str(data_key="Id"),
+                    }
+                ),
+                data_key="ResourceData",
+            )
+
+            @post_load
+            def convert_types(self, data, **_):
+                ns = self.namespace
+                resource = data["resource"]
+                data["type"] = ns.O365NotificationType.NOTIFICATION
+                data["subscription_id"] = sys.intern(data["subscription_id"])
+                data["event"] = O365EventType(data["event"])
+                resource["type"] = ns.O365ResourceDataType(resource["type"])
+                data["resource"] = O365Notification.O365ResourceData(**resource)
+                return data
+
+        return O365NotificationSchema
+
+    @classmethod
+    def fast_deserialize(cls, data: dict, *, namespace: O365Namespace):
+        """Build a notification from trusted data, bypassing the schema."""
+        resource = data["ResourceData"]
+        sequence = data.get("SequenceNumber")
+        return cls(
+            raw=data,
+            type=namespace.O365NotificationType.NOTIFICATION,
+            id=data.get("Id"),
+            subscription_id=sys.intern(data["SubscriptionId"]),
+            subscription_expire=_parse_expiration(
+                data["SubscriptionExpirationDateTime"]
+            ),
+            sequence=None if sequence is None else int(sequence),
+            event=O365EventType(data["ChangeType"]),
+            resource=cls.O365ResourceData(
+                type=namespace.member("O365ResourceDataType", resource["@odata.type"]),
+                url=resource["@odata.id"],
+                etag=resource["@odata.etag"],
+                id=resource["Id"],
+            ),
+        )
+
+
+class O365KeepAliveNotification(O365BaseNotification):
+    __slots__ = ()
+    status: str
+
+    @lazy_schema
+    def schema():
+        from marshmallow import fields
+
+        class O365KeepAliveNotificationSchema(O365BaseNotification.schema):
+            status = fields.Str(data_key="Status")
+
+        return O365KeepAliveNotificationSchema
+
+    @classmethod
+    def fast_deserialize(cls, data: dict, *, namespace):
+        """Build a keep-alive notification from trusted data."""
+        return cls(
+            raw=data, type=namespace.O365NotificationType.KEEP_ALIVE_NOTIFICATION
+        )
+
+
+class O365BaseNotificationsHandler(ABC):
+    max_batch_size = 1  # notifications grouped per 'process_batch' call
+    max_batch_linger = 0.0  # seconds a batch waits to be filled
+    batch_keep_alives = False  # keep-alives are sent to 'process' otherwise
+
+    @abstractmethod
+    def process(self, notification: O365BaseNotification):
+        pass
+
+    def receive(self, notification: O365BaseNotification):
+        """
+        Take note of a notification as soon as it is received.
+
+        Called before the notification waits in a batch, ahead of ``process`` or
+        ``process_batch``. Wrapping handlers don't pass it on.
+
+        :param notification: the received notification
+        """
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        """
+        Process a group of notifications at once.
+
+        Only called when ``max_batch_size`` is greater than 1. Override it to handle
+        bursts of notifications with a single bulk operation.
+
+        :param notifications: the notifications, in order of arrival
+        """
+        for notification in notifications:
+            self.process(notification)
+
+
+class O365NotificationHandler(O365BaseNotificationsHandler):
+    def process(self, notification: O365BaseNotification):
+        logger.debug(notification)
+
+
+def _is_coroutine_handler(handler: O365BaseNotificationsHandler) -> bool:
+    """Whether a handler processes notifications in coroutines, see ``aio``."""
+    return inspect.iscoroutinefunction(handler.process) or inspect.iscoroutinefunction(
+        handler.process_batch
+    )
+
+
+class O365WrappingHandler(O365BaseNotificationsHandler):
+    """
+    Base of the handlers handing notifications over to another handler.
+
+    Notifications are batched as the wrapped handler asks for, and passed on as
+    they are unless ``process`` or ``process_batch`` are overridden.
+    """
+
+    def __init__(self, handler: O365BaseNotificationsHandler):
+        """
+        :param handler: the wrapped handler
+        :raises TypeError: if the handler processes notifications in coroutines
+        """
+        if _is_coroutine_handler(handler):
+            raise TypeError(
+                f"'{type(self).__name__}' can't hand notifications over to "
+                "coroutines, only 'O365AsyncStreamingSubscriber' can."
+            )
+        self.handler = handler
+
+    @property
+    def max_batch_size(self):
+        return self.handler.max_batch_size
+
+    @property
+    def max_batch_linger(self):
+        return self.handler.max_batch_linger
+
+    @property
+    def batch_keep_alives(self):
+        return self.handler.batch_keep_alives
+
+    def process(self, notification: O365BaseNotification):
+        self.handler.process(notification)
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        self.handler.process_batch(notifications)
+
+
+class O365NotificationBatcher:
+    """
+    Groups notifications into batches for a handler's ``process_batch``.
+
+    A batch is released when it reaches the handler's ``max_batch_size`` or when its
+    oldest notification waited ``max_batch_linger`` seconds. Lingering batches are
+    released by ``poll``, which the streaming loop calls whenever data arrives, i.e.
+    at least once every keep-alive interval. Each released item is either a single
+    notification, for ``process``, or a list of notifications, for ``process_batch``.
+    """
+
+    def __init__(self, handler: O365BaseNotificationsHandler, clock=time.monotonic):
+        self.handler = handler
+        self.clock = clock
+        self.batching = handler.max_batch_size > 1
+        self._batch = []
+        self._since = None
+
+    def add(self, notification: O365BaseNotification) -> list:
+        self.handler.receive(notification)
+        if not self.batching:
+            return [notification]
+
+        is_keep_alive = notification.type.name == "KEEP_ALIVE_NOTIFICATION"
+        if is_keep_alive and not self.handler.batch_keep_alives:
+            return [notification]
+
+        if not self._batch:
+            self._since = self.clock()
+        self._batch.append(notification)
+        if len(self._batch) >= self.handler.max_batch_size:
+            return self.flush()
+        return []
+
+    def remaining(self) -> typing.Optional[float]:
+        """Seconds left before the pending batch is due, None without one."""
+        if not self._batch:
+            return None
+        return self._since + self.handler.max_batch_linger - self.clock()
+
+    def poll(self) -> list:
+        if self._batch and self.clock() - self._since >= self.handler.max_batch_linger:
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        if not self._batch:
+            return []
+        batch, self._batch = self._batch, []
+        return [batch]
@@ -0,0 +1,400 @@
+import logging
+import threading
+import time
+import typing
+from collections import Counter
+from dataclasses import dataclass
+
+from O365_notifications.base import _require_synchronous
+from O365_notifications.dedup import O365DedupFilter
+from O365_notifications.notifications import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365NotificationHandler,
+    O365WrappingHandler,
+)
+from O365_notifications.streaming import (
+    O365StreamingSubscriber,
+    O365StreamingSubscription,
+    O365StreamStats,
+    _is_duplicate,
+)
+
+__all__ = ("O365StreamLoad", "O365StreamPlan", "O365StreamPlanner")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class O365StreamPlan:
+    """A planned GetNotifications connection."""
+
+    subscriptions: list[O365StreamingSubscription]
+    keep_alive_interval: int  # in seconds
+    connection_timeout: int  # in minutes
+    dedicated: bool = False  # to a hot subscription
+
+    def key(self) -> tuple:
+        # subscriptions are updated in place on renewals, hence compared by identity
+        return (
+            frozenset(map(id, self.subscriptions)),
+            self.keep_alive_interval,
+            self.connection_timeout,
+        )
+
+
+@dataclass
+class O365StreamLoad:
+    """Load of a planned stream, over the current planning window."""
+
+    subscriptions: list[str]  # ids
+    dedicated: bool
+    keep_alive_interval: int  # in seconds
+    connection_timeout: int  # in minutes
+    notifications: int
+    rate: float  # notifications per second
+    idle: float  # mean seconds between notifications
+    connections: int
+    errors: int
+
+
+class _Lane(O365WrappingHandler):
+    """A running planned stream, counting the notifications it hands over."""
+
+    def __init__(
+        self,
+        plan: O365StreamPlan,
+        handler,
+        lock: threading.Lock,
+        seen: O365DedupFilter,
+    ):
+        self.plan = plan
+        super().__init__(handler)
+        self.lock = lock  # handlers are handed over a stream at a time
+        self.seen = seen  # shared by the lanes, overlapping while re-planned
+        self.counts = Counter()  # notifications per subscription id, in the window
+        self.stats = O365StreamStats()
+        self.errors_before = 0  # errors before the window
+        self.stop = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def _fresh(self, notification: O365BaseNotification) -> bool:
+        """Count a notification, unless handed over by another lane already."""
+        if _is_duplicate(self.seen, notification):
+            return False
+        subscription_id = getattr(notification, "subscription_id", None)
+        if subscription_id is not None:
+            self.counts[subscription_id] += 1
+        return True
+
+    def process(self, notification: O365BaseNotification):
+        with self.lock:
+            if self._fresh(notification):
+                self.handler.process(notification)
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        with self.lock:
+            notifications = [n for n in notifications if self._fresh(n)]
+            if notifications:
+                self.handler.process_batch(notifications)
+
+    @property
+    def errors(self) -> int:
+        return self.stats.errors - self.errors_before
+
+
+def _ladder(value: float, low: int, high: int) -> int:
+    """The greatest of low, 2 * low, 4 * low ... not above value, within bounds."""
+    if value >= high:
+        return high
+    step = low
+    while step * 2 <= value:
+        step *= 2
+    return step
+
+
+class O365StreamPlanner:
+    """
+    Splits the subscriptions of a streaming subscriber across concurrent
+    GetNotifications connections, by the rate of notifications observed on them.
+
+    Subscriptions notified about at ``hot_rate`` or more get a stream of their own,
+    within ``max_streams`` streams, and the others share one. Every stream is tuned
+    from what was measured on its subscriptions over the last ``window`` seconds:
+
+    - the keep-alive interval follows the mean idle time between notifications, so
+      that idle streams get sparse keep-alives, and is divided by the errors, for
+      dead connections to be detected sooner;
+    - the connection timeout is halved per error, for connections to be renewed
+      by handoffs before they break.
+
+    Both are picked from a ladder of doubling values, and only the streams which
+    re-planning changes, or whose subscriptions it moves, are restarted: their
+    successors are opened first, for up to ``handoff`` seconds of overlap, and
+    notifications received on both are handed over once. Subscriptions stay hot
+    until their rate falls below half ``hot_rate``.
+
+    Usage::
+
+        planner = O365StreamPlanner(subscriber, max_streams=4)
+        thread = threading.Thread(target=planner.run, args=(handler,))
+        thread.start()
+        ...
+        for load in planner.report():
+            print(load)
+        planner.stop()
+    """
+
+    def __init__(
+        self,
+        subscriber: O365StreamingSubscriber,
+        *,
+        max_streams: int = 4,
+        hot_rate: float = 1.0,
+        window: float = 300.0,
+        keep_alive_range: tuple[int, int] = (5, 60),
+        connection_timeout_range: tuple[int, int] = (15, 120),
+        clock=time.monotonic,
+        **stream_kwargs,
+    ):
+        """
+        :param subscriber: the streaming subscriber
+        :param max_streams: max number of concurrent connections
+        :param hot_rate: notifications per second of a subscription getting a
+            stream of its own
+        :param window: time in seconds between re-plannings, measured over
+        :param keep_alive_range: bounds of the keep-alive interval, in seconds
+        :param connection_timeout_range: bounds of the connection timeout, in
+            minutes
+        :param stream_kwargs: extra params to send to ``start_streaming``
+        :raises TypeError: if the subscriber's streamings are coroutines
+        """
+        _require_synchronous(subscriber, type(self).__name__)
+        self.subscriber = subscriber
+        self.max_streams = max_streams
+        self.hot_rate = hot_rate
+        self.window = window
+        self.keep_alive_range = keep_alive_range
+        self.connection_timeout_range = connection_timeout_range
+        self.clock = clock
+        self.stream_kwargs = {**stream_kwargs, "refresh_after_expire": True}
+        self._lanes = []
+        self._hot = set()  # ids of the subscriptions with a stream of their own
+        self._since = clock()  # start of the window
+        self._handing = threading.Lock()
+        self._seen = O365DedupFilter(subscriber.handoff_dedup_capacity)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def tune(
+        self, notifications: int, errors: int, elapsed: typing.Optional[float]
+    ) -> tuple[int, int]:
+        """
+        Tune a stream from what was measured on it.
+
+        :param notifications: notifications of the stream, over the window
+        :param errors: errors of the stream, over the window
+        :param elapsed: the window, in seconds, or None if nothing was measured
+        :return: the keep-alive interval and connection timeout
+        """
+        low, high = self.keep_alive_range
+        if elapsed is None:
+            keep_alive = low
+        else:
+            idle = elapsed / notifications if notifications else elapsed
+            keep_alive = _ladder(idle / (1 + errors), low, high)
+        low, high = self.connection_timeout_range
+        connection_timeout = max(high >> min(errors, 16), low)
+        return keep_alive, connection_timeout
+
+    def plan(
+        self,
+        counts: dict = None,
+        errors: dict = None,
+        elapsed: float = None,
+    ) -> list[O365StreamPlan]:
+        """
+        Split the subscriptions across streams.
+
+        :param counts: notifications per subscription id, over the window
+        :param errors: errors per subscription id, of the stream it was on
+        :param elapsed: the window, in seconds, or None if nothing was measured
+        :return: the planned streams
+        """
+        counts = counts or {}
+        errors = errors or {}
+
+        def rate(subscription) -> float:
+            return counts.get(subscription.id, 0) / elapsed if elapsed else 0.0
+
+        def threshold(subscription) -> float:
+            hot = id(subscription) in self._hot
+            return self.hot_rate / 2 if hot else self.hot_rate
+
+        ranked = sorted(self.subscriber.subscriptions, key=rate, reverse=True)
+        hot = [s for s in ranked if elapsed and rate(s) >= threshold(s)]
+        if len(hot) < len(ranked) or len(hot) > self.max_streams:
+            hot = hot[: self.max_streams - 1]  # a stream is left for the others
+        self._hot = set(map(id, hot))
+        shared = [s for s in ranked if id(s) not in self._hot]
+
+        plans = []
+        for group, dedicated in [*(([s], True) for s in hot), (shared, False)]:
+            if not group:
+                continue
+            keep_alive, connection_timeout = self.tune(
+                sum(counts.get(s.id, 0) for s in group),
+                max(errors.get(s.id, 0) for s in group),
+                elapsed,
+            )
+            plans.append(
+                O365StreamPlan(group, keep_alive, connection_timeout, dedicated)
+            )
+        return plans
+
+    def report(self) -> list[O365StreamLoad]:
+        """The load of the running streams, over the current window."""
+        elapsed = max(self.clock() - self._since, 1e-9)
+        loads = []
+        with self._handing:
+            for lane in self._lanes:
+                notifications = sum(lane.counts.values())
+                loads.append(
+                    O365StreamLoad(
+                        subscriptions=[s.id for s in lane.plan.subscriptions],
+                        dedicated=lane.plan.dedicated,
+                        keep_alive_interval=lane.plan.keep_alive_interval,
+                        connection_timeout=lane.plan.connection_timeout,
+                        notifications=notifications,
+                        rate=notifications / elapsed,
+                        idle=elapsed / notifications if notifications else elapsed,
+                        connections=lane.stats.connections,
+                        errors=lane.errors,
+                    )
+                )
+        return loads
+
+    def _measure(self) -> tuple[dict, dict, float]:
+        """What was measured over the window, which starts anew."""
+        now = self.clock()
+        counts, errors = Counter(), {}
+        with self._handing:
+            for lane in self._lanes:
+                counts.update(lane.counts)
+                for subscription in lane.plan.subscriptions:
+                    errors[subscription.id] = lane.errors
+                lane.counts = Counter()
+                lane.errors_before = lane.stats.errors
+        elapsed, self._since = now - self._since, now
+        return counts, errors, elapsed
+
+    def run(self, notification_handler: O365BaseNotificationsHandler = None):
+        """
+        Stream the subscriptions as planned, re-planning every window.
+
+        Returns once stopped, or once every stream ended.
+
+        :param notification_handler: the notification's handler
+        :raises Exception: if a stream fails
+        """
+        handler = notification_handler or O365NotificationHandler()
+        self._since = self.clock()
+        self._start(self.plan(), handler)
+        deadline = self._since + self.window
+        try:
+            while True:
+                self._wake.wait(max(deadline - self.clock(), 0))
+                self._wake.clear()
+                if self._stopping:
+                    break
+                failed = next((lane for lane in self._lanes if lane.error), None)
+                if failed is not None:
+                    raise failed.error
+                if not any(lane.thread.is_alive() for lane in self._lanes):
+                    break
+                if self.clock() >= deadline:
+                    self._replan(handler)
+                    deadline = self.clock() + self.window
+        finally:
+            self._stop_lanes(self._lanes)
+            with self._lock:
+                self._stopping = False
+
+    def stop(self):
+        """Stop the running streams. Safe to call from any thread."""
+        with self._lock:
+            self._stopping = True
+            for lane in self._lanes:
+                self.subscriber.stop_streaming(lane.stop)
+        self._wake.set()
+
+    def _replan(self, handler: O365BaseNotificationsHandler):
+        plans = self.plan(*self._measure())
+        running = {lane.plan.key(): lane for lane in self._lanes}
+        changed = [p for p in plans if p.key() not in running]
+        kept = [running.pop(p.key()) for p in plans if p.key() in running]
+        if not changed and not running:
+            return
+        logger.info(
+            f"Re-planning {len(self.subscriber.subscriptions)} subscriptions "
+            f"over {len(plans)} streams, {len(changed)} of them new."
+        )
+        # the new streams are opened before the ones they replace are stopped
+        started = self._start(changed, handler, kept)
+        handoff = self.stream_kwargs.get("handoff", 30)
+        deadline = self.clock() + handoff
+        while any(
+            lane.thread.is_alive() and not lane.stats.connections for lane in started
+        ):
+            if self._stopping or self.clock() >= deadline:
+                break
+            time.sleep(0.01)
+        self._stop_lanes(list(running.values()))
+
+    def _start(
+        self,
+        plans: list[O365StreamPlan],
+        handler,
+        kept: list[_Lane] = (),
+    ) -> list[_Lane]:
+        with self._lock:
+            if self._stopping:
+                return []
+            lanes = [_Lane(plan, handler, self._handing, self._seen) for plan in plans]
+            for lane in lanes:
+                lane.thread = threading.Thread(
+                    target=self._stream,
+                    args=(lane,),
+                    name="O365StreamPlanner",
+                    daemon=True,
+                )
+                lane.thread.start()
+            with self._handing:
+                self._lanes = [*kept, *lanes]
+        return lanes
+
+    def _stream(self, lane: _Lane):
+        plan = lane.plan
+        try:
+            self.subscriber.start_streaming(
+                notification_handler=lane,
+                subscriptions=plan.subscriptions,
+                stats=lane.stats,
+                stop=lane.stop,
+                keep_alive_interval=plan.keep_alive_interval,
+                connection_timeout=plan.connection_timeout,
+                **self.stream_kwargs,
+            )
+        except Exception as e:
+            logger.exception("Stream failed.")
+            lane.error = e
+        finally:
+            self._wake.set()
+
+    def _stop_lanes(self, lanes: list[_Lane]):
+        for lane in lanes:
+            self.subscriber.stop_streaming(lane.stop)
+        for lane in lanes:
+            lane.thread.join()
@@ -1,14 +1,486 @@
-from O365_notifications.base import O365Notification, O365Subscriber
+import datetime
+import json
+import logging
+import queue
+import secrets
+import threading
+from dataclasses import dataclass
+from urllib.parse import parse_qsl
+
+import requests
+
+from O365_notifications.base import (
+    O365BaseNotificationsHandler,
+    O365BaseSubscription,
+    O365Notification,
+    O365NotificationBatcher,
+    O365NotificationHandler,
+    O365Subscriber,
+)
+from O365_notifications.utils import build_url, lazy_schema
+
+__all__ = (
+    "O365PushNotification",
+    "O365PushReceiver",
+    "O365PushSubscription",
+    "O365PushSubscriber",
+)
+
+logger = logging.getLogger(__name__)
 
 
 class O365PushNotification(O365Notification):
-    pass
+    __slots__ = ()
+
+
+# keys of Microsoft Graph not merely camelCased, see 'O365Namespace.key'
+_GRAPH_KEYS = {
+    "NotificationURL": "notificationUrl",
+    "SubscriptionExpirationDateTime": "expirationDateTime",
+}
+
+
+@dataclass
+class O365PushSubscription(O365BaseSubscription):
+    notification_url: str = None
+    client_state: str = None
+    include_resource_data: bool = None
+    encryption_certificate: str = None
+    encryption_certificate_id: str = None
+    lifecycle_notification_url: str = None
+
+    @lazy_schema
+    def schema():
+        from marshmallow import EXCLUDE, fields, post_dump, pre_load
+
+        class O365PushSubscriptionSchema(O365BaseSubscription.schema):
+            context = fields.Str(data_key="@odata.context", load_only=True)
+            url = fields.Str(data_key="@odata.id", load_only=True)
+            notification_url = fields.Str(data_key="NotificationURL")
+            client_state = fields.Str(data_key="ClientState")
+            include_resource_data = fields.Bool(data_key="IncludeResourceData")
+            encryption_certificate = fields.Str(data_key="EncryptionCertificate")
+            encryption_certificate_id = fields.Str(data_key="EncryptionCertificateId")
+            lifecycle_notification_url = fields.Str(data_key="LifecycleNotificationUrl")
+            # requested on Microsoft Graph, which requires it
+            expiration = fields.DateTime(data_key="SubscriptionExpirationDateTime")
+
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                self.camel_case = self.namespace is not None and (
+                    self.namespace.camel_case
+                )
+                if self.camel_case:
+                    # Microsoft Graph keys subscriptions in camelCase, among
+                    # many more fields than kept here
+                    self.unknown = EXCLUDE
+                    for f in self.fields.values():
+                        key = f.data_key
+                        f.data_key = _GRAPH_KEYS.get(key, self.namespace.key(key))
+
+            @pre_load
+            def type_graph_subscription(self, data, **_):
+                if not self.camel_case:
+                    return data
+                # untyped, with lower-case change types
+                sub_type = self.namespace.O365SubscriptionType.PUSH_SUBSCRIPTION
+                events = data.get("changeType", "").split(",")
+                return {
+                    "@odata.type": sub_type.value,
+                    **data,
+                    "changeType": ",".join(e.strip().capitalize() for e in events),
+                }
+
+            @post_dump
+            def drop_unset_fields(self, data, **_):
+                # only sent for subscriptions to rich notifications, or on Graph
+                for name in (
+                    "include_resource_data",
+                    "encryption_certificate",
+                    "encryption_certificate_id",
+                    "lifecycle_notification_url",
+                    "expiration",
+                ):
+                    key = self.fields[name].data_key
+                    if data.get(key) is None:
+                        data.pop(key, None)
+                if self.camel_case:
+                    data.pop("@odata.type", None)
+                    data["changeType"] = data["changeType"].lower()
+                return data
+
+        return O365PushSubscriptionSchema
 
 
 class O365PushSubscriber(O365Subscriber):
-    def subscribe(self, *, resource):
-        raise NotImplementedError("TODO: must implement this method.")
+    subscription_cls = O365PushSubscription
+    notification_classes = {"NOTIFICATION": O365PushNotification}
+    # requested lifetimes on Microsoft Graph, below its max for messages
+    subscription_lifetime = datetime.timedelta(days=3)
+    rich_subscription_lifetime = datetime.timedelta(hours=12)
+
+    def __init__(
+        self,
+        *,
+        parent=None,
+        con=None,
+        notification_url: str,
+        client_state: str = None,
+        certificate=None,
+        decrypt_workers: int = 4,
+        lifecycle_notification_url: str = None,
+        **kwargs,
+    ):
+        """
+        Subscriber of push notifications.
+
+        With a ``certificate``, notifications carry the resource data they are
+        about, encrypted for the certificate (requires the ``rich`` extra).
+
+        Subscriptions are requested in the casing of the protocol; on Microsoft
+        Graph, they expire after ``subscription_lifetime``, or
+        ``rich_subscription_lifetime`` with a certificate, unless renewed. Posts of
+        rich notifications must then carry validation tokens, which the receiver
+        verifies (see ``O365TokenValidator``), and lifecycle events of the
+        subscriptions are posted to ``lifecycle_notification_url``.
+
+        :param notification_url: the url notifications are posted to
+        :param client_state: secret sent along with every notification, used to
+            tell genuine notifications apart; generated if not provided
+        :param certificate: an ``O365EncryptionCertificate``, for rich notifications
+        :param decrypt_workers: threads decrypting rich notifications
+        :param lifecycle_notification_url: the url lifecycle events are posted to,
+            required by Graph for rich notifications; defaults to
+            ``notification_url`` with a certificate, where they are logged
+        """
+        super().__init__(parent=parent, con=con, **kwargs)
+        self.notification_url = notification_url
+        self.client_state = client_state or secrets.token_urlsafe(32)
+        self.certificate = certificate
+        self.lifecycle_notification_url = lifecycle_notification_url
+        self.decryptor = None
+        self.token_validator = None
+        if certificate is not None:
+            from O365_notifications.rich import (
+                O365ContentDecryptor,
+                O365RichNotification,
+                O365TokenValidator,
+            )
+
+            if self.namespace.camel_case:
+                self.token_validator = O365TokenValidator(self.con)
+                self.lifecycle_notification_url = (
+                    lifecycle_notification_url or notification_url
+                )
+
+            self.decryptor = O365ContentDecryptor(
+                [certificate], workers=decrypt_workers
+            )
+            self.decoder.register(
+                self.namespace.O365NotificationType.NOTIFICATION, O365RichNotification
+            )
+
+    def rotate_certificate(self, certificate):
+        """
+        Encrypt the notifications of new subscriptions for another certificate.
+
+        Notifications encrypted for previous certificates are still decrypted.
+
+        :param certificate: the new ``O365EncryptionCertificate``
+        """
+        if self.decryptor is None:
+            raise ValueError("subscriber was not set up for rich notifications.")
+        self.decryptor.add_certificate(certificate)
+        self.certificate = certificate
+
+    def subscription_factory(self, **kwargs) -> O365PushSubscription:
+        sub_type = self.namespace.O365SubscriptionType.PUSH_SUBSCRIPTION
+        graph = {}
+        if self.namespace.camel_case:
+            graph["expiration"] = self._expiration()
+            if kwargs.get("resource") is not None:
+                graph["resource_url"] = self.resource_url(kwargs["resource"])
+        return self.subscription_cls(
+            **{
+                **kwargs,
+                "type": sub_type,
+                "notification_url": self.notification_url,
+                "client_state": self.client_state,
+                "lifecycle_notification_url": self.lifecycle_notification_url,
+                **self._rich_fields(),
+                **graph,
+                "raw": kwargs,
+            }
+        )
+
+    def build_url(self, endpoint: str) -> str:
+        if self.namespace.camel_case:
+            # subscriptions are addressed from the api root on Graph
+            return f"{self.protocol.service_url}{endpoint.lstrip('/')}"
+        return super().build_url(endpoint)
+
+    def resource_url(self, resource) -> str:
+        url = build_url(resource)
+        service_url = self.protocol.service_url
+        if self.namespace.camel_case and url and url.startswith(service_url):
+            return url[len(service_url) :]  # relative to the api root on Graph
+        return url
+
+    def renewal_request(self, subscription: O365PushSubscription) -> dict:
+        if not self.namespace.camel_case:
+            return super().renewal_request(subscription)
+        return {"expirationDateTime": self._expiration().isoformat()}
+
+    def _expiration(self) -> datetime.datetime:
+        lifetime = self.subscription_lifetime
+        if self.certificate is not None:
+            lifetime = self.rich_subscription_lifetime
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return now.replace(microsecond=0) + lifetime
+
+    def _rich_fields(self) -> dict:
+        if self.certificate is None:
+            return {}
+        return {
+            "include_resource_data": True,
+            "encryption_certificate": self.certificate.public,
+            "encryption_certificate_id": self.certificate.id,
+        }
+
+    def notification_factory(self, data: dict, *, frame: bytes = None):
+        if not self.namespace.camel_case:
+            return super().notification_factory(data, frame=frame)
+        # change notifications of Microsoft Graph are keyed in camelCase, untyped
+        normalized = _pascal_case(data)
+        normalized.setdefault(
+            "@odata.type", self.namespace.O365NotificationType.NOTIFICATION.value
+        )
+        normalized["ChangeType"] = normalized["ChangeType"].capitalize()
+        if "ResourceData" in normalized:
+            normalized["ResourceData"] = _pascal_case(normalized["ResourceData"])
+        notification = super().notification_factory(normalized, frame=frame)
+        if notification.raw is normalized:
+            notification.raw = data  # as received
+        return notification
+
+
+def _pascal_case(data: dict) -> dict:
+    return {
+        key if key.startswith("@") else key[:1].upper() + key[1:]: value
+        for key, value in data.items()
+    }
+
+
+class O365PushReceiver:
+    """
+    Embeddable WSGI/ASGI application receiving push notifications.
+
+    It answers the validation-token handshake sent upon subscription and
+    acknowledges notification posts with 202 as soon as their body is parsed.
+    Notifications are then decoded and handed over to the handler by a background
+    thread, so handlers never delay the acknowledgement. Notifications carrying an
+    unexpected client state are discarded, and so are rich notifications whose
+    content fails verification. The client state is read off the notifications on
+    Microsoft Graph, and off the ``ClientState`` request header on Outlook. Posts
+    of rich notifications whose validation tokens fail verification are refused
+    with 400, and lifecycle events are logged. When the backlog is full, posts are
+    refused with 503, for the api provider to retry them later.
+
+    Usage::
+
+        receiver = O365PushReceiver(subscriber, handler)
+        receiver.start()
+        wsgi_server.serve(receiver)  # or asgi_server.serve(receiver.asgi)
+    """
+
+    def __init__(
+        self,
+        subscriber: O365PushSubscriber,
+        handler: O365BaseNotificationsHandler = None,
+        *,
+        max_backlog: int = 10000,  # in posts
+    ):
+        self.subscriber = subscriber
+        self.handler = handler or O365NotificationHandler()
+        self._queue = queue.Queue(maxsize=max_backlog)
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        """Start processing notifications in a background thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._work, name="O365PushReceiver", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Process the pending notifications and stop the background thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def accept(
+        self, method: str, query: str, body: bytes, headers: dict = None
+    ) -> tuple[int, str]:
+        """
+        Framework-agnostic handling of a request.
+
+        :param method: the http method
+        :param query: the url query string
+        :param body: the request body
+        :param headers: the request headers, keyed by lower-case name
+        :return: the response status code and text
+        """
+        params = {k.lower(): v for k, v in parse_qsl(query)}
+        if "validationtoken" in params:
+            logger.debug("Answering subscription validation.")
+            return 200, params["validationtoken"]
+        if method != "POST":
+            return 405, ""
+
+        # posts arrive whole, unlike streams
+        try:
+            payload = json.loads(body)
+            values = payload["value"]
+            if not all(isinstance(v, dict) for v in values):
+                raise TypeError("notifications must be objects")
+        except (ValueError, KeyError, TypeError):
+            return 400, ""
+
+        namespace = self.subscriber.namespace
+        validator = self.subscriber.token_validator
+        encrypted = namespace.key("EncryptedContent")
+        if validator is not None and any(encrypted in v for v in values):
+            tenant_ids = {v.get("tenantId") for v in values}
+            try:
+                validator.validate_all(payload.get("validationTokens"), tenant_ids)
+            except ValueError as e:
+                logger.warning(f"Refused notifications, failing validation: {e}")
+                return 400, ""
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Failed fetching the token signing keys: {e!r}")
+                return 503, ""
+
+        client_state = self.subscriber.client_state
+        header = (headers or {}).get("clientstate")
+        key = namespace.key("ClientState")
+        genuine = [v for v in values if v.get(key, header) == client_state]
+        if len(genuine) < len(values):
+            logger.warning(f"Discarded {len(values) - len(genuine)} notification(s).")
+        for event in [v for v in genuine if "lifecycleEvent" in v]:
+            subscription_id = event.get("subscriptionId")
+            logger.warning(
+                f"Lifecycle event '{event['lifecycleEvent']}' "
+                f"on subscription '{subscription_id}'."
+            )
+            genuine.remove(event)
+        try:
+            self._queue.put_nowait(genuine)
+        except queue.Full:
+            return 503, ""
+        return 202, ""
+
+    def __call__(self, environ, start_response):
+        """The WSGI application."""
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        body = environ["wsgi.input"].read(length) if length else b""
+        headers = {}
+        if "HTTP_CLIENTSTATE" in environ:
+            headers["clientstate"] = environ["HTTP_CLIENTSTATE"]
+        status, text = self.accept(
+            environ["REQUEST_METHOD"], environ.get("QUERY_STRING", ""), body, headers
+        )
+        content = text.encode()
+        start_response(
+            f"{status} {_REASONS[status]}",
+            [("Content-Type", "text/plain"), ("Content-Length", str(len(content)))],
+        )
+        return [content]
+
+    async def asgi(self, scope, receive, send):
+        """The ASGI application."""
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    self.start()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    self.stop()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        body, more = b"", True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+        headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", ())
+        }
+        status, text = self.accept(
+            scope["method"], scope.get("query_string", b"").decode(), body, headers
+        )
+        content = text.encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"text/plain"),
+                    (b"content-length", str(len(content)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": content})
+
+    def _work(self):
+        batcher = O365NotificationBatcher(self.handler)
+        while True:
+            values = self._queue.get()
+            if values is None:
+                break
+            notifications = []
+            for raw in values:
+                try:
+                    notifications.append(self.subscriber.notification_factory(raw))
+                except Exception:
+                    logger.exception("Failed decoding push notification.")
+            decryptor = self.subscriber.decryptor
+            if decryptor is not None and notifications:
+                notifications = decryptor.process(notifications)
+            for notification in notifications:
+                try:
+                    for item in batcher.add(notification):
+                        self.subscriber.deliver(self.handler, item)
+                except Exception:
+                    logger.exception("Failed processing push notification.")
+            try:
+                for item in batcher.flush():
+                    self.subscriber.deliver(self.handler, item)
+            except Exception:
+                logger.exception("Failed processing push notifications.")
+
 
-    @property
-    def request_type(self):
-        raise NotImplementedError("TODO: must implement this method.")
+_REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    405: "Method Not Allowed",
+    503: "Service Unavailable",
+}
@@ -0,0 +1,110 @@
+import threading
+import typing
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.utils import build_url
+
+__all__ = ("O365SubscriptionRegistry",)
+
+
+class O365SubscriptionRegistry:
+    """
+    Subscriptions of a subscriber, indexed for constant time access.
+
+    Subscriptions are indexed by resource (using the resource url given by
+    ``build_url``), by subscription id and by event type. The registry keeps the
+    order of registration and behaves as a read-only sequence of subscriptions.
+    """
+
+    def __init__(self):
+        self._by_resource = {}
+        self._by_id = {}
+        self._by_event = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def resource_key(resource) -> typing.Hashable:
+        """The key a resource is indexed by."""
+        if isinstance(resource, str):
+            return resource
+        return build_url(resource) or id(resource)
+
+    def __len__(self):
+        return len(self._by_resource)
+
+    def __iter__(self):
+        return iter(list(self._by_resource.values()))
+
+    def __bool__(self):
+        return bool(self._by_resource)
+
+    def __contains__(self, subscription):
+        return self._by_id.get(getattr(subscription, "id", None)) is subscription
+
+    def __getitem__(self, index: int):
+        return list(self._by_resource.values())[index]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({list(self)})"
+
+    def get(self, subscription_id: str):
+        """The subscription with the given id, if any."""
+        return self._by_id.get(subscription_id)
+
+    def for_resource(self, resource):
+        """The subscription of a resource (or resource url), if any."""
+        return self._by_resource.get(self.resource_key(resource))
+
+    def for_event(self, event: O365EventType) -> list:
+        """The subscriptions listening to an event type."""
+        return list(self._by_event.get(event, {}).values())
+
+    def upsert(self, subscription):
+        """
+        Register a subscription, replacing the one of the same resource.
+
+        The subscription already registered for the resource is updated in place,
+        so references to it remain valid.
+
+        :param subscription: the subscription to register
+        :return: the registered subscription
+        """
+        key = self.resource_key(subscription.resource)
+        with self._lock:
+            current = self._by_resource.get(key)
+            if current is None:
+                current = self._by_resource[key] = subscription
+            else:
+                self._unindex(key, current)
+                current.id = subscription.id
+                current.events = subscription.events
+                current.expiration = subscription.expiration
+                current.raw = subscription.raw
+            self._index(key, current)
+        return current
+
+    def remove(self, subscription):
+        """
+        Unregister a subscription.
+
+        :param subscription: the subscription to unregister
+        :return: whether the subscription was registered
+        """
+        key = self.resource_key(subscription.resource)
+        with self._lock:
+            if self._by_resource.get(key) is not subscription:
+                return False
+            self._unindex(key, subscription)
+            del self._by_resource[key]
+        return True
+
+    def _index(self, key, subscription):
+        self._by_id[subscription.id] = subscription
+        for event in subscription.events:
+            self._by_event.setdefault(event, {})[key] = subscription
+
+    def _unindex(self, key, subscription):
+        if self._by_id.get(subscription.id) is subscription:
+            del self._by_id[subscription.id]
+        for event in subscription.events:
+            self._by_event.get(event, {}).pop(key, None)
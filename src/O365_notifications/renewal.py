@@ -0,0 +1,170 @@
+import datetime
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from O365_notifications.base import (
+    O365BaseSubscription,
+    O365Subscriber,
+    _require_synchronous,
+)
+
+__all__ = ("O365RenewalScheduler",)
+
+logger = logging.getLogger(__name__)
+
+
+def _now(reference: datetime.datetime) -> datetime.datetime:
+    """The current time, as aware or naive as the reference is."""
+    if reference.tzinfo is None:
+        return datetime.datetime.now()
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class O365RenewalScheduler:
+    """
+    Renews a subscriber's subscriptions ahead of their expiration.
+
+    The expiration of each subscription comes from the subscription payload, or
+    from the latest notification received for it. Renewal is due ``lead_time``
+    seconds before expiring, brought forward by a random jitter so that
+    subscriptions created together are not renewed in a single burst. Due
+    subscriptions are renewed concurrently, keeping their ids, so running streams
+    carry on undisturbed. Subscriptions with unknown expiration are left alone.
+    Asynchronous subscribers are refused, as renewals run on threads.
+
+    Usage::
+
+        with O365RenewalScheduler(subscriber):
+            subscriber.start_streaming(refresh_after_expire=True)
+    """
+
+    def __init__(
+        self,
+        subscriber: O365Subscriber,
+        *,
+        lead_time: float = 300,  # in seconds
+        jitter: float = 0.2,  # fraction of the lead time
+        max_workers: int = 4,
+        retry_interval: float = 30,  # in seconds
+        poll_interval: float = 60,  # in seconds
+    ):
+        _require_synchronous(subscriber, type(self).__name__)
+        self.subscriber = subscriber
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.retry_interval = retry_interval
+        self.poll_interval = poll_interval
+        self._schedule = {}  # subscription id -> (expiration, renewal time)
+        self._renewed = {}  # subscription id -> expiration renewed beyond
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        """Start renewing in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="O365RenewalScheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def expiration(self, subscription: O365BaseSubscription):
+        """The latest known expiration of a subscription."""
+        observed = self.subscriber.expirations.get(subscription.id)
+        known = [e for e in (observed, subscription.expiration) if e is not None]
+        renewed = self._renewed.get(subscription.id)
+        if renewed is not None:
+            # ignore expirations which were renewed already
+            known = [e for e in known if e.timestamp() > renewed.timestamp()]
+        return max(known, default=None, key=lambda e: e.timestamp())
+
+    def renewal_time(self, subscription: O365BaseSubscription):
+        """When a subscription is due for renewal, or None if unknown."""
+        expiration = self.expiration(subscription)
+        if expiration is None:
+            return None
+
+        scheduled = self._schedule.get(subscription.id)
+        if scheduled is None or scheduled[0] != expiration:
+            lead = self.lead_time * (1 + random.uniform(0, self.jitter))
+            renew_at = expiration - datetime.timedelta(seconds=lead)
+            self._schedule[subscription.id] = scheduled = (expiration, renew_at)
+        return scheduled[1]
+
+    def due(self) -> list[O365BaseSubscription]:
+        """The subscriptions due for renewal."""
+        due, subscriptions = [], list(self.subscriber.subscriptions)
+        for stale in self._renewed.keys() - {s.id for s in subscriptions}:
+            del self._renewed[stale]
+        for subscription in subscriptions:
+            renew_at = self.renewal_time(subscription)
+            if renew_at is not None and renew_at <= _now(renew_at):
+                due.append(subscription)
+        return due
+
+    def run_pending(self) -> list[O365BaseSubscription]:
+        """
+        Renew the subscriptions due for renewal, concurrently.
+
+        :return: the renewed subscriptions
+        """
+        due = self.due()
+        if not due:
+            return []
+
+        logger.info(f"Renewing {len(due)} subscription(s) ahead of expiration ...")
+        renewed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # ids are captured upfront since renewal may swap them
+            futures = {
+                executor.submit(self.subscriber.renew_subscription, s): s.id
+                for s in due
+            }
+            for future, sub_id in futures.items():
+                expiration, renew_at = self._schedule.pop(sub_id)
+                try:
+                    renewed.append(future.result())
+                except Exception as e:
+                    logger.warning(f"Failed renewing '{sub_id}': {e}")
+                    retry_at = _now(renew_at) + datetime.timedelta(
+                        seconds=self.retry_interval
+                    )
+                    self._schedule[sub_id] = (expiration, retry_at)
+                else:
+                    self._renewed[sub_id] = expiration
+        return renewed
+
+    def next_delay(self) -> float:
+        """Seconds until the next renewal is due, capped at the poll interval."""
+        delays = [self.poll_interval]
+        for subscription in list(self.subscriber.subscriptions):
+            renew_at = self.renewal_time(subscription)
+            if renew_at is not None:
+                delays.append((renew_at - _now(renew_at)).total_seconds())
+        return max(min(delays), 0)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception("Subscription renewal failed.")
+            self._stop.wait(self.next_delay())
@@ -0,0 +1,330 @@
+"""
+Record GetNotifications streams, and replay them offline.
+
+Replay a recording through the streaming pipeline::
+
+    python -m O365_notifications.replay notifications.rec.gz --speed 10
+"""
+
+import argparse
+import datetime
+import gzip
+import importlib
+import json
+import logging
+import struct
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+import O365
+
+from O365_notifications.base import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365NotificationHandler,
+)
+from O365_notifications.constants import O365EventType
+from O365_notifications.notifications import O365WrappingHandler
+from O365_notifications.streaming import O365StreamingSubscriber
+
+__all__ = ("O365ReplayStats", "O365StreamRecorder", "O365StreamReplayer")
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"O365REC\x01"
+_LENGTH = struct.Struct("<I")
+# record header: kind, stream, offset in microseconds, payload length
+_RECORD = struct.Struct("<BIQI")
+_STREAM, _CHUNK = 0, 1
+
+
+def _open(path: str, mode: str):
+    """Recordings ending in '.gz' are compressed."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class O365StreamRecorder:
+    """
+    Writes the raw bytes of GetNotifications streams to a file, as received.
+
+    Every chunk is recorded along with the stream it was read off and the time it
+    arrived, so that replays reproduce the chunk boundaries and timing. Streams
+    opened anew, e.g. on reconnects, are recorded one after the other.
+
+    Usage::
+
+        with O365StreamRecorder("notifications.rec.gz") as recorder:
+            subscriber.start_streaming(recorder=recorder)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._streams = 0
+        self._start = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def open_stream(self, subscriber: O365StreamingSubscriber, request: dict) -> int:
+        """
+        Record the opening of a stream.
+
+        :param subscriber: the streaming subscriber
+        :param request: the GetNotifications request
+        :return: the stream index, to record chunks with
+        """
+        with self._lock:
+            if self._file is None:
+                self._file = _open(self.path, "wb")
+                self._start = time.perf_counter()
+                header = json.dumps(
+                    {
+                        "protocol": type(subscriber.protocol).__name__,
+                        "api_version": subscriber.protocol.api_version,
+                        "main_resource": subscriber.main_resource,
+                        "recorded": datetime.datetime.now(
+                            datetime.timezone.utc
+                        ).isoformat(),
+                    }
+                ).encode()
+                self._file.write(_MAGIC + _LENGTH.pack(len(header)) + header)
+            index = self._streams
+            self._streams += 1
+            self._write(_STREAM, index, json.dumps(request).encode())
+        return index
+
+    def chunk(self, stream: int, data: bytes):
+        """Record a chunk read off a stream."""
+        with self._lock:
+            self._write(_CHUNK, stream, data)
+
+    def _write(self, kind: int, stream: int, data: bytes):
+        offset = int((time.perf_counter() - self._start) * 1e6)
+        self._file.write(_RECORD.pack(kind, stream, offset, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@dataclass
+class O365ReplayStats:
+    streams: int = 0
+    chunks: int = 0
+    bytes: int = 0
+    notifications: int = 0  # keep-alives included
+    seconds: float = 0.0
+
+
+class _ReplayResponse:
+    def __init__(self, chunks: list, speed: typing.Optional[float], stats):
+        self.chunks = chunks
+        self.speed = speed
+        self.stats = stats
+        self.closed = False
+
+    def __bool__(self):
+        return True
+
+    def iter_content(self, chunk_size=None):
+        start = time.perf_counter()
+        first = self.chunks[0][0] if self.chunks else 0
+        for offset, data in self.chunks:
+            if self.closed:
+                return
+            if self.speed:
+                delay = start + (offset - first) / 1e6 / self.speed
+                delay -= time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.stats.chunks += 1
+            self.stats.bytes += len(data)
+            yield data
+
+    def close(self):
+        self.closed = True
+
+
+class _ReplayConnection:
+    """Answers GetNotifications requests with the recorded streams, in order."""
+
+    def __init__(self, streams: list, speed: typing.Optional[float], stats):
+        self.responses = (_ReplayResponse(s, speed, stats) for s in streams)
+        self.stats = stats
+
+    def post(self, url: str, data: dict = None, **kwargs):
+        response = next(self.responses, None)
+        if response is not None:
+            self.stats.streams += 1
+        return response
+
+
+class _CountingHandler(O365WrappingHandler):
+    def __init__(self, handler: O365BaseNotificationsHandler, stats):
+        super().__init__(handler)
+        self.stats = stats
+
+    def process(self, notification: O365BaseNotification):
+        self.stats.notifications += 1
+        self.handler.process(notification)
+
+    def process_batch(self, notifications: list[O365BaseNotification]):
+        self.stats.notifications += len(notifications)
+        self.handler.process_batch(notifications)
+
+
+class O365StreamReplayer:
+    """
+    Replays a recording through the streaming pipeline: reader threads, decoder,
+    batching and handler, as ``start_streaming`` runs them.
+
+    Recorded streams are loaded in memory, and replayed one after the other.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.metadata = {}
+        self.requests = []  # GetNotifications request per stream
+        self.streams = []  # list of (offset, chunk) per stream
+        self._load()
+
+    def _load(self):
+        with _open(self.path, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"'{self.path}' is not a stream recording.")
+            (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+            self.metadata = json.loads(f.read(length))
+            index = {}  # recorded stream index -> position
+            while True:
+                header = f.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    break  # end of recording, or torn tail
+                kind, stream, offset, length = _RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                if kind == _STREAM:
+                    index[stream] = len(self.streams)
+                    self.requests.append(json.loads(data))
+                    self.streams.append([])
+                elif stream in index:
+                    self.streams[index[stream]].append((offset, data))
+
+    def subscriber(self, **kwargs) -> O365StreamingSubscriber:
+        """A subscriber of the recorded protocol, subscribed as when recorded."""
+        protocol_cls = getattr(O365, self.metadata["protocol"])
+        subscriber = O365StreamingSubscriber(
+            protocol=protocol_cls(api_version=self.metadata["api_version"]),
+            main_resource=self.metadata["main_resource"],
+            **kwargs,
+        )
+        sub_type = subscriber.namespace.O365SubscriptionType.STREAMING_SUBSCRIPTION
+        ids = dict.fromkeys(i for r in self.requests for i in r["SubscriptionIds"])
+        for subscription_id in ids:
+            subscriber.register_subscription(
+                resource=subscription_id,
+                events=[O365EventType.CREATED],
+                raw={
+                    "@odata.type": sub_type.value,
+                    "Id": subscription_id,
+                    "ChangeType": O365EventType.CREATED.value,  # unknown
+                },
+            )
+        return subscriber
+
+    def replay(
+        self,
+        notification_handler: O365BaseNotificationsHandler = None,
+        *,
+        speed: typing.Optional[float] = 1.0,
+        subscriber: O365StreamingSubscriber = None,
+    ) -> O365ReplayStats:
+        """
+        Replay the recording.
+
+        :param notification_handler: the notification's handler
+        :param speed: replay speed relative to the original one, or None for as
+            fast as possible
+        :param subscriber: the subscriber decoding the notifications, defaults to
+            one of the recorded protocol
+        :return: the replay stats
+        """
+        stats = O365ReplayStats()
+        handler = _CountingHandler(
+            notification_handler or O365NotificationHandler(), stats
+        )
+        subscriber = subscriber or self.subscriber()
+        con, subscriber.con = subscriber.con, _ReplayConnection(
+            self.streams, speed, stats
+        )
+        start = time.perf_counter()
+        try:
+            subscriber.start_streaming(
+                notification_handler=handler,
+                refresh_after_expire=True,
+                missed_keep_alives=0,  # no reconnecting a recording
+                handoff=0,
+            )
+        finally:
+            subscriber.con = con
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+
+def _handler(path: str) -> O365BaseNotificationsHandler:
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)()
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m O365_notifications.replay",
+        description="Replay a recording of GetNotifications streams.",
+    )
+    parser.add_argument("recording", help="the recording file")
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed, relative to the recorded one (default: 1)",
+    )
+    speed.add_argument(
+        "--max-speed",
+        dest="speed",
+        action="store_const",
+        const=None,
+        help="replay as fast as possible",
+    )
+    parser.add_argument(
+        "--handler",
+        type=_handler,
+        help="the notification handler class, as 'module:Class'",
+    )
+    args = parser.parse_args(argv)
+
+    replayer = O365StreamReplayer(args.recording)
+    stats = replayer.replay(args.handler, speed=args.speed)
+    rate = stats.notifications / stats.seconds if stats.seconds else 0
+    print(
+        f"{stats.notifications} notifications, {stats.bytes / 1e6:.2f} MB "
+        f"in {stats.chunks} chunks over {stats.streams} stream(s), "
+        f"in {stats.seconds:.3f}s ({rate:.0f} notifications/s)"
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    main()
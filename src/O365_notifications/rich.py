@@ -0,0 +1,401 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+import typing
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, padding, serialization
+from cryptography.hazmat.primitives.asymmetric import padding as asymmetric_padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.x509.oid import NameOID
+
+from O365_notifications.push import O365PushNotification
+from O365_notifications.utils import lazy_schema, slotted
+
+__all__ = (
+    "O365ContentDecryptor",
+    "O365DecryptStats",
+    "O365EncryptionCertificate",
+    "O365RichNotification",
+    "O365TokenValidator",
+)
+
+logger = logging.getLogger(__name__)
+
+
+@slotted
+@dataclass
+class O365RichNotification(O365PushNotification):
+    """Notification carrying the resource data itself, encrypted."""
+
+    encrypted_content: dict = None  # as received
+    content: dict = None  # decrypted, once verified
+
+    @lazy_schema
+    def schema():
+        from marshmallow import fields
+
+        class O365RichNotificationSchema(O365PushNotification.schema):
+            encrypted_content = fields.Dict(data_key="EncryptedContent")
+
+        return O365RichNotificationSchema
+
+    @classmethod
+    def fast_deserialize(cls, data: dict, *, namespace):
+        # the class was rebuilt by 'slotted', which zero-argument super() misses
+        parent = super(O365RichNotification, cls)
+        notification = parent.fast_deserialize(data, namespace=namespace)
+        notification.encrypted_content = data.get("EncryptedContent")
+        return notification
+
+
+class O365EncryptionCertificate:
+    """
+    Certificate the api provider encrypts the resource data of notifications with.
+
+    Only its public part is sent along with subscriptions; the private key stays
+    with the subscriber to unwrap the symmetric keys of notifications.
+    """
+
+    def __init__(self, certificate: x509.Certificate, private_key, *, id: str = None):
+        self.certificate = certificate
+        self.private_key = private_key
+        self.id = id or uuid.uuid4().hex
+
+    @classmethod
+    def generate(
+        cls,
+        *,
+        subject: str = "O365-notifications",
+        key_size: int = 2048,
+        valid_days: int = 365,
+        id: str = None,
+    ):
+        """A new self-signed certificate, with a new RSA key."""
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + datetime.timedelta(days=valid_days))
+            .sign(key, hashes.SHA256())
+        )
+        return cls(certificate, key, id=id)
+
+    @classmethod
+    def from_pem(
+        cls, certificate: bytes, private_key: bytes, *, password: bytes = None, id=None
+    ):
+        return cls(
+            x509.load_pem_x509_certificate(certificate),
+            serialization.load_pem_private_key(private_key, password=password),
+            id=id,
+        )
+
+    def to_pem(self, *, password: bytes = None) -> tuple[bytes, bytes]:
+        """The certificate and private key, PEM encoded."""
+        encryption = (
+            serialization.BestAvailableEncryption(password)
+            if password
+            else serialization.NoEncryption()
+        )
+        return (
+            self.certificate.public_bytes(serialization.Encoding.PEM),
+            self.private_key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                encryption,
+            ),
+        )
+
+    @property
+    def public(self) -> str:
+        """The base64 DER certificate, as sent with subscriptions."""
+        der = self.certificate.public_bytes(serialization.Encoding.DER)
+        return base64.b64encode(der).decode()
+
+    @property
+    def thumbprint(self) -> str:
+        return self.certificate.fingerprint(hashes.SHA1()).hex().upper()
+
+    @property
+    def expiration(self) -> datetime.datetime:
+        return self.certificate.not_valid_after_utc
+
+    def unwrap(self, data_key: str) -> bytes:
+        """Decrypt the symmetric key of a notification."""
+        return self.private_key.decrypt(
+            base64.b64decode(data_key),
+            asymmetric_padding.OAEP(
+                mgf=asymmetric_padding.MGF1(algorithm=hashes.SHA1()),
+                algorithm=hashes.SHA1(),
+                label=None,
+            ),
+        )
+
+
+@dataclass
+class O365DecryptStats:
+    decrypted: int = 0
+    rejected: int = 0  # bad signature, unknown certificate or corrupt data
+    key_hits: int = 0
+    key_misses: int = 0
+
+
+class O365ContentDecryptor:
+    """
+    Decrypts and verifies the resource data of rich notifications, in parallel.
+
+    For each notification, the symmetric key is unwrapped with the private key of
+    the certificate it was encrypted for, the HMAC-SHA256 signature of the data is
+    checked, and the data is decrypted with AES-CBC. Unwrapping is by far the most
+    expensive step, so unwrapped keys are kept in an LRU cache of ``cache_size``
+    keys; notifications sharing a key skip it. The work runs in a pool of
+    ``workers`` threads, as the OpenSSL calls release the GIL.
+
+    Certificates are looked up by id, so that notifications encrypted for a
+    certificate which was rotated out meanwhile are still decrypted.
+    """
+
+    def __init__(
+        self,
+        certificates: typing.Iterable[O365EncryptionCertificate],
+        *,
+        workers: int = 4,
+        cache_size: int = 1024,
+    ):
+        self.certificates = {c.id: c for c in certificates}
+        self.cache_size = cache_size
+        self.stats = O365DecryptStats()
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="O365ContentDecryptor"
+        )
+
+    def add_certificate(self, certificate: O365EncryptionCertificate):
+        self.certificates[certificate.id] = certificate
+
+    def close(self):
+        self._executor.shutdown()
+
+    def _key(self, encrypted: dict) -> bytes:
+        # keys are cached as futures, so that notifications of a batch sharing a
+        # key wait for the one unwrapping it rather than unwrapping it again
+        cache_key = (encrypted.get("encryptionCertificateId"), encrypted["dataKey"])
+        with self._lock:
+            future = self._keys.get(cache_key)
+            if future is not None:
+                self._keys.move_to_end(cache_key)
+                self.stats.key_hits += 1
+                owner = False
+            else:
+                self.stats.key_misses += 1
+                future = self._keys[cache_key] = Future()
+                if len(self._keys) > self.cache_size:
+                    self._keys.popitem(last=False)
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            certificate = self.certificates.get(cache_key[0])
+            if certificate is None:
+                raise ValueError(f"unknown certificate '{cache_key[0]}'")
+            future.set_result(certificate.unwrap(encrypted["dataKey"]))
+        except Exception as e:
+            with self._lock:
+                self._keys.pop(cache_key, None)
+            future.set_exception(e)
+        return future.result()
+
+    def decrypt(self, encrypted: dict) -> dict:
+        """
+        Decrypt the encrypted content of a notification.
+
+        :param encrypted: the encrypted content of the notification
+        :return: the resource data
+        :raises ValueError: if the content can't be verified or decrypted
+        """
+        key = self._key(encrypted)
+        data = base64.b64decode(encrypted["data"])
+        signature = base64.b64decode(encrypted["dataSignature"])
+        if not hmac.compare_digest(
+            hmac.new(key, data, hashlib.sha256).digest(), signature
+        ):
+            raise ValueError("data signature mismatch")
+
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).decryptor()
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        plain = decryptor.update(data) + decryptor.finalize()
+        return json.loads(unpadder.update(plain) + unpadder.finalize())
+
+    def _process(self, notification) -> bool:
+        encrypted = getattr(notification, "encrypted_content", None)
+        if encrypted is None:
+            return True  # nothing to decrypt
+        try:
+            notification.content = self.decrypt(encrypted)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Rejected rich notification: {e}")
+            with self._lock:
+                self.stats.rejected += 1
+            return False
+        with self._lock:
+            self.stats.decrypted += 1
+        return True
+
+    def process(self, notifications: list) -> list:
+        """
+        Decrypt the content of notifications, in parallel.
+
+        :param notifications: the notifications
+        :return: the notifications verified, in order; rejected ones are left out
+        """
+        if len(notifications) == 1:
+            verified = [self._process(notifications[0])]
+        else:
+            verified = list(self._executor.map(self._process, notifications))
+        return [n for n, ok in zip(notifications, verified) if ok]
+
+
+def _b64url(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+class O365TokenValidator:
+    """
+    Verifies the validation tokens Microsoft Graph posts along with rich
+    notifications.
+
+    The data signature of a notification only proves the data was encrypted for
+    the subscriber's certificate, which is public. Validation tokens prove the
+    post comes from Microsoft Graph: they are JWTs signed by the Microsoft identity
+    platform, for the app of the subscriptions, on behalf of the notification
+    publisher. Signing keys are fetched from ``keys_url``, and fetched again when a
+    token is signed by an unknown key, at most once every ``refresh`` seconds.
+    """
+
+    keys_url = "https://login.microsoftonline.com/common/discovery/v2.0/keys"
+    publisher_id = "0bf30f3b-4a52-48df-9a82-234910c4a086"  # the Graph notifier
+
+    def __init__(
+        self,
+        con,
+        *,
+        app_id: str = None,
+        leeway: float = 300,  # in seconds, of clock skew
+        refresh: float = 300,  # in seconds
+    ):
+        """
+        :param con: the connection signing keys are fetched through
+        :param app_id: the app tokens are issued for, defaults to the client id of
+            the connection
+        """
+        self.con = con
+        self.app_id = app_id or con.auth[0]
+        self.leeway = leeway
+        self.refresh = refresh
+        self._keys = {}
+        self._fetched = None
+        self._lock = threading.Lock()
+
+    def _signing_key(self, kid: str):
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is None and (
+                self._fetched is None
+                or time.monotonic() - self._fetched >= self.refresh
+            ):
+                response = self.con.naive_request(self.keys_url, "get")
+                self._keys = {
+                    k["kid"]: rsa.RSAPublicNumbers(
+                        int.from_bytes(_b64url(k["e"]), "big"),
+                        int.from_bytes(_b64url(k["n"]), "big"),
+                    ).public_key()
+                    for k in response.json()["keys"]
+                    if k.get("kty") == "RSA"
+                }
+                self._fetched = time.monotonic()
+                key = self._keys.get(kid)
+        if key is None:
+            raise ValueError(f"unknown signing key '{kid}'")
+        return key
+
+    def validate(self, token: str, tenant_ids: typing.Collection[str]) -> dict:
+        """
+        Verify a validation token.
+
+        :param token: the token
+        :param tenant_ids: the tenants of the notifications posted along
+        :return: the claims of the token
+        :raises ValueError: if the token doesn't verify
+        :raises requests.exceptions.RequestException: if fetching keys failed
+        """
+        try:
+            header_b64, claims_b64, signature_b64 = token.split(".")
+            header = json.loads(_b64url(header_b64))
+            claims = json.loads(_b64url(claims_b64))
+            signature = _b64url(signature_b64)
+            if not (isinstance(header, dict) and isinstance(claims, dict)):
+                raise ValueError
+        except (AttributeError, ValueError):
+            raise ValueError("malformed token") from None
+        if header.get("alg") != "RS256":
+            raise ValueError(f"unexpected algorithm '{header.get('alg')}'")
+
+        key = self._signing_key(header.get("kid"))
+        try:
+            key.verify(
+                signature,
+                f"{header_b64}.{claims_b64}".encode(),
+                asymmetric_padding.PKCS1v15(),
+                hashes.SHA256(),
+            )
+        except InvalidSignature:
+            raise ValueError("token signature mismatch") from None
+
+        now = time.time()
+        if claims.get("exp", 0) + self.leeway < now:
+            raise ValueError("expired token")
+        if claims.get("nbf", 0) - self.leeway > now:
+            raise ValueError("token not valid yet")
+        if claims.get("aud") != self.app_id:
+            raise ValueError(f"token issued for another app '{claims.get('aud')}'")
+        if claims.get("azp", claims.get("appid")) != self.publisher_id:
+            raise ValueError("token issued on behalf of another publisher")
+        tenant_id = claims.get("tid")
+        issuers = (
+            f"https://sts.windows.net/{tenant_id}/",
+            f"https://login.microsoftonline.com/{tenant_id}/v2.0",
+        )
+        if tenant_id not in tenant_ids or claims.get("iss") not in issuers:
+            raise ValueError(f"unexpected token issuer '{claims.get('iss')}'")
+        return claims
+
+    def validate_all(self, tokens: list, tenant_ids: typing.Collection[str]):
+        """
+        Verify the validation tokens of a post, which must all verify.
+
+        :raises ValueError: if a token doesn't verify, or none was posted
+        """
+        if not tokens:
+            raise ValueError("no validation token")
+        for token in tokens:
+            self.validate(token, tenant_ids)
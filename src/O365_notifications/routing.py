@@ -0,0 +1,137 @@
+import itertools
+import typing
+from dataclasses import dataclass
+from enum import Enum
+
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.notifications import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365NotificationHandler,
+)
+
+if typing.TYPE_CHECKING:
+    from O365_notifications.base import O365BaseSubscription
+
+__all__ = ("O365NotificationRouter",)
+
+
+@dataclass(frozen=True)
+class _Route:
+    handler: O365BaseNotificationsHandler
+    subscription: "O365BaseSubscription" = None
+    event: O365EventType = None
+    resource_type: Enum = None
+    notification_type: Enum = None
+
+    def matches(self, notification_type, event, resource_type) -> bool:
+        return (
+            self.notification_type in (None, notification_type)
+            and self.event in (None, event)
+            and self.resource_type in (None, resource_type)
+        )
+
+
+class O365NotificationRouter(O365BaseNotificationsHandler):
+    """
+    Handler dispatching notifications to the handlers of matching routes.
+
+    Routes match on subscription, event type, resource data type and notification
+    type, any of which may be left out as a wildcard. Routes are compiled upon
+    registration into a dispatch table keyed by the notification attributes, so
+    each notification costs a constant number of dict lookups regardless of the
+    number of routes. A notification is sent to the handler of every matching
+    route, in order of registration, or to the default handler if none matches.
+
+    Subscriptions are matched by identity, which renewals preserve.
+    """
+
+    def __init__(
+        self,
+        *,
+        namespace: O365Namespace,
+        default: O365BaseNotificationsHandler = None,
+    ):
+        self.namespace = namespace
+        self.default = default or O365NotificationHandler()
+        self._routes = []
+        self._table = {}
+        self._compile()
+
+    def route(
+        self,
+        handler: O365BaseNotificationsHandler,
+        *,
+        subscription: "O365BaseSubscription" = None,
+        event: O365EventType = None,
+        resource_type: Enum = None,
+        notification_type: Enum = None,
+    ):
+        """
+        Register a handler for the notifications matching a pattern.
+
+        :param handler: the notification's handler
+        :param subscription: the subscription the notification belongs to
+        :param event: the notification event type
+        :param resource_type: the notification resource data type
+        :param notification_type: the notification type
+        """
+        self._routes.append(
+            _Route(
+                handler=handler,
+                subscription=subscription,
+                event=event,
+                resource_type=resource_type,
+                notification_type=notification_type,
+            )
+        )
+        self._compile()
+
+    def _compile(self):
+        ns = self.namespace
+        table = {}
+        keys = itertools.product(
+            ns.O365NotificationType,
+            [None, *O365EventType],
+            [None, *ns.O365ResourceDataType],
+        )
+        for key in keys:
+            routes = [r for r in self._routes if r.matches(*key)]
+            if not routes:
+                continue
+            wildcard = tuple(r.handler for r in routes if r.subscription is None)
+            by_subscription = {}
+            subscriptions = {id(r.subscription): r.subscription for r in routes}
+            subscriptions.pop(id(None), None)
+            for key_id, subscription in subscriptions.items():
+                by_subscription[key_id] = tuple(
+                    r.handler
+                    for r in routes
+                    if r.subscription is None or r.subscription is subscription
+                )
+            table[key] = (by_subscription, wildcard)
+        self._table = table
+
+    def handlers(self, notification: O365BaseNotification) -> tuple:
+        """The handlers a notification is dispatched to."""
+        resource = getattr(notification, "resource", None)
+        key = (
+            notification.type,
+            getattr(notification, "event", None),
+            getattr(resource, "type", None),
+        )
+        entry = self._table.get(key)
+        if entry is None:
+            return (self.default,)
+
+        by_subscription, wildcard = entry
+        if by_subscription:
+            subscription = getattr(notification, "subscription", None)
+            handlers = by_subscription.get(id(subscription), wildcard)
+        else:
+            handlers = wildcard
+        return handlers or (self.default,)
+
+    def process(self, notification: O365BaseNotification):
+        for handler in self.handlers(notification):
+            handler.process(notification)
@@ -0,0 +1,109 @@
+import json
+import re
+import typing
+
+__all__ = ("NotificationStreamDecoder",)
+
+# structural characters outside of a json string
+_STRUCTURAL = re.compile(rb'[{}\[\]"]')
+
+# characters that may terminate (or escape within) a json string
+_STRING_CONTROL = re.compile(rb'["\\]')
+
+_QUOTE, _BACKSLASH = ord('"'), ord("\\")
+_OPENERS = frozenset(b"{[")
+_LBRACKET = ord("[")
+_LBRACE = ord("{")
+
+
+class NotificationStreamDecoder:
+    """
+    Incremental decoder for a GetNotifications response body.
+
+    The response is a single json document whose ``value`` array grows for as long
+    as the connection stays open. Chunks of any size are fed to the decoder, which
+    returns every ``value[]`` element completed so far. Scanning jumps between
+    structural characters with precompiled regexes, so the cost is proportional to
+    the number of braces and quotes rather than to the number of bytes, and braces
+    within string values are never mistaken for object boundaries.
+    """
+
+    def __init__(self, *, loads: typing.Callable[[bytes], typing.Any] = json.loads):
+        self.loads = loads
+        self.done = False  # whether the ``value`` array was closed
+        self._buffer = bytearray()
+        self._pos = 0  # scanning position within the buffer
+        self._stack = bytearray()  # open containers
+        self._in_string = False
+        self._array_depth = None  # depth of the ``value`` array
+        self._start = None  # buffer offset of the element being read
+
+    def feed(self, data: bytes) -> list:
+        """
+        Feed a chunk of the response body.
+
+        :param data: the next chunk of bytes
+        :return: the decoded elements completed by this chunk
+        """
+        return [self.loads(frame) for frame in self.feed_frames(data)]
+
+    def feed_frames(self, data: bytes) -> list[bytes]:
+        """
+        Feed a chunk of the response body without decoding it.
+
+        :param data: the next chunk of bytes
+        :return: the raw json frames of the elements completed by this chunk
+        """
+        if self.done or not data:
+            return []
+
+        buffer, stack, frames = self._buffer, self._stack, []
+        buffer += data
+        pos = self._pos
+        while True:
+            if self._in_string:
+                match = _STRING_CONTROL.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                if buffer[match.start()] == _BACKSLASH:
+                    if match.end() >= len(buffer):
+                        pos = match.start()  # wait for the escaped character
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                continue
+
+            match = _STRUCTURAL.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            char, pos = buffer[match.start()], match.end()
+            if char == _QUOTE:
+                self._in_string = True
+            elif char in _OPENERS:
+                depth = len(stack)
+                if depth == self._array_depth and char == _LBRACE:
+                    self._start = match.start()
+                stack.append(char)
+                if self._array_depth is None and char == _LBRACKET:
+                    self._array_depth = len(stack)
+            elif stack:
+                stack.pop()
+                depth = len(stack)
+                if depth == self._array_depth and self._start is not None:
+                    frames.append(bytes(buffer[self._start : pos]))
+                    self._start = None
+                elif self._array_depth is not None and depth < self._array_depth:
+                    self.done = True
+                    break
+
+        # discard consumed bytes, keeping any partially read element
+        keep = pos if self._start is None else self._start
+        del buffer[:keep]
+        self._pos = pos - keep
+        if self._start is not None:
+            self._start = 0
+        return frames
@@ -1,20 +1,34 @@
-import json
+import functools
+import itertools
 import logging
+import queue
+import threading
+import time
+import typing
+from dataclasses import dataclass
 
 import requests
-from marshmallow import EXCLUDE, fields
 
 from O365_notifications.base import (
     O365BaseNotification,
     O365BaseNotificationsHandler,
     O365BaseSubscription,
-    O365Notification,
+    O365NotificationBatcher,
     O365NotificationHandler,
     O365Subscriber,
 )
+from O365_notifications.dedup import O365DedupFilter, _change_key
+from O365_notifications.notifications import (
+    O365KeepAliveNotification,
+    O365Notification,
+)
+from O365_notifications.stream import NotificationStreamDecoder
+from O365_notifications.utils import backoff_delay, lazy_schema
 
 __all__ = (
     "O365KeepAliveNotification",
+    "O365StreamStats",
+    "O365StreamWatchdog",
     "O365StreamingSubscription",
     "O365StreamingSubscriber",
 )
@@ -22,41 +36,66 @@ __all__ = (
 logger = logging.getLogger(__name__)
 
 
-class O365KeepAliveNotification(O365BaseNotification):
-    status: str
+@dataclass
+class O365StreamStats:
+    """Connections of a streaming, as counted by ``start_streaming``."""
 
-    class O365KeepAliveNotificationSchema(O365BaseNotification.schema):
-        status = fields.Str(data_key="Status")
-
-    schema = O365KeepAliveNotificationSchema  # alias
+    connections: int = 0  # opened
+    errors: int = 0  # broken or dead connections, and failed reconnections
 
 
 class O365StreamingSubscription(O365BaseSubscription):
-    class O365StreamingSubscriptionSchema(O365BaseSubscription.schema):
-        context = fields.Str(data_key="@odata.context", load_only=True)
-        url = fields.Str(data_key="@odata.id", load_only=True)
+    @lazy_schema
+    def schema():
+        from marshmallow import fields
+
+        class O365StreamingSubscriptionSchema(O365BaseSubscription.schema):
+            context = fields.Str(data_key="@odata.context", load_only=True)
+            url = fields.Str(data_key="@odata.id", load_only=True)
 
-    schema = O365StreamingSubscriptionSchema  # alias
+        return O365StreamingSubscriptionSchema
 
 
 class O365StreamingSubscriber(O365Subscriber):
     _endpoints = {
-        "subscriptions": "/subscriptions",
+        **O365Subscriber._endpoints,
         "notifications": "/GetNotifications",
     }
     subscription_cls = O365StreamingSubscription
+    notification_classes = {
+        **O365Subscriber.notification_classes,
+        "KEEP_ALIVE_NOTIFICATION": O365KeepAliveNotification,
+    }
+    reconnect_backoff = 1.0  # in seconds, doubling per failed connection
+    max_reconnect_backoff = 60.0  # in seconds
+    max_pending_chunks = 256  # chunks read ahead of the handler
+    handoff_dedup_capacity = 10000  # notifications remembered across handoffs
+
+    def __init__(self, *, parent=None, con=None, **kwargs):
+        super().__init__(parent=parent, con=con, **kwargs)
+        self._stopping = threading.Event()  # stops the next streaming
+        self._running = []  # events queues and stop events of the streamings
+        self._lock = threading.Lock()
+        self._renewing = threading.Lock()
+        self._renewals = 0  # renewals of expired subscriptions, see _open_stream
 
     def subscription_factory(self, **kwargs) -> O365StreamingSubscription:
         sub_type = self.namespace.O365SubscriptionType.STREAMING_SUBSCRIPTION
         return self.subscription_cls(**{**kwargs, "type": sub_type, "raw": kwargs})
 
-    def notification_factory(self, data) -> O365BaseNotification:
-        opts = {"namespace": self.namespace, "unknown": EXCLUDE}
-        base = O365BaseNotification.deserialize(data, **opts)
-        if base.type == self.namespace.O365NotificationType.NOTIFICATION:
-            return O365Notification.deserialize(data, **opts)
-        elif base.type == self.namespace.O365NotificationType.KEEP_ALIVE_NOTIFICATION:
-            return O365KeepAliveNotification.deserialize(data, **opts)
+    def streaming_request(
+        self,
+        *,
+        connection_timeout: int,
+        keep_alive_interval: int,
+        subscriptions: list[O365StreamingSubscription] = None,
+    ):
+        subscriptions = self.subscriptions if subscriptions is None else subscriptions
+        return {
+            "ConnectionTimeoutInMinutes": connection_timeout,
+            "KeepAliveNotificationIntervalInSeconds": keep_alive_interval,
+            "SubscriptionIds": [s.id for s in subscriptions],
+        }
 
     def start_streaming(
         self,
@@ -65,100 +104,393 @@ class O365StreamingSubscriber(O365Subscriber):
         connection_timeout: int = 120,  # equivalent to 2 hours
         keep_alive_interval: int = 5,  # in seconds
         refresh_after_expire: bool = False,
+        chunk_size: int = None,
+        missed_keep_alives: int = 3,
+        handoff: float = 30,  # in seconds
+        recorder=None,
+        subscriptions: list[O365StreamingSubscription] = None,
+        stats: O365StreamStats = None,
+        stop: threading.Event = None,
     ):
         """
         Start a new streaming connection.
 
+        A watchdog flags the connection as dead once ``missed_keep_alives``
+        keep-alives in a row did not arrive, and a new connection is then opened,
+        after a jittered exponential backoff. With ``refresh_after_expire``, the
+        next connection is opened ``handoff`` seconds before the current one
+        expires, and notifications received on both are delivered once.
+
+        Several streamings may run at once, each on some of the subscriptions, see
+        ``O365StreamPlanner``; they are then handed over notifications concurrently,
+        and can be stopped one at a time through ``stop_streaming(stop)``.
+
         :param notification_handler: the notification's handler
         :param connection_timeout: time in minutes in which connection closes
         :param keep_alive_interval: time interval in seconds in which a message is sent
         :param refresh_after_expire: refresh when http connection expires
+        :param chunk_size: max bytes read at once, defaults to data as it arrives
+        :param missed_keep_alives: keep-alives missed before reconnecting, or 0 to
+            wait on the connection indefinitely
+        :param handoff: overlap in seconds of consecutive connections, or 0 to
+            open the next connection once the current one expired
+        :param recorder: an ``O365StreamRecorder`` recording the streams as read
+        :param subscriptions: the subscriptions to stream, defaults to all of them
+        :param stats: counts the connections of the streaming
+        :param stop: stops this streaming only, once set by ``stop_streaming``
         :raises ValueError: if no subscription is provided
         :raises Exception: if streaming error occurs
         """
-        if not self.subscriptions:
+        if not (self.subscriptions if subscriptions is None else subscriptions):
             raise ValueError("can't start a streaming connection without subscription.")
 
         notification_handler = notification_handler or O365NotificationHandler()
-        url = self.build_url(self._endpoints.get("notifications"))
+        request_schema = self.streaming_request(
+            connection_timeout=connection_timeout,
+            keep_alive_interval=keep_alive_interval,
+            subscriptions=subscriptions,
+        )
+        dead_after = keep_alive_interval * missed_keep_alives or None
+        handoff_after = None
+        if refresh_after_expire and handoff:
+            handoff_after = max(connection_timeout * 60 - handoff, 0)
+        seen = O365DedupFilter(self.handoff_dedup_capacity) if handoff_after else None
 
-        request_schema = {
-            "ConnectionTimeoutInMinutes": connection_timeout,
-            "KeepAliveNotificationIntervalInSeconds": keep_alive_interval,
-            "SubscriptionIds": [s.id for s in self.subscriptions],
-        }
+        events = queue.Queue(maxsize=self.max_pending_chunks)
+        stopping = stop if stop is not None else threading.Event()
+        with self._lock:
+            if self._stopping.is_set():  # stopped before it started
+                self._stopping.clear()
+                stopping.set()
+            self._running.append((events, stopping))
+        batcher = O365NotificationBatcher(notification_handler)
+        instrumentation = self.instrumentation
+        opened = itertools.count()
+        streams = []  # open connections, oldest first
+        failures = 0  # consecutive failed connections
+        handoff_failures = 0  # consecutive failed handoffs
+        handoff_retry = 0.0  # time before which no handoff is attempted
+        reconnect = True
+
+        def open_stream(*, retry: bool) -> typing.Optional[_Stream]:
+            nonlocal failures
+            while True:
+                try:
+                    response = self._open_stream(
+                        request_schema, dead_after, subscriptions
+                    )
+                except requests.exceptions.ConnectionError as e:
+                    if not retry:
+                        raise e
+                    logger.warning(f"Failed reconnecting: {e}")
+                    if stats is not None:
+                        stats.errors += 1
+                    if stopping.wait(self._backoff(failures)):
+                        return None
+                    failures += 1
+                    continue
+                if not response:
+                    return None
+                if stats is not None:
+                    stats.connections += 1
+                if instrumentation is not None:
+                    if next(opened):
+                        instrumentation.reconnected()
+                stream = _Stream(response, dead_after)
+                if recorder is not None:
+                    stream.record = functools.partial(
+                        recorder.chunk, recorder.open_stream(self, request_schema)
+                    )
+                stream.start(events, chunk_size)
+                return stream
 
         logger.info("Open new events channel ...")
+        try:
+            while True:
+                if stopping.is_set():
+                    for item in batcher.flush():
+                        self.deliver(notification_handler, item)
+                    break
+                if not streams:
+                    for item in batcher.flush():
+                        self.deliver(notification_handler, item)
+                    if not reconnect:
+                        break
+                    if failures and stopping.wait(self._backoff(failures - 1)):
+                        continue
+                    stream = open_stream(retry=failures > 0)
+                    if stream is None:
+                        break
+                    streams.append(stream)
+                    reconnect = refresh_after_expire
+
+                now = time.monotonic()
+                timeouts = [s.watchdog.remaining() for s in streams if s.watchdog]
+                if handoff_after is not None and len(streams) == 1:
+                    handoff_at = max(streams[0].opened + handoff_after, handoff_retry)
+                    handoff_in = handoff_at - now
+                    if handoff_in <= 0:
+                        logger.debug("Handing off to a new connection ...")
+                        try:
+                            successor = open_stream(retry=False)
+                        except _HANDOFF_ERRORS as e:
+                            # the current connection is still up, and kept on
+                            logger.warning(f"Failed handing off: {e}")
+                            if stats is not None:
+                                stats.errors += 1
+                            delay = self._backoff(handoff_failures)
+                            handoff_retry = time.monotonic() + delay
+                            handoff_failures += 1
+                            continue
+                        handoff_failures = 0
+                        if successor is None:
+                            handoff_after = None
+                        else:
+                            streams.append(successor)
+                        continue
+                    timeouts.append(handoff_in)
+
+                linger = batcher.remaining()
+                if linger is not None:
+                    timeouts.append(linger)  # release the lingering batch on time
+
+                timeout = max(min(timeouts), 0) if timeouts else None
+                try:
+                    stream, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    stream, payload = None, None
+
+                if stream in streams:
+                    if isinstance(payload, bytes):
+                        if instrumentation is not None:
+                            instrumentation.bytes_read(len(payload))
+                        for frame in stream.decoder.feed_frames(payload):
+                            failures = 0
+                            notification = self.notification_factory(
+                                stream.decoder.loads(frame), frame=frame
+                            )
+                            if instrumentation is not None:
+                                stream.last_keep_alive = _time_keep_alive(
+                                    instrumentation,
+                                    notification,
+                                    stream.last_keep_alive,
+                                )
+                            if seen is not None and _is_duplicate(seen, notification):
+                                continue
+                            for item in batcher.add(notification):
+                                self.deliver(notification_handler, item)
+                        if stream.decoder.done:
+                            payload = _END  # Connection timed out
+                    if payload is _END:
+                        logger.debug("Connection expired.")
+                        stream.close()
+                        streams.remove(stream)
+                    elif isinstance(payload, _SUPPRESSED_ERRORS):
+                        # Seem like empty values in the connection, is causing
+                        # the communication to be corrupted. When that happens,
+                        # the loop is interrupted and the streaming is restarted
+                        logger.warning(f"Exception suppressed: {payload}")
+                        if instrumentation is not None:
+                            instrumentation.error_suppressed(payload)
+                        if stats is not None:
+                            stats.errors += 1
+                        stream.close()
+                        streams.remove(stream)
+                        if isinstance(payload, requests.exceptions.ConnectionError):
+                            failures += 1
+                            reconnect = True  # the connection broke
+                    elif isinstance(payload, Exception):
+                        raise payload
+
+                for item in batcher.poll():
+                    self.deliver(notification_handler, item)
+
+                for stream in [s for s in streams if s.watchdog and s.watchdog.dead]:
+                    logger.warning(f"No keep-alive for {dead_after}s, reconnecting ...")
+                    if stats is not None:
+                        stats.errors += 1
+                    stream.close()
+                    streams.remove(stream)
+                    failures += 1
+                    reconnect = True
+        finally:
+            for stream in streams:
+                stream.close()
+            with self._lock:
+                self._running.remove((events, stopping))
+
+        logger.info("Cancel streaming: connection closed.")
+
+    def stop_streaming(self, stop: threading.Event = None):
+        """
+        Stop the running streamings, or the next one if none is running.
+
+        Safe to call from any thread; batched notifications are handed over before
+        ``start_streaming`` returns.
+
+        :param stop: the ``stop`` event of the streaming to stop, if only that one
+        """
+        with self._lock:
+            if stop is None:
+                running = list(self._running)
+                if not running:
+                    self._stopping.set()
+            else:
+                stop.set()
+                running = [r for r in self._running if r[1] is stop]
+            for _, stopping in running:
+                stopping.set()
+        for events, _ in running:
+            try:
+                events.put_nowait((None, None))  # wakes up the streaming loop
+            except queue.Full:
+                pass  # the loop is busy, and checks for stops in between
+
+    def _open_stream(
+        self,
+        request_schema: dict,
+        read_timeout: float = None,
+        subscriptions: list[O365StreamingSubscription] = None,
+    ):
+        """Open a GetNotifications connection, renewing subscriptions if expired."""
+        url = self.build_url(self._endpoints.get("notifications"))
+        subscriptions = self.subscriptions if subscriptions is None else subscriptions
         while True:
+            # pick up subscription ids swapped by renewals, in place
+            request_schema["SubscriptionIds"] = [s.id for s in subscriptions]
+            renewals = self._renewals
+            kwargs = (
+                {"timeout": (_CONNECT_TIMEOUT, read_timeout)} if read_timeout else {}
+            )
             try:
-                response = self.con.post(url, request_schema, stream=True)
+                response = self.con.post(url, request_schema, stream=True, **kwargs)
                 logger.debug("Start streaming cycle ...")
+                return response
 
             # Renew subscriptions if 404 is raised
             except requests.exceptions.HTTPError as e:
                 if e.response.status_code == requests.codes.not_found:
                     logger.debug("Expired subscription.")
-                    renewed_ids = [s.id for s in self.renew_subscriptions()]
-                    request_schema["SubscriptionIds"] = renewed_ids
+                    with self._renewing:
+                        # renewed once for concurrent streamings expiring together
+                        if self._renewals == renewals:
+                            if self.instrumentation is not None:
+                                self.instrumentation.not_found_renewal()
+                            self.renew_subscriptions()
+                            self._renewals += 1
                     continue
                 # raise for any other error
                 raise e
-            else:
-                if not response:
-                    return
-
-            # Use 'with' clause to prevent requests.exceptions.ChunkedEncodingError.
-            # Exception occurs when connection is closed by the server causing
-            # partially reading the request body.
-            with response:
-                stream_data = b""
-                bracket_control = []
-                for starting_chunk in response.iter_content(chunk_size=1):
-                    # Reading json group values...
-                    if starting_chunk == b"[":
-                        bracket_control.append(starting_chunk)
-                        try:
-                            for chunk in response.iter_content(chunk_size=1):
-                                # Grouping json objects
-                                if chunk == b"{":
-                                    bracket_control.append(chunk)
-                                elif chunk == b"}":
-                                    bracket_control.remove(b"{")
-                                elif chunk == b"]":
-                                    bracket_control.remove(b"[")
-
-                                # Control to see if json object is complete
-                                if b"{" in bracket_control:
-                                    stream_data += chunk
-                                elif b"[" in bracket_control:
-                                    if stream_data:
-                                        stream_data += b"}"
-                                        raw = json.loads(stream_data.decode("utf-8"))
-                                        notification = self.notification_factory(raw)
-                                        notification_handler.process(notification)
-                                        stream_data = b""
-                                else:
-                                    # Break outer loop
-                                    bracket_control.append(True)
-                                    break  # Connection timed out
-
-                        except Exception as e:
-                            if isinstance(e, requests.exceptions.ChunkedEncodingError):
-                                # Seem like empty values in the connection, is causing
-                                # the communication to be corrupted. When that happens,
-                                # the loop is interrupted and the streaming is restarted
-                                logger.warning(f"Exception suppressed: {e}")
-                                break
-                            # raise for any other error
-                            raise e
-                    if bracket_control:
-                        # Break loop since all data is read
-                        break
 
-            # Automatically refresh HTTP connection after it expires
-            if refresh_after_expire:
-                logger.debug("Refreshing connection ...")
-            else:
-                break
+    def _backoff(self, attempt: int) -> float:
+        delay = backoff_delay(
+            attempt, base=self.reconnect_backoff, cap=self.max_reconnect_backoff
+        )
+        logger.info(f"Reconnecting in {delay:.1f}s ...")
+        return delay
 
-        logger.info("Cancel streaming: connection closed.")
+
+# errors breaking a stream, recovered from by opening a new one
+_SUPPRESSED_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+)
+# errors opening a successor connection, retried while the current one is up
+_HANDOFF_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.HTTPError,
+)
+_CONNECT_TIMEOUT = 30  # in seconds
+_END = object()  # end of stream marker
+
+
+def _is_duplicate(seen: O365DedupFilter, notification: O365BaseNotification) -> bool:
+    if not isinstance(notification, O365Notification):
+        return False  # keep-alives
+    return seen.seen(_change_key(notification))
+
+
+def _time_keep_alive(
+    instrumentation, notification: O365BaseNotification, last: typing.Optional[float]
+) -> typing.Optional[float]:
+    """
+    Observe the interval since the last keep-alive of the same connection.
+
+    :return: the time of the last keep-alive of the connection, now or before
+    """
+    if notification.type.name != "KEEP_ALIVE_NOTIFICATION":
+        return last
+    now = time.perf_counter()
+    if last is not None:
+        instrumentation.keep_alive(now - last)
+    return now
+
+
+class O365StreamWatchdog:
+    """
+    Flags a stream as dead once no data arrived for ``timeout`` seconds.
+
+    Keep-alives make sure data arrives at least once per keep-alive interval on a
+    healthy stream. The watchdog can be paused while the reader is held up on
+    purpose, e.g. by a full queue.
+    """
+
+    def __init__(self, timeout: float, clock=time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.paused = False
+        self._last = clock()
+
+    def feed(self):
+        """Record a sign of life."""
+        self._last = self.clock()
+
+    def remaining(self) -> float:
+        """Seconds left before the stream is flagged as dead."""
+        if self.paused:
+            return self.timeout
+        return self._last + self.timeout - self.clock()
+
+    @property
+    def dead(self) -> bool:
+        return self.remaining() <= 0
+
+
+class _Stream:
+    """A GetNotifications connection, read in a thread of its own."""
+
+    def __init__(self, response, dead_after: float = None):
+        self.response = response
+        self.decoder = NotificationStreamDecoder()
+        self.watchdog = O365StreamWatchdog(dead_after) if dead_after else None
+        self.opened = time.monotonic()
+        self.record = None  # records the chunks read, if any
+        self.last_keep_alive = None  # as seen by the instrumentation
+        self._thread = None
+
+    def start(self, events: queue.Queue, chunk_size: int = None):
+        self._thread = threading.Thread(
+            target=self._read, args=(events, chunk_size), name="O365Stream"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, events: queue.Queue, chunk_size: int = None):
+        watchdog, record = self.watchdog, self.record
+        try:
+            for chunk in self.response.iter_content(chunk_size=chunk_size):
+                if record is not None:
+                    record(chunk)
+                if watchdog is not None:
+                    watchdog.feed()
+                    watchdog.paused = True  # waiting on the consumer
+                events.put((self, chunk))
+                if watchdog is not None:
+                    watchdog.paused = False
+                    watchdog.feed()
+            events.put((self, _END))
+        except Exception as e:
+            events.put((self, e))
+
+    def close(self):
+        self.response.close()
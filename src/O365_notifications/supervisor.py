@@ -0,0 +1,479 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+import typing
+from multiprocessing.connection import wait
+
+from O365_notifications.base import (
+    O365BaseNotification,
+    O365BaseNotificationsHandler,
+    O365Notification,
+    _require_synchronous,
+)
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.streaming import (
+    O365KeepAliveNotification,
+    O365StreamingSubscriber,
+)
+from O365_notifications.utils import backoff_delay
+
+__all__ = ("O365HashRing", "O365ShardedSupervisor")
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class O365HashRing:
+    """
+    Consistent hashing of keys over nodes.
+
+    Each node is placed on the ring ``replicas`` times, and a key belongs to the
+    node following it on the ring. Adding or removing a node thus only moves the
+    keys of that node, about ``1 / len(nodes)`` of them.
+    """
+
+    def __init__(self, nodes: typing.Iterable[str] = (), *, replicas: int = 64):
+        self.replicas = replicas
+        self._points = []  # sorted hashes
+        self._nodes = {}  # hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node: str):
+        return _hash(f"{node}#0") in self._nodes
+
+    def __len__(self):
+        return len(self._nodes) // self.replicas
+
+    def add(self, node: str):
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node: str):
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            if self._nodes.pop(point, None) is not None:
+                self._points.remove(point)
+
+    def node_for(self, key: str) -> typing.Optional[str]:
+        """The node a key belongs to, or None if the ring is empty."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+def _pack(notification: O365BaseNotification) -> tuple:
+    """A picklable record of a notification; namespace enums are not picklable."""
+    raw = notification.raw if isinstance(notification.raw, bytes) else None
+    if not isinstance(notification, O365Notification):
+        return (notification.type.name, raw)
+    resource = notification.resource
+    return (
+        notification.type.name,
+        raw,
+        notification.id,
+        notification.subscription_id,
+        notification.subscription_expire,
+        notification.sequence,
+        notification.event.value,
+        resource.type.name,
+        resource.url,
+        resource.etag,
+        resource.id,
+    )
+
+
+def _unpack(record: tuple, namespace: O365Namespace) -> O365BaseNotification:
+    notification_type = namespace.O365NotificationType[record[0]]
+    if len(record) == 2:
+        return O365KeepAliveNotification(raw=record[1], type=notification_type)
+    raw, id, subscription_id, expire, sequence, event = record[1:7]
+    return O365Notification(
+        raw=raw,
+        type=notification_type,
+        id=id,
+        subscription_id=subscription_id,
+        subscription_expire=expire,
+        sequence=sequence,
+        event=O365EventType(event),
+        resource=O365Notification.O365ResourceData(
+            namespace.O365ResourceDataType[record[7]], *record[8:]
+        ),
+    )
+
+
+class _Forwarder(O365BaseNotificationsHandler):
+    """Worker-side handler sending notifications to the supervisor in batches."""
+
+    def __init__(self, conn, *, batch_size: int, linger: float):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.linger = linger
+        self._batch = []
+        self._base = None
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="O365Forwarder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def process(self, notification: O365BaseNotification):
+        record = _pack(notification)
+        with self._cond:
+            self._base = notification.type.value.rsplit(".", 1)[0]
+            self._batch.append(record)
+            if len(self._batch) in (1, self.batch_size):
+                self._cond.notify()  # a batch to linger on, or a full one
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._batch)
+                self._cond.wait_for(
+                    lambda: len(self._batch) >= self.batch_size, self.linger
+                )
+            self.flush()
+
+    def flush(self):
+        """Send the pending notifications now."""
+        with self._send_lock:
+            with self._cond:
+                batch, self._batch = self._batch, []
+            if batch:
+                self.conn.send((self._base, batch))  # pickled once per batch
+
+
+class _Mailbox:
+    """A mailbox streamed by a worker, in a thread of its own."""
+
+    def __init__(self, main_resource: str, factory, forwarder, stream_kwargs: dict):
+        self.main_resource = main_resource
+        self.factory = factory
+        self.forwarder = forwarder
+        self.stream_kwargs = stream_kwargs
+        self.removed = threading.Event()
+        self.subscriber = None
+        self.thread = threading.Thread(
+            target=self._run, name=f"O365Mailbox-{main_resource}"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        failures = 0
+        while not self.removed.is_set():
+            try:
+                if self.subscriber is None:
+                    subscriber = self.factory(self.main_resource)
+                    _require_synchronous(subscriber, "O365ShardedSupervisor")
+                    self.subscriber = subscriber
+                if self.removed.is_set():
+                    break
+                self.subscriber.start_streaming(
+                    notification_handler=self.forwarder, **self.stream_kwargs
+                )
+                self.removed.wait()  # the stream ended, as configured
+                break
+            except Exception:
+                logger.exception(f"Streaming '{self.main_resource}' failed.")
+                if self.removed.wait(backoff_delay(failures)):
+                    break
+                failures += 1
+        self._unsubscribe()
+
+    def remove(self):
+        self.removed.set()
+        if self.subscriber is not None:
+            self.subscriber.stop_streaming()
+
+    def _unsubscribe(self):
+        """Leave the mailbox to its new owner, best effort."""
+        if self.subscriber is None or not self.removed.is_set():
+            return
+        for subscription in list(self.subscriber.subscriptions):
+            try:
+                self.subscriber.unsubscribe(subscription)
+            except Exception as e:
+                logger.warning(f"Failed unsubscribing '{self.main_resource}': {e}")
+
+
+def _work(conn, factory, stream_kwargs: dict, batch_size: int, linger: float):
+    """Worker process: streams the mailboxes it is told to own."""
+    forwarder = _Forwarder(conn, batch_size=batch_size, linger=linger)
+    mailboxes = {}
+    while True:
+        try:
+            command, main_resource = conn.recv()
+        except EOFError:
+            command = "stop"  # the supervisor is gone
+        if command == "add" and main_resource not in mailboxes:
+            mailboxes[main_resource] = _Mailbox(
+                main_resource, factory, forwarder, stream_kwargs
+            )
+        elif command == "remove" and main_resource in mailboxes:
+            mailboxes.pop(main_resource).remove()
+        elif command == "stop":
+            for mailbox in mailboxes.values():
+                mailbox.remove()
+            for mailbox in mailboxes.values():
+                mailbox.thread.join()
+            forwarder.flush()
+            return
+
+
+class _Worker:
+    def __init__(self, name: str, process, conn):
+        self.name = name
+        self.process = process
+        self.conn = conn
+        self.deaths = 0  # in a row
+
+
+class O365ShardedSupervisor:
+    """
+    Streams many mailboxes across a pool of worker processes.
+
+    Mailboxes (``main_resource``) are spread over the workers by consistent
+    hashing. Each worker builds the subscriber of the mailboxes it owns with
+    ``subscriber_factory`` - which must subscribe it to its resources - and
+    streams them, decoding notifications off the GIL of other workers. Decoded
+    notifications are forwarded to the supervisor in batches over pipes, and
+    handed over to ``handler`` in the supervisor process. When a worker dies, its
+    mailboxes move to the other workers until it is restarted; adding or removing
+    mailboxes only moves those.
+
+    ``subscriber_factory`` is called in the worker processes, so it must be
+    picklable, e.g. a module level function. Forwarded notifications keep their
+    raw payload only as json bytes (``O365KeepRaw.BYTES``), and are not linked to
+    their subscription, which lives in the worker. A mailbox moving between
+    workers may briefly be streamed twice, so handlers should be idempotent, e.g.
+    wrapped in an ``O365DedupHandler``.
+
+    Usage::
+
+        def subscriber_factory(main_resource):
+            account = O365.Account(..., main_resource=main_resource)
+            subscriber = O365StreamingSubscriber(parent=account)
+            subscriber.subscribe(resource=..., events=...)
+            return subscriber
+
+        with O365ShardedSupervisor(subscriber_factory, handler, workers=8) as sup:
+            sup.add(*mailboxes)
+            sup.join()
+    """
+
+    def __init__(
+        self,
+        subscriber_factory: typing.Callable[[str], O365StreamingSubscriber],
+        handler: O365BaseNotificationsHandler,
+        *,
+        workers: int = None,
+        replicas: int = 64,
+        stream_kwargs: dict = None,
+        batch_size: int = 256,  # notifications forwarded at once
+        linger: float = 0.01,  # seconds a batch waits to be filled
+        restart_delay: float = 1.0,  # in seconds, doubling per death in a row
+        context: str = "spawn",
+    ):
+        self.subscriber_factory = subscriber_factory
+        self.handler = handler
+        self.workers = workers or multiprocessing.cpu_count()
+        self.stream_kwargs = {"refresh_after_expire": True, **(stream_kwargs or {})}
+        self.batch_size = batch_size
+        self.linger = linger
+        self.restart_delay = restart_delay
+        self.ring = O365HashRing(replicas=replicas)
+        self.mailboxes = set()
+        self._context = multiprocessing.get_context(context)
+        self._workers = {}  # name -> _Worker, alive
+        self._restarts = {}  # name -> (due time, deaths)
+        self._owners = {}  # main_resource -> worker name
+        self._lock = threading.RLock()
+        self._stopping = False
+        self._wakeup_r, self._wakeup_w = self._context.Pipe(duplex=False)
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        """Start the workers, and receive notifications in a background thread."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            for i in range(self.workers):
+                self._spawn(f"worker-{i}")
+        self._thread = threading.Thread(target=self._run, name="O365Supervisor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop the workers, handing over the notifications they forwarded."""
+        with self._lock:
+            self._stopping = True
+            self._restarts.clear()
+            for worker in self._workers.values():
+                self._send(worker, "stop")
+        self._wakeup_w.send(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        for worker in list(self._workers.values()):
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+
+    def join(self, timeout: float = None):
+        """Wait for the supervisor to stop."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def add(self, *main_resources: str):
+        """Stream more mailboxes."""
+        with self._lock:
+            self.mailboxes.update(main_resources)
+            self._rebalance()
+
+    def remove(self, *main_resources: str):
+        """Stop streaming some mailboxes."""
+        with self._lock:
+            self.mailboxes.difference_update(main_resources)
+            self._rebalance()
+
+    def assignments(self) -> dict[str, list[str]]:
+        """The mailboxes owned by each worker alive."""
+        with self._lock:
+            owned = {name: [] for name in self._workers}
+            for main_resource, name in self._owners.items():
+                owned[name].append(main_resource)
+        return owned
+
+    def _spawn(self, name: str):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_work,
+            args=(
+                child_conn,
+                self.subscriber_factory,
+                self.stream_kwargs,
+                self.batch_size,
+                self.linger,
+            ),
+            name=f"O365Supervisor-{name}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self._workers[name] = _Worker(name, process, conn)
+        self.ring.add(name)
+        logger.info(f"Started {name} (pid {process.pid}).")
+
+    def _send(self, worker: _Worker, command: str, main_resource: str = None):
+        try:
+            worker.conn.send((command, main_resource))
+        except (BrokenPipeError, OSError):
+            pass  # the worker died, and is handled as such
+
+    def _rebalance(self):
+        """Move mailboxes to the workers they hash to."""
+        for main_resource in list(self._owners):
+            if main_resource not in self.mailboxes:
+                worker = self._workers.get(self._owners.pop(main_resource))
+                if worker is not None:
+                    self._send(worker, "remove", main_resource)
+        for main_resource in self.mailboxes:
+            target = self.ring.node_for(main_resource)
+            owner = self._owners.get(main_resource)
+            if target is None or target == owner:
+                continue
+            if owner in self._workers:
+                self._send(self._workers[owner], "remove", main_resource)
+            self._send(self._workers[target], "add", main_resource)
+            self._owners[main_resource] = target
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopping and not self._workers:
+                    return
+                workers = {w.conn: w for w in self._workers.values()}
+                sentinels = {w.process.sentinel: w for w in self._workers.values()}
+                due = [t for t, _ in self._restarts.values()]
+            timeout = max(min(due) - time.monotonic(), 0) if due else None
+            ready = wait([self._wakeup_r, *workers, *sentinels], timeout)
+
+            for conn in ready:
+                if conn is self._wakeup_r:
+                    conn.recv()
+                elif conn in workers:
+                    try:
+                        base, batch = conn.recv()
+                    except (EOFError, OSError):
+                        continue  # the sentinel tells the worker died
+                    workers[conn].deaths = 0
+                    self._deliver(O365Namespace(base), batch)
+            for sentinel in ready:
+                if sentinel in sentinels:
+                    self._died(sentinels[sentinel])
+            self._restart_due()
+
+    def _deliver(self, namespace: O365Namespace, batch: list):
+        notifications = [_unpack(record, namespace) for record in batch]
+        if self.handler.max_batch_size > 1:
+            size = self.handler.max_batch_size
+            for i in range(0, len(notifications), size):
+                self.handler.process_batch(notifications[i : i + size])
+        else:
+            for notification in notifications:
+                self.handler.process(notification)
+
+    def _died(self, worker: _Worker):
+        # hand over what the worker forwarded before dying
+        try:
+            while worker.conn.poll():
+                base, batch = worker.conn.recv()
+                self._deliver(O365Namespace(base), batch)
+        except (EOFError, OSError):
+            pass
+        with self._lock:
+            del self._workers[worker.name]
+            self.ring.remove(worker.name)
+            for main_resource, name in list(self._owners.items()):
+                if name == worker.name:
+                    del self._owners[main_resource]
+            worker.conn.close()
+            if self._stopping:
+                return
+            worker.process.join(1)
+            code = worker.process.exitcode
+            delay = backoff_delay(worker.deaths, base=self.restart_delay)
+            logger.warning(
+                f"{worker.name} died (exit code {code}), restarting in {delay:.1f}s."
+            )
+            self._restarts[worker.name] = (time.monotonic() + delay, worker.deaths + 1)
+            self._rebalance()
+
+    def _restart_due(self):
+        with self._lock:
+            now = time.monotonic()
+            for name, (due, deaths) in list(self._restarts.items()):
+                if due <= now and not self._stopping:
+                    del self._restarts[name]
+                    self._spawn(name)
+                    self._workers[name].deaths = deaths
+                    self._rebalance()
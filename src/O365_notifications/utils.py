@@ -1,12 +1,24 @@
+import datetime
+import json
+import random
+import re
+import sys
+import threading
 import typing
 from dataclasses import dataclass, fields
 
-import O365.mailbox
-from marshmallow import Schema, post_load
+if typing.TYPE_CHECKING:
+    from marshmallow import Schema
+    from O365.utils import ApiComponent
 
+# fractional seconds beyond microsecond precision
+_ISO_FRACTION = re.compile(r"(\.\d{6})\d+")
 
-def build_url(resource: O365.utils.ApiComponent) -> typing.Optional[str]:
-    if isinstance(resource, O365.mailbox.Folder):
+
+def build_url(resource: "ApiComponent") -> typing.Optional[str]:
+    # a resource can't be a folder unless 'O365.mailbox' was imported already
+    mailbox = sys.modules.get("O365.mailbox")
+    if mailbox is not None and isinstance(resource, mailbox.Folder):
         folder = resource
         endpoints = folder._endpoints
         return folder.build_url(
@@ -19,25 +31,107 @@ def build_url(resource: O365.utils.ApiComponent) -> typing.Optional[str]:
     return None
 
 
+def parse_datetime(value: str) -> datetime.datetime:
+    """Parse the ISO 8601 datetime strings sent by the O365 APIs."""
+    if value.endswith("Z"):
+        value = f"{value[:-1]}+00:00"
+    return datetime.datetime.fromisoformat(_ISO_FRACTION.sub(r"\1", value))
+
+
+def slotted(cls):
+    """
+    Rebuild a dataclass with ``__slots__`` for its fields.
+
+    Backport of ``dataclass(slots=True)``, only available from python 3.10. Fields
+    already slotted by a base class are left out.
+    """
+    inherited = {
+        name for base in cls.__mro__[1:] for name in getattr(base, "__slots__", ())
+    }
+    names = tuple(f.name for f in fields(cls) if f.name not in inherited)
+    cls_dict = dict(cls.__dict__)
+    for name in ("__dict__", "__weakref__", *names):
+        cls_dict.pop(name, None)  # defaults live on __init__
+    cls_dict["__slots__"] = names
+    slotted_cls = type(cls)(cls.__name__, cls.__bases__, cls_dict)
+    slotted_cls.__qualname__ = cls.__qualname__
+    return slotted_cls
+
+
+def backoff_delay(attempt: int, *, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Exponential backoff delay with full jitter.
+
+    :param attempt: the number of attempts failed so far, from 0
+    :param base: the delay bound of the first attempt, in seconds
+    :param cap: the max delay, in seconds
+    :return: a random delay, in seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+
+
+class lazy_schema:
+    """
+    Class attribute holding a schema class, built on first access.
+
+    Keeps ``marshmallow`` and the building of schemas off the import of the classes
+    they (de)serialize. ``build`` takes no argument and returns the schema class; it
+    runs once, and subclasses not declaring a schema of their own share it::
+
+        @lazy_schema
+        def schema():
+            from marshmallow import fields
+
+            class FooSchema(Base.schema):
+                foo = fields.Str(data_key="Foo")
+
+            return FooSchema
+    """
+
+    def __init__(self, build: typing.Callable[[], type]):
+        self.build = build
+        self.schema = None
+        self._lock = threading.Lock()
+
+    def __get__(self, obj, owner) -> type:
+        if self.schema is None:
+            with self._lock:
+                if self.schema is None:
+                    self.schema = self.build()
+        return self.schema
+
+
+@slotted
 @dataclass
 class DeserializerMixin:
-    raw: dict
+    raw: typing.Union[dict, bytes, None]  # as received, as json bytes, or dropped
+
+    @lazy_schema
+    def schema():
+        from marshmallow import Schema, post_load
+
+        class DeserializerSchema(Schema):
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                for f in self.declared_fields.values():
+                    f.load_only = True
 
-    class DeserializerSchema(Schema):
-        def __init__(self, **kwargs):
-            super().__init__(**kwargs)
-            for f in self.declared_fields.values():
-                f.load_only = True
+            @post_load(pass_original=True)
+            def include_raw_field(self, data, original_data, **_):
+                data["raw"] = original_data
+                return data
 
-        @post_load(pass_original=True)
-        def include_raw_field(self, data, original_data, **_):
-            data["raw"] = original_data
-            return data
+        return DeserializerSchema
 
-    schema = DeserializerSchema  # alias
+    def payload(self) -> typing.Optional[dict]:
+        """The raw payload, parsed if kept as json bytes."""
+        if isinstance(self.raw, (bytes, bytearray)):
+            return json.loads(self.raw)
+        return self.raw
 
     @classmethod
-    def deserialize(cls, data: dict, **kwargs):
+    def deserialize(cls, data: dict, *, schema: "Schema" = None, **kwargs):
         cls_fields = [f.name for f in fields(cls)]
-        loaded_fields = cls.schema(**kwargs).load(data)
+        schema = schema if schema is not None else cls.schema(**kwargs)
+        loaded_fields = schema.load(data)
         return cls(**{k: v for k, v in loaded_fields.items() if k in cls_fields})
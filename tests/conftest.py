@@ -1,6 +1,16 @@
+import json
+import threading
+
 import pytest
 from O365.utils import BaseTokenBackend
 
+from O365_notifications.constants import O365EventType
+from O365_notifications.notifications import (
+    O365BaseNotificationsHandler,
+    O365KeepAliveNotification,
+    O365Notification,
+)
+
 
 class TestBackend(BaseTokenBackend):
     def save_token(self):
@@ -25,3 +35,163 @@ class TestBackend(BaseTokenBackend):
 @pytest.fixture(scope="session")
 def backend():
     return TestBackend()
+
+
+def notification_payload(
+    ns,
+    sequence=1,
+    *,
+    subscription_id="1234",
+    event=O365EventType.CREATED,
+    resource_id=None,
+    resource_type=None,
+    etag="XYZ000",
+    url=None,
+    expiration="2030-01-01T10:00:00Z",
+):
+    """A notification as streamed, about the message of id ``sequence`` by default."""
+    resource_id = str(sequence) if resource_id is None else resource_id
+    resource_type = resource_type or ns.O365ResourceDataType.MESSAGE
+    url = url or f"https://graph.microsoft.com/beta/Messages('{resource_id}')"
+    return {
+        "@odata.type": ns.O365NotificationType.NOTIFICATION.value,
+        "Id": "null",
+        "SubscriptionId": subscription_id,
+        "SubscriptionExpirationDateTime": expiration,
+        "SequenceNumber": sequence,
+        "ChangeType": event.value,
+        "ResourceData": {
+            "@odata.type": resource_type.value,
+            "@odata.id": url,
+            "@odata.etag": etag,
+            "Id": resource_id,
+        },
+    }
+
+
+def keep_alive_payload(ns):
+    return {
+        "@odata.type": ns.O365NotificationType.KEEP_ALIVE_NOTIFICATION.value,
+        "Status": "OK",
+    }
+
+
+def graph_payload(message_id, *, client_state="secret", **extra):
+    """A change notification as posted by Microsoft Graph."""
+    return {
+        "subscriptionId": "ABC",
+        "subscriptionExpirationDateTime": "2030-01-01T10:00:00Z",
+        "changeType": "created",
+        "resource": f"Users/foo/Messages/{message_id}",
+        "clientState": client_state,
+        "tenantId": "foo",
+        "resourceData": {
+            "@odata.type": "#Microsoft.Graph.Message",
+            "@odata.id": f"Users/foo/Messages/{message_id}",
+            "@odata.etag": 'W/"XYZ000"',
+            "id": str(message_id),
+        },
+        **extra,
+    }
+
+
+def notification(ns, sequence=1, **kwargs) -> O365Notification:
+    """A notification built from ``notification_payload``."""
+    payload = notification_payload(ns, sequence, **kwargs)
+    return O365Notification.fast_deserialize(payload, namespace=ns)
+
+
+def keep_alive(ns) -> O365KeepAliveNotification:
+    return O365KeepAliveNotification.fast_deserialize(
+        keep_alive_payload(ns), namespace=ns
+    )
+
+
+class FakeResponse:
+    """
+    A response of json data, streamed in chunks ``pause`` seconds apart.
+
+    With ``stall``, the stream stalls before its closing bracket until closed, as
+    ``requests`` fails then, or until ``expire`` seconds passed.
+    """
+
+    def __init__(self, data, *, chunk_size=None, pause=0, stall=False, expire=None):
+        self.data = data
+        self.body = json.dumps(data).encode()
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.stall = stall
+        self.expire = expire
+        self.closed = threading.Event()
+
+    def __bool__(self):
+        return True
+
+    def json(self):
+        return self.data
+
+    def iter_content(self, chunk_size=None):
+        tail = self.body.rindex(b"]") if self.stall else len(self.body)
+        step = self.chunk_size or tail
+        for i in range(0, tail, step):
+            if i and self.closed.wait(self.pause):
+                return
+            yield self.body[i : min(i + step, tail)]
+        if not self.stall:
+            return
+        if self.closed.wait(self.expire):
+            raise AttributeError("'NoneType' object has no attribute 'read'")
+        yield self.body[tail:]
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeStream(FakeResponse):
+    """A GetNotifications response streaming the given elements."""
+
+    def __init__(self, elements, **kwargs):
+        super().__init__({"value": elements}, **kwargs)
+
+
+class FakeConnection:
+    """Answers posts with the given responses in turn, raising the exceptions."""
+
+    def __init__(self, responses=()):
+        self.responses = iter(responses)
+        self.requests = []
+
+    def respond(self, url, data):
+        return next(self.responses, None)
+
+    def post(self, url, data=None, **kwargs):
+        self.requests.append({**kwargs, "url": url, "data": data})
+        response = self.respond(url, data)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def delete(self, url, **kwargs):
+        pass
+
+
+class CollectingHandler(O365BaseNotificationsHandler):
+    """Collects the notifications handed over, to be waited for."""
+
+    def __init__(self):
+        self.notifications = []
+        self.cond = threading.Condition()
+
+    def process(self, notification):
+        with self.cond:
+            self.notifications.append(notification)
+            self.cond.notify_all()
+
+    @property
+    def sequences(self) -> list:
+        """The sequence numbers of the notifications, keep-alives aside."""
+        return [n.sequence for n in self.notifications if n.type.name == "NOTIFICATION"]
+
+    def wait_for(self, count: int, timeout: float = 5) -> bool:
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.notifications) >= count, timeout)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+import pytest
+from O365 import Account, MSGraphProtocol, MSOffice365Protocol
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.push import (
+    O365PushNotification,
+    O365PushReceiver,
+    O365PushSubscriber,
+)
+from tests.conftest import CollectingHandler, graph_payload, notification_payload
+
+
+@pytest.fixture
+def account(backend):
+    return Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSOffice365Protocol(api_version="beta"),
+        token_backend=backend,
+    )
+
+
+@pytest.fixture
+def subscriber(account):
+    return O365PushSubscriber(
+        parent=account,
+        notification_url="https://foo.bar/notifications",
+        client_state="secret",
+    )
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def serve(app):
+        httpd = make_server("127.0.0.1", 0, app, handler_class=QuietHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return f"http://127.0.0.1:{httpd.server_port}"
+
+    yield serve
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def post(url, body=b"", headers=None):
+    request = urllib.request.Request(
+        url, data=body, headers=headers or {}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, ""
+
+
+def notification(ns, sequence):
+    """A notification as posted by Outlook, the client state sent as a header."""
+    url = "https://outlook.office.com/api/beta/Users('foo')/Messages('XYZ')"
+    payload = notification_payload(
+        ns,
+        sequence,
+        subscription_id="ABC",
+        resource_id="XYZ",
+        url=url,
+        expiration=datetime.now().isoformat(),
+    )
+    return {**payload, "Id": None, "Resource": url}
+
+
+class TestPushSubscriber:
+    def test_subscribe(self, account, subscriber, requests_mock):
+        base_url = f"{subscriber.protocol.service_url}{subscriber.main_resource}"
+        sub_type = subscriber.namespace.O365SubscriptionType.PUSH_SUBSCRIPTION
+        requests_mock.register_uri(
+            "POST",
+            f"{base_url}/subscriptions",
+            json={
+                "@odata.type": sub_type.value,
+                "Id": "ABC",
+                "Resource": f"{base_url}/me/mailfolders('inbox')/Messages",
+                "ChangeType": O365EventType.CREATED.value,
+                "NotificationURL": subscriber.notification_url,
+                "ClientState": subscriber.client_state,
+                "SubscriptionExpirationDateTime": "2023-01-01T10:00:00Z",
+            },
+        )
+        inbox = account.mailbox().inbox_folder()
+        subscription = subscriber.subscribe(
+            resource=inbox, events=[O365EventType.CREATED]
+        )
+
+        request = requests_mock.last_request.json()
+        assert request["@odata.type"] == sub_type.value
+        assert request["NotificationURL"] == subscriber.notification_url
+        assert request["ClientState"] == "secret"
+        assert subscription.id == "ABC"
+        assert subscription.client_state == "secret"
+        assert subscription.expiration.year == 2023
+
+    def test_subscribe_graph(self, account, requests_mock):
+        account.protocol = MSGraphProtocol(api_version="beta")
+        subscriber = O365PushSubscriber(
+            parent=account,
+            notification_url="https://foo.bar/notifications",
+            client_state="secret",
+        )
+        url = f"{subscriber.protocol.service_url}subscriptions"
+        resource = "users/foo@bar.com/mailFolders/Inbox/messages"
+        graph_subscription = {
+            "@odata.context": "$metadata#subscriptions/$entity",
+            "id": "ABC",
+            "resource": resource,
+            "applicationId": "app",
+            "changeType": "created,deleted",
+            "clientState": "secret",
+            "notificationUrl": subscriber.notification_url,
+            "expirationDateTime": "2030-01-01T10:00:00Z",
+            "creatorId": "foo",
+            "latestSupportedTlsVersion": "v1_2",
+        }
+        requests_mock.post(url, json=graph_subscription)
+        renewed = {**graph_subscription, "expirationDateTime": "2030-01-03T10:00:00Z"}
+        patch = requests_mock.patch(f"{url}/ABC", json=renewed)
+
+        subscription = subscriber.subscribe(
+            resource=account.mailbox().inbox_folder(),
+            events=[O365EventType.CREATED, O365EventType.DELETED],
+        )
+        request = requests_mock.request_history[0].json()
+        assert request["changeType"] == "created,deleted"
+        assert request["notificationUrl"] == subscriber.notification_url
+        assert request["clientState"] == "secret"
+        assert request["resource"] == resource
+        assert datetime.fromisoformat(request["expirationDateTime"]) > datetime.now(
+            timezone.utc
+        )
+        assert "@odata.type" not in request
+        assert subscription.id == "ABC"
+        assert subscription.events == [O365EventType.CREATED, O365EventType.DELETED]
+        assert subscription.expiration.year == 2030
+
+        subscription = subscriber.renew_subscription(subscription)
+        assert list(patch.last_request.json()) == ["expirationDateTime"]
+        assert subscription.expiration.day == 3
+
+
+class TestPushReceiver:
+    def test_validation(self, subscriber, server):
+        with O365PushReceiver(subscriber) as receiver:
+            url = server(receiver)
+            assert post(f"{url}/?validationtoken=Abc123") == (200, "Abc123")
+            assert post(f"{url}/?validationToken=Abc123") == (200, "Abc123")
+
+    def test_notifications(self, subscriber, server):
+        ns = subscriber.namespace
+        handler = CollectingHandler()
+        with O365PushReceiver(subscriber, handler) as receiver:
+            url = server(receiver)
+            for client_state, sequences in [
+                ("secret", [1]),
+                ("forged", [2]),
+                ("secret", [3]),
+            ]:
+                body = {"value": [notification(ns, i) for i in sequences]}
+                headers = {"ClientState": client_state}
+                assert post(url, json.dumps(body).encode(), headers) == (202, "")
+            assert handler.wait_for(2)
+
+        assert [n.sequence for n in handler.notifications] == [1, 3]
+        assert all(type(n) is O365PushNotification for n in handler.notifications)
+
+    def test_graph_notifications(self, account, server):
+        account.protocol = MSGraphProtocol(api_version="beta")
+        subscriber = O365PushSubscriber(
+            parent=account,
+            notification_url="https://foo.bar/notifications",
+            client_state="secret",
+        )
+        handler = CollectingHandler()
+        with O365PushReceiver(subscriber, handler) as receiver:
+            url = server(receiver)
+            body = {
+                "validationTokens": ["eyJ0eXAiOiJKV1Qi"],
+                "value": [
+                    graph_payload("A", client_state="secret"),
+                    graph_payload("B", client_state="forged"),
+                    {
+                        "subscriptionId": "ABC",
+                        "lifecycleEvent": "reauthorizationRequired",
+                        "clientState": "secret",
+                        "tenantId": "foo",
+                    },
+                    graph_payload("C", client_state="secret"),
+                ],
+            }
+            assert post(url, json.dumps(body).encode()) == (202, "")
+            assert handler.wait_for(2)
+
+        notifications = handler.notifications
+        assert [n.resource.id for n in notifications] == ["A", "C"]
+        assert notifications[0].event is O365EventType.CREATED
+        assert notifications[0].sequence is None
+        assert notifications[0].raw["clientState"] == "secret"  # as received
+
+    def test_asgi(self, subscriber):
+        ns = subscriber.namespace
+        handler = CollectingHandler()
+        receiver = O365PushReceiver(subscriber, handler)
+
+        async def request(client_state, sequence):
+            body = json.dumps({"value": [notification(ns, sequence)]}).encode()
+            scope = {
+                "type": "http",
+                "method": "POST",
+                "query_string": b"",
+                "headers": [(b"clientstate", client_state.encode())],
+            }
+            messages = [{"type": "http.request", "body": body}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await receiver.asgi(scope, receive, send)
+            return sent[0]["status"]
+
+        with receiver:
+            assert asyncio.run(request("forged", 1)) == 202
+            assert asyncio.run(request("secret", 2)) == 202
+            assert handler.wait_for(1)
+        assert [n.sequence for n in handler.notifications] == [2]
+
+    def test_bad_requests(self, subscriber, server):
+        with O365PushReceiver(subscriber) as receiver:
+            url = server(receiver)
+            assert post(url, b"not json")[0] == 400
+            assert post(url, b'{"value": [{"Id": 1}')[0] == 400
+            assert post(url, b'{"value": [1]}')[0] == 400
+            assert post(url, b'{"values": []}')[0] == 400
+
+    def test_backlog_full(self, subscriber):
+        receiver = O365PushReceiver(subscriber, max_backlog=1)
+        assert receiver.accept("POST", "", b'{"value": []}') == (202, "")
+        assert receiver.accept("POST", "", b'{"value": []}') == (503, "")
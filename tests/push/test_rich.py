@@ -0,0 +1,220 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import pytest
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.push import O365PushReceiver, O365PushSubscriber
+from tests.conftest import CollectingHandler, graph_payload
+
+pytest.importorskip("cryptography")
+
+from cryptography.hazmat.primitives import hashes, padding  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import (  # noqa: E402
+    padding as asymmetric_padding,
+)
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from cryptography.hazmat.primitives.ciphers import (  # noqa: E402
+    Cipher,
+    algorithms,
+    modes,
+)
+
+from O365_notifications.rich import (  # noqa: E402
+    O365EncryptionCertificate,
+    O365RichNotification,
+    O365TokenValidator,
+)
+
+
+@pytest.fixture(scope="module")
+def certificate():
+    return O365EncryptionCertificate.generate(id="cert-1")
+
+
+@pytest.fixture
+def subscriber(backend, certificate):
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+    return O365PushSubscriber(
+        parent=account,
+        notification_url="https://foo.bar/notifications",
+        client_state="secret",
+        certificate=certificate,
+    )
+
+
+@pytest.fixture(scope="module")
+def signing_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def signing_keys(signing_key, requests_mock):
+    """The signing keys of the identity platform, as published."""
+    numbers = signing_key.public_key().public_numbers()
+
+    def b64(number):
+        raw = number.to_bytes((number.bit_length() + 7) // 8, "big")
+        return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+    key = {"kty": "RSA", "kid": "k1", "e": b64(numbers.e), "n": b64(numbers.n)}
+    return requests_mock.get(O365TokenValidator.keys_url, json={"keys": [key]})
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def validation_token(signing_key, **claims) -> str:
+    """A validation token, as issued along with rich notifications."""
+    header = {"typ": "JWT", "alg": "RS256", "kid": "k1"}
+    claims = {
+        "aud": "user",  # the client id of the account
+        "iss": "https://sts.windows.net/foo/",
+        "tid": "foo",
+        "azp": O365TokenValidator.publisher_id,
+        "nbf": time.time() - 60,
+        "exp": time.time() + 3600,
+        **claims,
+    }
+    signed = ".".join(b64url(json.dumps(part).encode()) for part in (header, claims))
+    signature = signing_key.sign(
+        signed.encode(), asymmetric_padding.PKCS1v15(), hashes.SHA256()
+    )
+    return f"{signed}.{b64url(signature)}"
+
+
+def encrypt(certificate, content: dict, key: bytes = None) -> dict:
+    """Encrypt resource data the way the api provider does."""
+    key = key or os.urandom(32)
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    plain = padder.update(json.dumps(content).encode()) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).encryptor()
+    data = encryptor.update(plain) + encryptor.finalize()
+    data_key = certificate.certificate.public_key().encrypt(
+        key,
+        asymmetric_padding.OAEP(
+            mgf=asymmetric_padding.MGF1(algorithm=hashes.SHA1()),
+            algorithm=hashes.SHA1(),
+            label=None,
+        ),
+    )
+    return {
+        "data": base64.b64encode(data).decode(),
+        "dataSignature": base64.b64encode(
+            hmac.new(key, data, hashlib.sha256).digest()
+        ).decode(),
+        "dataKey": base64.b64encode(data_key).decode(),
+        "encryptionCertificateId": certificate.id,
+        "encryptionCertificateThumbprint": certificate.thumbprint,
+    }
+
+
+class TestRichNotifications:
+    def test_subscribe(self, subscriber, certificate):
+        request = subscriber.subscription_factory(
+            resource="inbox", events=[O365EventType.CREATED]
+        ).serialize()
+        assert request["includeResourceData"] is True
+        assert request["encryptionCertificate"] == certificate.public
+        assert request["encryptionCertificateId"] == "cert-1"
+        assert request["lifecycleNotificationUrl"] == subscriber.notification_url
+        assert "expirationDateTime" in request
+
+    def test_certificate_pem(self, certificate):
+        restored = O365EncryptionCertificate.from_pem(
+            *certificate.to_pem(password=b"pass"), password=b"pass", id="cert-1"
+        )
+        assert restored.thumbprint == certificate.thumbprint
+
+    def test_decrypt(self, subscriber, certificate, signing_key, signing_keys):
+        key = os.urandom(32)
+        forged = encrypt(certificate, {"subject": "forged"}, key)
+        forged["dataSignature"] = encrypt(certificate, {"subject": "other"}, key)[
+            "dataSignature"
+        ]
+        contents = [
+            encrypt(certificate, {"subject": "hello"}, key),
+            forged,
+            encrypt(certificate, {"subject": "again"}, key),
+        ]
+        for content in contents:  # the key is wrapped once, for the batch
+            content["dataKey"] = contents[0]["dataKey"]
+        bodies = [
+            graph_payload(i, encryptedContent=c) for i, c in enumerate(contents, 1)
+        ]
+
+        handler = CollectingHandler()
+        receiver = O365PushReceiver(subscriber, handler)
+        with receiver:
+            tokens = [validation_token(signing_key)]
+            body = json.dumps({"validationTokens": tokens, "value": bodies})
+            assert receiver.accept("POST", "", body.encode()) == (202, "")
+            assert handler.wait_for(2)
+
+        assert [n.resource.id for n in handler.notifications] == ["1", "3"]
+        assert [n.content for n in handler.notifications] == [
+            {"subject": "hello"},
+            {"subject": "again"},
+        ]
+        assert all(type(n) is O365RichNotification for n in handler.notifications)
+        stats = subscriber.decryptor.stats
+        assert (stats.decrypted, stats.rejected) == (2, 1)
+        assert stats.key_misses == 1  # the key is unwrapped once
+
+    def test_validation_tokens(
+        self, subscriber, certificate, signing_key, signing_keys
+    ):
+        forger = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        receiver = O365PushReceiver(subscriber)
+
+        def post(tokens):
+            bodies = [
+                graph_payload(
+                    1, encryptedContent=encrypt(certificate, {"subject": "hi"})
+                )
+            ]
+            body = {"validationTokens": tokens, "value": bodies}
+            return receiver.accept("POST", "", json.dumps(body).encode())[0]
+
+        assert post([validation_token(signing_key)]) == 202
+        assert post([validation_token(forger)]) == 400  # forged
+        assert post([]) == 400
+        assert post(["not.a.token"]) == 400
+        assert post([validation_token(signing_key, aud="other-app")]) == 400
+        assert post([validation_token(signing_key, azp="other-publisher")]) == 400
+        assert post([validation_token(signing_key, exp=time.time() - 3600)]) == 400
+        assert post([validation_token(signing_key, tid="bar")]) == 400
+        assert post([validation_token(signing_key), validation_token(forger)]) == 400
+        assert signing_keys.call_count == 1  # fetched once, unless unknown
+
+    def test_rotated_certificate(self, subscriber, certificate):
+        rotated = O365EncryptionCertificate.generate(id="cert-2")
+        subscriber.rotate_certificate(rotated)
+        assert (
+            subscriber.subscription_factory(
+                resource="inbox", events=[O365EventType.CREATED]
+            ).serialize()["encryptionCertificateId"]
+            == "cert-2"
+        )
+
+        notifications = [
+            subscriber.notification_factory(
+                graph_payload(i, encryptedContent=encrypt(c, {"i": i}))
+            )
+            for i, c in enumerate([certificate, rotated])
+        ]
+        decrypted = subscriber.decryptor.process(notifications)
+        assert [n.content for n in decrypted] == [{"i": 0}, {"i": 1}]
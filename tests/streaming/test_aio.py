@@ -0,0 +1,272 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.base import O365Notification
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.dedup import O365DedupHandler
+from O365_notifications.renewal import O365RenewalScheduler
+from O365_notifications.streaming import O365KeepAliveNotification
+from tests.conftest import (
+    CollectingHandler,
+    keep_alive_payload,
+    notification_payload,
+)
+
+aiohttp = pytest.importorskip("aiohttp")
+web = pytest.importorskip("aiohttp.web")
+
+from O365_notifications.aio import O365AsyncStreamingSubscriber  # noqa: E402
+
+NS = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+
+
+class StandInServer:
+    """Local stand-in for the subscriptions and GetNotifications endpoints."""
+
+    def __init__(self, expired=0, hold=0):
+        self.ids = itertools.count(1)
+        self.expired = expired  # number of GetNotifications answered with 404
+        self.hold = hold  # seconds streams are held open for, before their end
+        self.app = web.Application()
+        self.app.router.add_post("/users/{mailbox}/subscriptions", self.subscriptions)
+        self.app.router.add_post(
+            "/users/{mailbox}/GetNotifications", self.notifications
+        )
+
+    async def subscriptions(self, request):
+        body = await request.json()
+        return web.json_response(
+            {
+                "@odata.type": body["@odata.type"],
+                "Id": f"{request.match_info['mailbox']}-{next(self.ids)}",
+                "Resource": "me/mailfolders('inbox')/Messages",
+                "ChangeType": body["ChangeType"],
+            }
+        )
+
+    async def notifications(self, request):
+        if self.expired:
+            self.expired -= 1
+            raise web.HTTPNotFound()
+
+        body = await request.json()
+        values = [keep_alive_payload(NS)]
+        for i, sub_id in enumerate(body["SubscriptionIds"]):
+            values.append(
+                notification_payload(
+                    NS,
+                    i + 1,
+                    subscription_id=sub_id,
+                    resource_id="{ABC}",
+                    url=f"https://graph.microsoft.com/beta/Messages('{sub_id}')",
+                    expiration=datetime.now().isoformat(),
+                )
+            )
+        payload = json.dumps({"@odata.context": "#Notifications", "value": values})
+
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for i in range(0, len(payload) - 2, 50):
+            await response.write(payload[i : min(i + 50, len(payload) - 2)].encode())
+            await asyncio.sleep(0)
+        await asyncio.sleep(self.hold)
+        await response.write(payload[-2:].encode())
+        await response.write_eof()
+        return response
+
+
+class AsyncCollectingHandler(CollectingHandler):
+    async def process(self, notification):
+        await asyncio.sleep(0)
+        self.notifications.append(notification)
+
+
+def run_with_server(server, coro_fn):
+    async def main():
+        runner = web.AppRunner(server.app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await coro_fn(f"http://127.0.0.1:{port}/")
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def make_subscriber(backend, url, mailbox, session):
+    protocol = MSGraphProtocol(api_version="beta")
+    protocol.service_url = url
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource=mailbox,
+        auth_flow_type="credentials",
+        protocol=protocol,
+        token_backend=backend,
+    )
+    subscriber = O365AsyncStreamingSubscriber(parent=account, session=session)
+    return subscriber, account.mailbox().inbox_folder()
+
+
+class TestAsyncStreaming:
+    def test_many_mailboxes_one_loop(self, backend):
+        mailboxes = [f"user{i}@bar.com" for i in range(5)]
+
+        async def scenario(url):
+            async with aiohttp.ClientSession() as session:
+                handlers = []
+                streams = []
+                for mailbox in mailboxes:
+                    subscriber, inbox = make_subscriber(backend, url, mailbox, session)
+                    await subscriber.subscribe(
+                        resource=inbox, events=[O365EventType.CREATED]
+                    )
+                    handler = AsyncCollectingHandler()
+                    handlers.append(handler)
+                    streams.append(
+                        subscriber.start_streaming(notification_handler=handler)
+                    )
+                await asyncio.gather(*streams)
+                return handlers
+
+        handlers = run_with_server(StandInServer(), scenario)
+        for mailbox, handler in zip(mailboxes, handlers):
+            keep_alive, notification = handler.notifications
+            assert type(keep_alive) is O365KeepAliveNotification
+            assert type(notification) is O365Notification
+            assert notification.subscription_id.startswith(mailbox)
+            assert notification.resource.id == "{ABC}"
+
+    def test_expired_subscription(self, backend):
+        async def scenario(url):
+            subscriber, inbox = make_subscriber(backend, url, "foo@bar.com", None)
+            try:
+                subscription = await subscriber.subscribe(
+                    resource=inbox, events=[O365EventType.CREATED]
+                )
+                expired_id = subscription.id
+                handler = AsyncCollectingHandler()
+                await subscriber.start_streaming(notification_handler=handler)
+                return expired_id, subscriber, handler
+            finally:
+                await subscriber.close()
+
+        expired_id, subscriber, handler = run_with_server(
+            StandInServer(expired=1), scenario
+        )
+        assert len(subscriber.subscriptions) == 1
+        assert subscriber.subscriptions[0].id != expired_id
+        assert (
+            handler.notifications[1].subscription_id == subscriber.subscriptions[0].id
+        )
+
+    def test_no_subscription(self, backend):
+        async def scenario(url):
+            subscriber, _ = make_subscriber(backend, url, "foo@bar.com", None)
+            with pytest.raises(ValueError):
+                await subscriber.start_streaming()
+
+        run_with_server(StandInServer(), scenario)
+
+    def test_subscribe_many(self, backend):
+        async def scenario(url):
+            subscriber, inbox = make_subscriber(backend, url, "foo@bar.com", None)
+            mailbox = inbox.parent
+            folders = [inbox, mailbox.sent_folder(), mailbox.drafts_folder()]
+            try:
+                results = await subscriber.subscribe_many(
+                    folders, [O365EventType.CREATED], max_workers=2
+                )
+                return subscriber, folders, results
+            finally:
+                await subscriber.close()
+
+        subscriber, folders, results = run_with_server(StandInServer(), scenario)
+        assert [r.resource for r in results] == folders
+        assert all(r.ok for r in results)
+        assert len(subscriber.subscriptions) == 3
+
+    def test_stop_streaming(self, backend):
+        async def scenario(url):
+            subscriber, inbox = make_subscriber(backend, url, "foo@bar.com", None)
+            try:
+                await subscriber.subscribe(
+                    resource=inbox, events=[O365EventType.CREATED]
+                )
+                handler = AsyncCollectingHandler()
+                threading.Timer(0.2, subscriber.stop_streaming).start()
+                start = time.monotonic()
+                await subscriber.start_streaming(notification_handler=handler)
+                return handler, time.monotonic() - start
+            finally:
+                await subscriber.close()
+
+        handler, elapsed = run_with_server(StandInServer(hold=2), scenario)
+        assert elapsed < 2  # the stream was closed, not waited on
+        assert len(handler.notifications) == 2
+
+    def test_batches(self, backend):
+        class BatchingHandler(AsyncCollectingHandler):
+            max_batch_size = 2
+            batch_keep_alives = True
+
+        async def scenario(url):
+            subscriber, inbox = make_subscriber(backend, url, "foo@bar.com", None)
+            try:
+                await subscriber.subscribe(
+                    resource=inbox, events=[O365EventType.CREATED]
+                )
+                handler = BatchingHandler()
+                await subscriber.start_streaming(notification_handler=handler)
+                return handler
+            finally:
+                await subscriber.close()
+
+        handler = run_with_server(StandInServer(), scenario)
+        keep_alive, notification = handler.notifications
+        assert type(keep_alive) is O365KeepAliveNotification
+        assert type(notification) is O365Notification
+
+    def test_lingering_batch(self, backend):
+        class BatchingHandler(AsyncCollectingHandler):
+            max_batch_size = 10
+            max_batch_linger = 0.05
+
+            async def process_batch(self, notifications):
+                self.elapsed = time.monotonic() - self.start
+                self.notifications.extend(notifications)
+
+        async def scenario(url):
+            subscriber, inbox = make_subscriber(backend, url, "foo@bar.com", None)
+            try:
+                await subscriber.subscribe(
+                    resource=inbox, events=[O365EventType.CREATED]
+                )
+                handler = BatchingHandler()
+                handler.start = time.monotonic()
+                await subscriber.start_streaming(notification_handler=handler)
+                return handler
+            finally:
+                await subscriber.close()
+
+        handler = run_with_server(StandInServer(hold=1), scenario)
+        # released while the stream was held open, not once it ended
+        assert handler.elapsed < 1
+        assert type(handler.notifications[1]) is O365Notification
+
+    def test_threaded_helpers(self, backend):
+        subscriber, _ = make_subscriber(backend, "http://foo.bar/", "foo@bar.com", None)
+        with pytest.raises(TypeError):
+            O365DedupHandler(AsyncCollectingHandler())
+        with pytest.raises(TypeError):
+            O365RenewalScheduler(subscriber)
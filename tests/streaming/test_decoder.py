@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from O365_notifications.stream import NotificationStreamDecoder
+
+
+@pytest.fixture
+def body():
+    return json.dumps(
+        {
+            "@odata.context": "https://foo/metadata#Notifications{[",
+            "value": [
+                {"@odata.type": "#Foo.KeepAliveNotification", "Status": "OK"},
+                {"Id": "1", "Subject": 'curly } braces { and "quotes" \\ ]'},
+                {"Id": "2", "ResourceData": {"Id": "ABC", "Tags": ["a", "b"]}},
+            ],
+        }
+    ).encode()
+
+
+class TestNotificationStreamDecoder:
+    def test_single_chunk(self, body):
+        decoder = NotificationStreamDecoder()
+        elements = decoder.feed(body)
+        assert elements == json.loads(body)["value"]
+        assert decoder.done
+
+    @pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+    def test_chunk_boundaries(self, body, size):
+        decoder = NotificationStreamDecoder()
+        elements = []
+        for i in range(0, len(body), size):
+            elements.extend(decoder.feed(body[i : i + size]))
+        assert elements == json.loads(body)["value"]
+        assert decoder.done
+
+    def test_open_stream(self, body):
+        decoder = NotificationStreamDecoder()
+        head = body[: body.index(b"Id") + 4]
+        assert len(decoder.feed(head)) == 1
+        assert not decoder.done
+
+    def test_feed_after_done(self, body):
+        decoder = NotificationStreamDecoder()
+        decoder.feed(body)
+        assert decoder.feed(body) == []
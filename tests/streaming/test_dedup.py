@@ -0,0 +1,83 @@
+from O365 import MSGraphProtocol
+
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.dedup import (
+    O365DedupFilter,
+    O365DedupHandler,
+    O365SequenceTracker,
+)
+from tests.conftest import CollectingHandler, notification
+
+NS = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+
+
+def change(sequence, etag, event=O365EventType.UPDATED, subscription_id="A", **kwargs):
+    kwargs.setdefault("resource_id", "XYZ")
+    return notification(
+        NS, sequence, etag=etag, event=event, subscription_id=subscription_id, **kwargs
+    )
+
+
+class TestDedup:
+    def test_filter_is_bounded(self):
+        dedup = O365DedupFilter(capacity=3)
+        assert not any(dedup.seen(k) for k in range(5))
+        assert len(dedup) == 3
+        assert dedup.seen(4)
+        assert not dedup.seen(0)  # evicted
+
+    def test_tracker_is_bounded(self):
+        tracker = O365SequenceTracker(capacity=2)
+        assert tracker.track("1", 1) == 0
+        assert tracker.track("2", 1) == 0
+        assert tracker.track("1", 3) == 1  # "1" is the most recent subscription
+        assert tracker.track("3", 1) == 0  # replaces "2"
+        assert len(tracker) == 2
+        assert tracker.track("2", 5) == 0  # evicted, tracked anew
+        assert tracker.track("3", 1) == -1
+
+    def test_redelivery_after_restart(self):
+        handler = CollectingHandler()
+        dedup = O365DedupHandler(handler)
+        first = [change(1, "e1"), change(2, "e2")]
+        for n in first:
+            dedup.process(n)
+        # the stream restarts and delivers the same changes again
+        for n in [change(1, "e1"), change(2, "e2"), change(3, "e3")]:
+            dedup.process(n)
+        assert [n.sequence for n in handler.notifications] == [1, 2, 3]
+        assert dedup.stats.duplicates == 2
+
+    def test_gaps_and_missed(self):
+        gaps, missed = [], []
+        dedup = O365DedupHandler(
+            CollectingHandler(),
+            on_gap=lambda *args: gaps.append(args),
+            on_missed=missed.append,
+        )
+        dedup.process(change(1, "e1"))
+        dedup.process(change(4, "e4"))
+        dedup.process(change(5, "e5", event=O365EventType.MISSED))
+        dedup.process(change(1, "e1", subscription_id="B"))
+
+        assert gaps == [("A", 2, 4)]
+        assert dedup.stats.gaps == 1
+        assert dedup.stats.skipped == 2
+        assert len(missed) == 1
+        assert dedup.stats.missed == 1
+
+    def test_change_key(self):
+        handler = CollectingHandler()
+        dedup = O365DedupHandler(handler)
+        dedup.process(change(1, "e1", event=O365EventType.CREATED))
+        # the same change, caught up on or notified by another subscription
+        dedup.process(change(None, "e1"))
+        dedup.process(change(1, "e1", subscription_id="B"))
+        # deleted resources are known by id only
+        dedup.process(change(2, "e2", event=O365EventType.DELETED))
+        dedup.process(change(None, None, event=O365EventType.DELETED))
+        # 'Missed' notifications are no changes
+        dedup.process(change(3, "e1", event=O365EventType.MISSED))
+        dedup.process(change(4, "e1", resource_id="ABC"))
+        assert [n.sequence for n in handler.notifications] == [1, 2, 3, 4]
+        assert dedup.stats.duplicates == 3
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+from O365 import MSGraphProtocol
+
+from O365_notifications.constants import O365Namespace
+from O365_notifications.dispatch import O365NotificationDispatcher, O365OverflowPolicy
+from tests.conftest import CollectingHandler, keep_alive, notification
+
+NS = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+
+
+class RecordingHandler(CollectingHandler):
+    def __init__(self, gate=None):
+        super().__init__()
+        self.gate = gate
+
+    def process(self, notification):
+        if self.gate:
+            self.gate.wait()
+        time.sleep(0.0001)
+        super().process(notification)
+
+
+class TestDispatcher:
+    def test_ordering_per_subscription(self):
+        handler = RecordingHandler()
+        with O365NotificationDispatcher(handler, workers=4) as dispatcher:
+            for seq in range(1, 51):
+                for sub_id in ("A", "B", "C"):
+                    dispatcher.process(notification(NS, seq, subscription_id=sub_id))
+                dispatcher.process(keep_alive(NS))
+
+        assert dispatcher.stats().processed == 200
+        for sub_id in ("A", "B", "C"):
+            sequences = [
+                n.sequence
+                for n in handler.notifications
+                if getattr(n, "subscription_id", None) == sub_id
+            ]
+            assert sequences == list(range(1, 51))
+
+    def test_drop_keep_alives(self):
+        gate = threading.Event()
+        handler = RecordingHandler(gate=gate)
+        dispatcher = O365NotificationDispatcher(
+            handler,
+            workers=1,
+            max_queue_size=2,
+            overflow=O365OverflowPolicy.DROP_KEEP_ALIVE,
+        )
+        for _ in range(5):
+            dispatcher.process(keep_alive(NS))
+        stats = dispatcher.stats()
+        assert stats.dropped >= 2
+        assert stats.depth <= 2
+        gate.set()
+        dispatcher.close()
+        assert len(handler.notifications) == 5 - dispatcher.stats().dropped
+
+    def test_spill(self):
+        gate = threading.Event()
+        handler = RecordingHandler(gate=gate)
+        dispatcher = O365NotificationDispatcher(
+            handler, workers=1, max_queue_size=2, overflow=O365OverflowPolicy.SPILL
+        )
+        for seq in range(10):
+            dispatcher.process(notification(NS, seq, subscription_id="A"))
+        assert dispatcher.stats().spilled >= 7
+        assert dispatcher.stats().max_depth >= 9
+        gate.set()
+        dispatcher.close()
+        assert [n.sequence for n in handler.notifications] == list(range(10))
+
+    def test_spill_is_bounded(self):
+        gate = threading.Event()
+        handler = RecordingHandler(gate=gate)
+        dispatcher = O365NotificationDispatcher(
+            handler,
+            workers=1,
+            max_queue_size=2,
+            overflow=O365OverflowPolicy.SPILL,
+            max_spill_size=3,
+        )
+        producer = threading.Thread(
+            target=lambda: [
+                dispatcher.process(notification(NS, s, subscription_id="A"))
+                for s in range(10)
+            ]
+        )
+        producer.daemon = True
+        producer.start()
+        time.sleep(0.1)
+        assert producer.is_alive()  # blocked, once the overflow buffer is full
+        stats = dispatcher.stats()
+        assert stats.blocked >= 1
+        assert stats.max_depth <= 5
+        gate.set()
+        producer.join()
+        dispatcher.close()
+        assert [n.sequence for n in handler.notifications] == list(range(10))
+
+    def test_closed(self):
+        dispatcher = O365NotificationDispatcher(RecordingHandler())
+        dispatcher.close()
+        with pytest.raises(RuntimeError):
+            dispatcher.process(keep_alive(NS))
@@ -0,0 +1,178 @@
+import threading
+import time
+
+import pytest
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.planner import O365StreamPlanner
+from O365_notifications.streaming import O365StreamingSubscriber
+from tests.conftest import (
+    CollectingHandler,
+    FakeConnection,
+    FakeStream,
+    notification_payload,
+)
+
+IDS = ("A", "B", "C", "D", "E")
+
+
+class PlannedConnection(FakeConnection):
+    """Streams notifications of the requested subscriptions, in given numbers."""
+
+    def __init__(self, ns, counts):
+        super().__init__()
+        self.ns = ns
+        self.counts = counts
+        self.down = False  # no more connections
+
+    def respond(self, url, data):
+        if self.down:
+            return None
+        elements = [
+            notification_payload(
+                self.ns,
+                i,
+                subscription_id=subscription_id,
+                resource_id=f"{subscription_id}{i}",
+                etag=f"XYZ{len(self.requests):03}",  # changed in between
+            )
+            for subscription_id in data["SubscriptionIds"]
+            for i in range(self.counts.get(subscription_id, 0))
+        ]
+        return FakeStream(elements, stall=True, expire=10)
+
+
+@pytest.fixture
+def subscriber(backend):
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+    subscriber = O365StreamingSubscriber(parent=account)
+    sub_type = subscriber.namespace.O365SubscriptionType.STREAMING_SUBSCRIPTION
+    for subscription_id in IDS:
+        subscriber.register_subscription(
+            resource=f"folder {subscription_id}",
+            events=[O365EventType.CREATED],
+            raw={
+                "@odata.type": sub_type.value,
+                "Id": subscription_id,
+                "ChangeType": O365EventType.CREATED.value,
+            },
+        )
+    return subscriber
+
+
+def ids(plans):
+    return [[s.id for s in plan.subscriptions] for plan in plans]
+
+
+class TestPlanner:
+    def test_plan(self, subscriber):
+        planner = O365StreamPlanner(subscriber, max_streams=3, hot_rate=1.0)
+
+        # nothing measured yet: a single stream, with frequent keep-alives
+        (plan,) = planner.plan()
+        assert ids([plan]) == [list(IDS)]
+        assert (plan.keep_alive_interval, plan.connection_timeout) == (5, 120)
+
+        counts = {"A": 600, "B": 450, "C": 330, "D": 30}
+        plans = planner.plan(counts, {"D": 1, "E": 1}, elapsed=300)
+        assert ids(plans) == [["A"], ["B"], ["C", "D", "E"]]
+        assert [p.dedicated for p in plans] == [True, True, False]
+        # busy, hence frequent keep-alives; the error halves the timeout
+        assert plans[2].keep_alive_interval == 5
+        assert plans[2].connection_timeout == 60
+
+        # hot subscriptions stay so until their rate halves
+        plans = planner.plan({"A": 600, "B": 180, "C": 200}, elapsed=300)
+        assert ids(plans) == [["A"], ["B"], ["C", "D", "E"]]
+        plans = planner.plan({"A": 600, "B": 120, "C": 200}, elapsed=300)
+        assert ids(plans) == [["A"], ["C", "B", "D", "E"]]
+
+        # idle streams get sparse keep-alives
+        (plan,) = planner.plan({}, elapsed=300)
+        assert (plan.keep_alive_interval, plan.connection_timeout) == (60, 120)
+        assert planner.tune(notifications=15, errors=0, elapsed=300) == (20, 120)
+        assert planner.tune(notifications=15, errors=20, elapsed=300) == (5, 15)
+
+    def test_run(self, subscriber):
+        con = subscriber.con = PlannedConnection(
+            subscriber.namespace, {"A": 50, "B": 1}
+        )
+        handler = CollectingHandler()
+        planner = O365StreamPlanner(
+            subscriber, hot_rate=20, window=0.3, missed_keep_alives=0
+        )
+        thread = threading.Thread(target=planner.run, args=(handler,))
+        thread.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(con.requests) < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            first, *planned = [r["data"]["SubscriptionIds"] for r in con.requests]
+            assert first == list(IDS)
+            assert sorted(planned) == [["A"], ["B", "C", "D", "E"]]
+            time.sleep(0.1)
+            loads = {tuple(load.subscriptions): load for load in planner.report()}
+            assert set(loads) == {("A",), ("B", "C", "D", "E")}
+            assert loads[("A",)].dedicated
+            assert loads[("A",)].notifications == 50
+            assert loads[("A",)].connections == 1
+            assert loads[("B", "C", "D", "E")].notifications == 1
+        finally:
+            planner.stop()
+            thread.join(5)
+        assert not thread.is_alive()
+        assert len(handler.notifications) == 102
+        assert subscriber._running == []
+        assert not subscriber._stopping.is_set()
+
+    def test_replan(self, subscriber):
+        con = subscriber.con = PlannedConnection(subscriber.namespace, {})
+        planner = O365StreamPlanner(subscriber, max_streams=3, missed_keep_alives=0)
+        handler = CollectingHandler()
+        planner._start(planner.plan({"A": 600}, elapsed=300), handler)
+        hot, shared = planner._lanes
+
+        # only the stream whose subscriptions moved is replaced
+        planner._measure = lambda: ({"A": 600, "B": 600}, {}, 300)
+        planner._replan(handler)
+        assert planner._lanes[0] is hot and hot.thread.is_alive()
+        assert shared.stop.is_set() and not shared.thread.is_alive()
+        assert ids(lane.plan for lane in planner._lanes) == [
+            ["A"],
+            ["B"],
+            list(IDS[2:]),
+        ]
+        requests = [r["data"]["SubscriptionIds"] for r in con.requests[2:]]
+        assert requests == [["B"], list(IDS[2:])]
+
+        planner.stop()
+        planner._stop_lanes(planner._lanes)
+        assert subscriber._running == []
+
+    def test_streams_ended(self, subscriber):
+        con = subscriber.con = PlannedConnection(subscriber.namespace, {})
+        con.down = True
+        planner = O365StreamPlanner(subscriber, missed_keep_alives=0)
+        planner.run(CollectingHandler())  # returns as no stream could be opened
+
+        # the subscriber is left streamable
+        con.down = False
+        con.counts = {"A": 3}
+        handler = CollectingHandler()
+        thread = threading.Thread(
+            target=subscriber.start_streaming,
+            kwargs={"notification_handler": handler, "missed_keep_alives": 0},
+        )
+        thread.start()
+        handler.wait_for(3)
+        subscriber.stop_streaming()
+        thread.join(5)
+        assert len(handler.notifications) == 3
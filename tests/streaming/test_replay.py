@@ -0,0 +1,104 @@
+import time
+
+import pytest
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.replay import (
+    O365StreamRecorder,
+    O365StreamReplayer,
+    main,
+)
+from O365_notifications.streaming import O365StreamingSubscriber
+from tests.conftest import (
+    CollectingHandler,
+    FakeConnection,
+    FakeStream,
+    keep_alive_payload,
+    notification_payload,
+)
+
+
+@pytest.fixture
+def subscriber(backend):
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+    subscriber = O365StreamingSubscriber(parent=account)
+    ns = subscriber.namespace
+    subscriber.register_subscription(
+        resource="inbox",
+        events=[O365EventType.CREATED],
+        raw={
+            "@odata.type": ns.O365SubscriptionType.STREAMING_SUBSCRIPTION.value,
+            "Id": "1234",
+            "Resource": "https://graph.microsoft.com/beta/me/Messages",
+            "ChangeType": O365EventType.CREATED.value,
+        },
+    )
+    return subscriber
+
+
+def paced_stream(ns, sequences, pause=0.05):
+    """A streamed response, sending its body in small chunks, 50ms apart."""
+    elements = [
+        keep_alive_payload(ns),
+        *(notification_payload(ns, i) for i in sequences),
+    ]
+    return FakeStream(elements, chunk_size=50, pause=pause)
+
+
+class TestReplay:
+    @pytest.mark.parametrize("suffix", [".rec", ".rec.gz"])
+    def test_record_and_replay(self, subscriber, tmp_path, suffix):
+        ns = subscriber.namespace
+        streams = [paced_stream(ns, [1, 2]), paced_stream(ns, [3])]
+        subscriber.con = FakeConnection(streams)
+        path = str(tmp_path / f"notifications{suffix}")
+
+        recorded = CollectingHandler()
+        start = time.perf_counter()
+        with O365StreamRecorder(path) as recorder:
+            subscriber.start_streaming(
+                notification_handler=recorded,
+                refresh_after_expire=True,
+                recorder=recorder,
+            )
+        recorded_seconds = time.perf_counter() - start
+
+        replayer = O365StreamReplayer(path)
+        assert replayer.subscriber().main_resource == subscriber.main_resource
+        assert [r["SubscriptionIds"] for r in replayer.requests] == [["1234"]] * 2
+        assert [b"".join(c for _, c in s) for s in replayer.streams] == [
+            s.body for s in streams
+        ]
+
+        replayed = CollectingHandler()
+        stats = replayer.replay(replayed, speed=None)
+        assert stats.streams == 2
+        assert stats.chunks == sum(len(s) for s in replayer.streams)
+        assert stats.notifications == len(recorded.notifications) == 5
+        assert [n.raw for n in replayed.notifications] == [
+            n.raw for n in recorded.notifications
+        ]
+        assert stats.seconds < recorded_seconds / 2
+
+        # paced as recorded, twice as fast
+        stats = replayer.replay(CollectingHandler(), speed=2)
+        assert stats.seconds == pytest.approx(recorded_seconds / 2, rel=0.5)
+
+    def test_cli(self, subscriber, tmp_path, capsys):
+        ns = subscriber.namespace
+        subscriber.con = FakeConnection([paced_stream(ns, [1], pause=0)])
+        path = str(tmp_path / "notifications.rec")
+        with O365StreamRecorder(path) as recorder:
+            subscriber.start_streaming(recorder=recorder)
+
+        stats = main([path, "--max-speed"])
+        assert stats.notifications == 2
+        assert "2 notifications" in capsys.readouterr().out
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+from O365 import MSGraphProtocol
+
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.routing import O365NotificationRouter
+from tests.conftest import CollectingHandler
+
+NS = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+
+
+def notification(event, resource_type, subscription=None):
+    return SimpleNamespace(
+        type=NS.O365NotificationType.NOTIFICATION,
+        event=event,
+        resource=SimpleNamespace(type=resource_type),
+        subscription=subscription,
+    )
+
+
+class TestNotificationRouter:
+    def test_routes(self):
+        inbox, archive = object(), object()
+        created, messages, audit, archived, default = (
+            CollectingHandler() for _ in range(5)
+        )
+        router = O365NotificationRouter(namespace=NS, default=default)
+        router.route(created, event=O365EventType.CREATED)
+        router.route(messages, resource_type=NS.O365ResourceDataType.MESSAGE)
+        router.route(audit, notification_type=NS.O365NotificationType.NOTIFICATION)
+        router.route(archived, subscription=archive, event=O365EventType.DELETED)
+
+        message = NS.O365ResourceDataType.MESSAGE
+        event = NS.O365ResourceDataType.EVENT
+        new_message = notification(O365EventType.CREATED, message, inbox)
+        deleted_event = notification(O365EventType.DELETED, event, archive)
+        updated_event = notification(O365EventType.UPDATED, event, inbox)
+        for n in (new_message, deleted_event, updated_event):
+            router.process(n)
+        router.process(
+            SimpleNamespace(type=NS.O365NotificationType.KEEP_ALIVE_NOTIFICATION)
+        )
+
+        assert created.notifications == [new_message]
+        assert messages.notifications == [new_message]
+        assert audit.notifications == [new_message, deleted_event, updated_event]
+        assert archived.notifications == [deleted_event]
+        assert len(default.notifications) == 1
+
+    def test_subscription_route_only(self):
+        inbox = object()
+        handler, default = CollectingHandler(), CollectingHandler()
+        router = O365NotificationRouter(namespace=NS, default=default)
+        router.route(handler, subscription=inbox)
+
+        message = NS.O365ResourceDataType.MESSAGE
+        router.process(notification(O365EventType.CREATED, message, inbox))
+        router.process(notification(O365EventType.CREATED, message, object()))
+        assert len(handler.notifications) == 1
+        assert len(default.notifications) == 1
@@ -1,5 +1,6 @@
+import json
 import random
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 import pytest
 import pytest_cases
@@ -7,11 +8,32 @@ from O365 import Account, MSGraphProtocol, MSOffice365Protocol
 from pytest_cases import fixture_ref
 
 from O365_notifications.base import O365BaseNotificationsHandler, O365Notification
-from O365_notifications.constants import O365EventType
+from O365_notifications.constants import O365EventType, O365KeepRaw
+from O365_notifications.metrics import O365Metrics
+from O365_notifications.renewal import O365RenewalScheduler
 from O365_notifications.streaming import (
     O365KeepAliveNotification,
     O365StreamingSubscriber,
 )
+from O365_notifications.utils import build_url
+from tests.conftest import (
+    CollectingHandler,
+    keep_alive_payload,
+    notification_payload,
+)
+
+
+def event_payload(ns):
+    """The notification of an updated event, expiring with 7 fractional digits."""
+    return notification_payload(
+        ns,
+        2,
+        event=O365EventType.UPDATED,
+        resource_id="ABC",
+        resource_type=ns.O365ResourceDataType.EVENT,
+        url="https://outlook.office.com/api/Events('XYZ')",
+        expiration="2023-01-01T10:00:00.1234567Z",
+    )
 
 
 @pytest.fixture(scope="class", params=[MSOffice365Protocol, MSGraphProtocol])
@@ -126,3 +148,192 @@ class TestMailbox:
         assert handler.notifications[1].sequence == 1
         assert handler.notifications[1].event == O365EventType.CREATED
         assert handler.notifications[1].resource.type == types["message"]
+        assert handler.notifications[1].subscription is subscription
+
+    def test_notification_decoding(self, subscriber):
+        raw = event_payload(subscriber.namespace)
+        fast = subscriber.notification_factory(raw)
+        subscriber.decoder.validate = True
+        try:
+            validated = subscriber.notification_factory(raw)
+        finally:
+            subscriber.decoder.validate = False
+        assert fast == validated
+
+        with pytest.raises(ValueError):
+            subscriber.notification_factory({**raw, "@odata.type": "#Foo.Bar"})
+
+    @pytest.mark.parametrize("keep_raw", list(O365KeepRaw))
+    def test_compact_notifications(self, account, keep_raw):
+        subscriber = O365StreamingSubscriber(parent=account, keep_raw=keep_raw)
+        raw = event_payload(subscriber.namespace)
+        frame = json.dumps(raw).encode()
+        first = subscriber.notification_factory(raw, frame=frame)
+        second = subscriber.notification_factory(json.loads(frame))
+
+        assert not hasattr(first, "__dict__")
+        assert not hasattr(first.resource, "__dict__")
+        assert first.subscription_id is second.subscription_id
+        assert first.subscription_expire is second.subscription_expire
+        if keep_raw == O365KeepRaw.OFF:
+            assert first.raw is None
+        elif keep_raw == O365KeepRaw.BYTES:
+            assert first.raw == frame
+            assert second.payload() == raw
+        else:
+            assert first.raw is raw
+
+    @pytest_cases.parametrize("subscription", [fixture_ref("subscribe")])
+    def test_streaming_batches(self, subscription, subscriber, requests_mock):
+        proto_url = subscriber.protocol.service_url
+        base_url = f"{proto_url}{subscriber.main_resource}"
+        ns = subscriber.namespace
+        keep_alive = keep_alive_payload(ns)
+        notifications = [
+            notification_payload(
+                ns,
+                i,
+                subscription_id=subscription.id,
+                event=O365EventType.DELETED,
+                url=f"{base_url}/Messages('{i}')",
+                expiration=datetime.now().isoformat(),
+            )
+            for i in range(1, 6)
+        ]
+        data = {"value": [keep_alive, *notifications, keep_alive]}
+        requests_mock.register_uri("POST", f"{base_url}/GetNotifications", json=data)
+
+        class BatchHandler(O365BaseNotificationsHandler):
+            max_batch_size = 2
+            max_batch_linger = 60
+
+            def __init__(self):
+                self.batches = []
+                self.keep_alives = 0
+
+            def process(self, notification):
+                self.keep_alives += 1
+
+            def process_batch(self, notifications):
+                self.batches.append([n.sequence for n in notifications])
+
+        handler = BatchHandler()
+        subscriber.start_streaming(notification_handler=handler)
+        assert handler.batches == [[1, 2], [3, 4], [5]]
+        assert handler.keep_alives == 2
+
+    @pytest_cases.parametrize("subscription", [fixture_ref("subscribe")])
+    def test_streaming_metrics(self, subscription, subscriber, requests_mock):
+        base_url = f"{subscriber.protocol.service_url}{subscriber.main_resource}"
+        ns = subscriber.namespace
+        keep_alive = keep_alive_payload(ns)
+        notification = event_payload(ns)
+        body = json.dumps({"value": [keep_alive, notification, keep_alive]})
+        requests_mock.register_uri(
+            "POST",
+            f"{base_url}/GetNotifications",
+            [{"status_code": 404}, {"text": body}],
+        )
+
+        metrics = O365Metrics()
+        subscriber.instrumentation = metrics
+        try:
+            subscriber.start_streaming(notification_handler=CollectingHandler())
+        finally:
+            subscriber.instrumentation = None
+
+        assert metrics.value("o365_stream_bytes_read_total") == len(body)
+        assert metrics.value("o365_stream_not_found_renewals_total") == 1
+        assert metrics.value("o365_stream_reconnects_total") == 0
+        decoded = "o365_notifications_decoded_total"
+        assert metrics.value(decoded, "KEEP_ALIVE_NOTIFICATION") == 2
+        assert metrics.value(decoded, "NOTIFICATION") == 1
+        assert metrics.value("o365_decode_seconds")[0] == 3
+        assert metrics.value("o365_notifications_handled_total") == 3
+        assert metrics.value("o365_keep_alive_interval_seconds")[0] == 1
+        assert metrics.value("o365_request_seconds", "subscribe")[0] == 1
+
+    @pytest_cases.parametrize("subscription", [fixture_ref("subscribe")])
+    def test_renew_subscriptions_returns(self, subscription, subscriber):
+        renewed = subscriber.renew_subscriptions()
+        assert renewed == list(subscriber.subscriptions)
+
+    @pytest_cases.parametrize("subscription", [fixture_ref("subscribe")])
+    def test_renewal_scheduler(self, subscription, subscriber, requests_mock):
+        base_url = f"{subscriber.protocol.service_url}{subscriber.main_resource}"
+        now = datetime.now(timezone.utc)
+        subscription.expiration = now + timedelta(seconds=60)
+        renewed_expiration = now + timedelta(hours=1)
+        requests_mock.register_uri(
+            "PATCH",
+            f"{base_url}/subscriptions/{subscription.id}",
+            json={
+                **subscription.raw,
+                "SubscriptionExpirationDateTime": renewed_expiration.isoformat(),
+            },
+        )
+
+        scheduler = O365RenewalScheduler(subscriber, lead_time=300)
+        assert scheduler.due() == [subscription]
+        assert scheduler.run_pending() == [subscription]
+        assert subscription.expiration == renewed_expiration
+        assert scheduler.due() == []
+        assert 0 < scheduler.next_delay() <= scheduler.poll_interval
+
+    @pytest_cases.parametrize("subscription", [fixture_ref("subscribe")])
+    def test_unsubscribe(self, subscription, subscriber, requests_mock):
+        base_url = f"{subscriber.protocol.service_url}{subscriber.main_resource}"
+        requests_mock.register_uri(
+            "DELETE", f"{base_url}/subscriptions/{subscription.id}", status_code=204
+        )
+        subscriber.unsubscribe(subscription)
+        assert len(subscriber.subscriptions) == 0
+        assert subscriber.subscriptions.get(subscription.id) is None
+
+    def test_subscribe_many(self, account, requests_mock):
+        subscriber = O365StreamingSubscriber(parent=account)
+        base_url = f"{subscriber.protocol.service_url}{subscriber.main_resource}"
+        sub_type = subscriber.namespace.O365SubscriptionType.STREAMING_SUBSCRIPTION
+        mailbox = account.mailbox()
+        folders = [
+            mailbox.inbox_folder(),
+            mailbox.drafts_folder(),
+            mailbox.sent_folder(),
+        ]
+        events = [O365EventType.CREATED, O365EventType.DELETED]
+
+        def created(request, context):
+            resource = request.json()["Resource"]
+            if "Drafts" in resource:
+                context.status_code = 400
+                return {"error": {"code": "ErrorInvalidRequest"}}
+            return {
+                "@odata.type": sub_type.value,
+                "Id": resource.split("/")[-2],
+                "Resource": resource,
+                "ChangeType": "Created,Deleted",
+            }
+
+        requests_mock.register_uri("POST", f"{base_url}/subscriptions", json=created)
+        results = subscriber.subscribe_many(folders, events, max_workers=2)
+
+        assert [r.resource for r in results] == folders
+        assert [r.ok for r in results] == [True, False, True]
+        assert results[1].error.response.status_code == 400
+        assert [r.subscription.id for r in results if r.ok] == ["Inbox", "SentItems"]
+        assert len(subscriber.subscriptions) == 2
+        requests = [r.json() for r in requests_mock.request_history]
+        assert sorted(r["Resource"] for r in requests) == sorted(
+            build_url(f) for f in folders
+        )
+        assert all(r["ChangeType"] == "Created,Deleted" for r in requests)
+
+        # serializing a subscription leaves it untouched
+        subscription = subscriber.subscription_factory(
+            resource=folders[0], events=events
+        )
+        request = subscription.serialize()
+        assert request == subscription.serialize()
+        assert request["Resource"] == build_url(folders[0])
+        assert subscription.events == events
+        assert subscription.resource_url is None
@@ -0,0 +1,207 @@
+import json
+import threading
+
+import pytest
+import requests
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.metrics import O365Instrumentation
+from O365_notifications.streaming import (
+    O365StreamingSubscriber,
+    O365StreamStats,
+    O365StreamWatchdog,
+)
+from tests.conftest import (
+    CollectingHandler,
+    FakeConnection,
+    FakeStream,
+    keep_alive_payload,
+    notification_payload,
+)
+
+
+class PacedStream(FakeStream):
+    """A streamed response, sending its elements ``pace`` seconds apart."""
+
+    def __init__(self, *elements, pace):
+        super().__init__(list(elements))
+        self.parts = [json.dumps(element).encode() for element in elements]
+        self.pace = pace
+
+    def iter_content(self, chunk_size=None):
+        yield b'{"value": [' + self.parts[0]
+        for part in self.parts[1:]:
+            if self.closed.wait(self.pace):
+                return
+            yield b", " + part
+        yield b"]}"
+
+
+@pytest.fixture
+def subscriber(backend):
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+    subscriber = O365StreamingSubscriber(parent=account)
+    ns = subscriber.namespace
+    subscriber.register_subscription(
+        resource="inbox",
+        events=[O365EventType.CREATED],
+        raw={
+            "@odata.type": ns.O365SubscriptionType.STREAMING_SUBSCRIPTION.value,
+            "Id": "1234",
+            "Resource": "https://graph.microsoft.com/beta/me/Messages",
+            "ChangeType": O365EventType.CREATED.value,
+        },
+    )
+    subscriber.reconnect_backoff = 0.01
+    return subscriber
+
+
+class TestStreamWatchdog:
+    def test_dead(self):
+        now = [0.0]
+        watchdog = O365StreamWatchdog(15, clock=lambda: now[0])
+        now[0] = 10
+        assert watchdog.remaining() == 5
+        watchdog.feed()
+        now[0] = 24
+        assert not watchdog.dead
+        now[0] = 25
+        assert watchdog.dead
+
+        watchdog.paused = True
+        assert not watchdog.dead
+
+    def test_stalled_stream(self, subscriber):
+        ns = subscriber.namespace
+        stalled = FakeStream([notification_payload(ns, 1)], stall=True)
+        subscriber.con = FakeConnection(
+            [stalled, FakeStream([notification_payload(ns, 2)])]
+        )
+
+        handler = CollectingHandler()
+        subscriber.start_streaming(
+            notification_handler=handler,
+            keep_alive_interval=0.05,
+            missed_keep_alives=2,
+        )
+        assert handler.sequences == [1, 2]
+        assert stalled.closed.is_set()
+        assert subscriber.con.requests[0]["timeout"][1] == pytest.approx(0.1)
+
+    def test_overlapping_handoff(self, subscriber):
+        ns = subscriber.namespace
+        first = FakeStream(
+            [notification_payload(ns, 1), notification_payload(ns, 2)],
+            stall=True,
+            expire=0.6,
+        )
+        second = FakeStream([notification_payload(ns, 2), notification_payload(ns, 3)])
+        subscriber.con = FakeConnection([first, second])
+
+        handler = CollectingHandler()
+        subscriber.start_streaming(
+            notification_handler=handler,
+            connection_timeout=0.01,  # 0.6 seconds
+            refresh_after_expire=True,
+            missed_keep_alives=0,
+            handoff=0.5,
+        )
+        assert handler.sequences == [1, 2, 3]
+
+    def test_failed_handoff(self, subscriber):
+        ns = subscriber.namespace
+        first = FakeStream(
+            [notification_payload(ns, 1), notification_payload(ns, 2)],
+            stall=True,
+            expire=0.6,
+        )
+        second = FakeStream([notification_payload(ns, 2), notification_payload(ns, 3)])
+        failure = requests.exceptions.ConnectionError("connection refused")
+        subscriber.con = FakeConnection([first, failure, second])
+
+        handler = CollectingHandler()
+        stats = O365StreamStats()
+        subscriber.start_streaming(
+            notification_handler=handler,
+            connection_timeout=0.01,  # 0.6 seconds
+            refresh_after_expire=True,
+            missed_keep_alives=0,
+            handoff=0.5,
+            stats=stats,
+        )
+        # the current connection is kept on, and the handoff retried
+        assert handler.sequences == [1, 2, 3]
+        assert stats == O365StreamStats(connections=2, errors=1)
+
+    def test_lingering_batch(self, subscriber):
+        ns = subscriber.namespace
+        stalled = FakeStream(
+            [notification_payload(ns, 1), notification_payload(ns, 2)],
+            stall=True,
+            expire=1,
+        )
+        subscriber.con = FakeConnection([stalled])
+
+        class BatchHandler(CollectingHandler):
+            max_batch_size = 10
+            max_batch_linger = 0.05
+
+            def process_batch(self, notifications):
+                self.stalled = not stalled.closed.is_set()
+                super().process_batch(notifications)
+
+        handler = BatchHandler()
+        subscriber.start_streaming(notification_handler=handler, missed_keep_alives=0)
+        # released while the stream stalled, not once it ended
+        assert handler.sequences == [1, 2]
+        assert handler.stalled
+
+    def test_keep_alives_per_connection(self, subscriber):
+        keep_alive = keep_alive_payload(subscriber.namespace)
+        first = PacedStream(keep_alive, keep_alive, pace=1)
+        second = PacedStream(keep_alive, keep_alive, pace=0.2)
+        subscriber.con = FakeConnection([first, second])
+
+        class Intervals(O365Instrumentation):
+            def __init__(self):
+                self.intervals = []
+
+            def keep_alive(self, interval):
+                self.intervals.append(interval)
+
+        subscriber.instrumentation = instrumentation = Intervals()
+        subscriber.start_streaming(
+            connection_timeout=0.01,  # 0.6 seconds
+            refresh_after_expire=True,
+            missed_keep_alives=0,
+            handoff=0.5,
+        )
+        # not measured across the overlapping connections
+        short, long = sorted(instrumentation.intervals)
+        assert 0.2 <= short < 1 <= long
+
+    def test_stop_streaming(self, subscriber):
+        ns = subscriber.namespace
+        stalled = FakeStream([notification_payload(ns, 1)], stall=True)
+        subscriber.con = FakeConnection([stalled])
+
+        handler = CollectingHandler()
+        thread = threading.Thread(
+            target=subscriber.start_streaming,
+            kwargs={"notification_handler": handler, "missed_keep_alives": 0},
+        )
+        thread.start()
+        while not handler.sequences:
+            thread.join(0.01)
+        subscriber.stop_streaming()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert stalled.closed.is_set()
@@ -0,0 +1,166 @@
+from datetime import datetime
+
+import pytest
+from O365 import Account, MSGraphProtocol, MSOffice365Protocol
+
+from O365_notifications.base import O365Notification
+from O365_notifications.catchup import O365CatchUpHandler, O365DeltaTokenStore
+from O365_notifications.constants import O365EventType
+from O365_notifications.streaming import O365StreamingSubscriber
+from tests.conftest import CollectingHandler
+
+SERVICE_URL = "https://graph.microsoft.com/beta/"
+DELTA_URL = f"{SERVICE_URL}users/foo@bar.com/mailFolders/Inbox/messages/delta"
+
+
+@pytest.fixture
+def account(backend):
+    return Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+
+
+@pytest.fixture
+def subscriber(account, requests_mock):
+    subscriber = O365StreamingSubscriber(parent=account)
+    sub_type = subscriber.namespace.O365SubscriptionType.STREAMING_SUBSCRIPTION
+    requests_mock.post(
+        f"{SERVICE_URL}users/foo@bar.com/subscriptions",
+        json={
+            "@odata.type": sub_type.value,
+            "Id": "1234",
+            "Resource": "me/mailfolders('inbox')/Messages",
+            "ChangeType": "Created,Deleted",
+        },
+    )
+    subscriber.subscribe(
+        resource=account.mailbox().inbox_folder(),
+        events=[O365EventType.CREATED, O365EventType.DELETED],
+    )
+    return subscriber
+
+
+def delta_pages(requests_mock, token, pages):
+    """Serve the pages of changes following a delta token."""
+    for i, items in enumerate(pages):
+        url = f"{DELTA_URL}?$deltatoken={token}" if i == 0 else f"{DELTA_URL}?page={i}"
+        link = (
+            {"@odata.nextLink": f"{DELTA_URL}?page={i + 1}"}
+            if i + 1 < len(pages)
+            else {"@odata.deltaLink": f"{DELTA_URL}?$deltatoken={token}-next"}
+        )
+        requests_mock.get(url, json={"value": items, **link})
+
+
+def live(subscriber, resource_id, etag, event=O365EventType.CREATED):
+    return O365Notification(
+        raw={},
+        type=subscriber.namespace.O365NotificationType.NOTIFICATION,
+        id=None,
+        subscription_id="1234",
+        subscription_expire=datetime.now(),
+        sequence=1,
+        event=event,
+        resource=O365Notification.O365ResourceData(
+            type=subscriber.namespace.O365ResourceDataType.MESSAGE,
+            url="",
+            etag=etag,
+            id=resource_id,
+        ),
+    )
+
+
+class TestCatchUp:
+    def test_catch_up(self, subscriber, requests_mock, tmp_path):
+        path = str(tmp_path / "delta.json")
+        handler = CollectingHandler()
+        catch_up = O365CatchUpHandler(
+            handler, subscriber=subscriber, store=O365DeltaTokenStore(path)
+        )
+
+        # the first run only tracks changes from now on
+        requests_mock.get(
+            DELTA_URL,
+            json={
+                "value": [{"id": "old", "@odata.etag": "E0"}],
+                "@odata.deltaLink": f"{DELTA_URL}?$deltatoken=T1",
+            },
+        )
+        catch_up.catch_up(wait=True)
+        assert handler.notifications == []
+
+        # the stream delivers a change while catching up on the others
+        catch_up.process(live(subscriber, "A", "E1"))
+        delta_pages(
+            requests_mock,
+            "T1",
+            [
+                [{"id": "A", "@odata.etag": "E1"}, {"id": "B", "@odata.etag": "E1"}],
+                [{"id": "old", "@removed": {"reason": "deleted"}}],
+            ],
+        )
+        catch_up.catch_up(wait=True)
+
+        delivered = [(n.resource.id, n.event) for n in handler.notifications]
+        assert delivered == [
+            ("A", O365EventType.CREATED),
+            ("B", O365EventType.CREATED),
+            ("old", O365EventType.DELETED),
+        ]
+        caught_up = handler.notifications[1]
+        assert caught_up.sequence is None
+        assert caught_up.subscription is subscriber.subscriptions[0]
+        assert caught_up.resource.url.endswith("/messages/B")
+
+        # the delta token survives restarts
+        store = O365DeltaTokenStore(path)
+        assert store.get(subscriber.subscriptions[0]).endswith("$deltatoken=T1-next")
+
+    def test_expired_token(self, subscriber, requests_mock):
+        handler = CollectingHandler()
+        store = O365DeltaTokenStore()
+        subscription = subscriber.subscriptions[0]
+        store.set(subscription, f"{DELTA_URL}?$deltatoken=T1")
+        requests_mock.get(
+            DELTA_URL,
+            json={"value": [], "@odata.deltaLink": f"{DELTA_URL}?$deltatoken=T2"},
+        )
+        expired = requests_mock.get(f"{DELTA_URL}?$deltatoken=T1", status_code=410)
+
+        O365CatchUpHandler(handler, subscriber=subscriber, store=store).catch_up(
+            wait=True
+        )
+        assert expired.called
+        assert handler.notifications == []
+        assert store.get(subscription).endswith("$deltatoken=T2")
+
+    def test_catch_up_on_missed(self, subscriber, requests_mock):
+        handler = CollectingHandler()
+        store = O365DeltaTokenStore()
+        store.set(subscriber.subscriptions[0], f"{DELTA_URL}?$deltatoken=T1")
+        delta_pages(requests_mock, "T1", [[{"id": "B", "@odata.etag": "E1"}]])
+        catch_up = O365CatchUpHandler(handler, subscriber=subscriber, store=store)
+
+        missed = live(subscriber, "A", "E1", event=O365EventType.MISSED)
+        catch_up.process(missed)
+        catch_up.wait()
+
+        assert [n.resource.id for n in handler.notifications] == ["A", "B"]
+
+    def test_outlook_protocol(self, backend):
+        account = Account(
+            credentials=("user", "pass"),
+            tenant_id="foo",
+            main_resource="foo@bar.com",
+            auth_flow_type="credentials",
+            protocol=MSOffice365Protocol(),
+            token_backend=backend,
+        )
+        subscriber = O365StreamingSubscriber(parent=account)
+        with pytest.raises(ValueError, match="Microsoft Graph"):
+            O365CatchUpHandler(CollectingHandler(), subscriber=subscriber)
@@ -0,0 +1,33 @@
+import pytest
+from O365 import MSGraphProtocol, MSOffice365Protocol
+
+from O365_notifications.constants import O365Namespace
+
+
+class TestO365Namespace:
+    @pytest.mark.parametrize("protocol", [MSOffice365Protocol, MSGraphProtocol])
+    def test_interned(self, protocol):
+        ns = O365Namespace.from_protocol(protocol=protocol())
+        assert ns is O365Namespace.from_protocol(protocol=protocol())
+        assert ns.O365NotificationType is ns.from_type(ns.base).O365NotificationType
+
+        keep_alive = ns.O365NotificationType.KEEP_ALIVE_NOTIFICATION
+        assert ns.member("O365NotificationType", keep_alive.value) is keep_alive
+
+    def test_protocols_differ(self):
+        graph = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+        outlook = O365Namespace.from_protocol(protocol=MSOffice365Protocol())
+        assert graph is not outlook
+        assert graph.O365SubscriptionType is not outlook.O365SubscriptionType
+
+    def test_unknown_member(self):
+        ns = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+        with pytest.raises(ValueError):
+            ns.member("O365ResourceDataType", "#Foo.Bar")
+
+    def test_key(self):
+        graph = O365Namespace.from_protocol(protocol=MSGraphProtocol())
+        outlook = O365Namespace.from_protocol(protocol=MSOffice365Protocol())
+        assert graph.key("EncryptedContent") == "encryptedContent"
+        assert outlook.key("EncryptedContent") == "EncryptedContent"
+        assert graph.key("@odata.type") == "@odata.type"
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import pytest
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.streaming import O365StreamingSubscriber
+
+SERVICE_URL = "https://graph.microsoft.com/beta/"
+
+
+@pytest.fixture
+def subscriber(backend):
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+    return O365StreamingSubscriber(parent=account)
+
+
+def notification(i, etag="E1"):
+    url = f"{SERVICE_URL}Users('foo')/Messages('{i}')"
+    return SimpleNamespace(resource=SimpleNamespace(id=str(i), etag=etag, url=url))
+
+
+def batch_callback(request, context):
+    responses = []
+    for r in request.json()["requests"]:
+        message_id = r["url"].split("'")[-2]
+        if message_id == "gone":
+            responses.append({"id": r["id"], "status": 404, "body": {}})
+        else:
+            body = {"id": message_id, "url": r["url"]}
+            responses.append({"id": r["id"], "status": 200, "body": body})
+    return {"responses": responses}
+
+
+class TestResourceFetcher:
+    def test_batches_and_cache(self, subscriber, requests_mock):
+        batch = requests_mock.post(f"{SERVICE_URL}$batch", json=batch_callback)
+        fetcher = subscriber.fetcher
+
+        notifications = [notification(i) for i in range(25)]
+        notifications += [notification(3), notification(7)]  # duplicates
+        resources = fetcher.fetch_many(notifications)
+
+        assert [r["id"] for r in resources] == [
+            *(str(i) for i in range(25)),
+            "3",
+            "7",
+        ]
+        assert resources[0]["url"] == "/Users('foo')/Messages('0')"
+        assert batch.call_count == 2
+        assert len(batch.request_history[0].json()["requests"]) == 20
+        assert fetcher.stats.misses == 25
+        assert fetcher.stats.coalesced == 2
+
+        # cached, unless the resource changed; a lone fetch is sent as a plain GET
+        requests_mock.get(notification(2).resource.url, json={"id": "2"})
+        fetcher.fetch_many([notification(1), notification(2, etag="E2")])
+        assert fetcher.stats.hits == 1
+        assert fetcher.stats.misses == 26
+
+    def test_gone_resource(self, subscriber, requests_mock):
+        requests_mock.post(f"{SERVICE_URL}$batch", json=batch_callback)
+        resources = subscriber.fetcher.fetch_many(
+            [notification("gone"), notification(1)]
+        )
+        assert resources == [None, {"id": "1", "url": "/Users('foo')/Messages('1')"}]
+
+    def test_single_fetch(self, subscriber, requests_mock):
+        url = notification(1).resource.url
+        get = requests_mock.get(url, json={"id": "1"})
+        assert subscriber.fetcher.fetch(notification(1), timeout=5) == {"id": "1"}
+        assert get.call_count == 1
+        assert subscriber.fetcher.stats.requests == 1
+
+    def test_no_etag(self, subscriber, requests_mock):
+        get = requests_mock.get(notification(1).resource.url, json={"id": "1"})
+        for _ in range(2):
+            assert subscriber.fetcher.fetch(notification(1, etag=None)) == {"id": "1"}
+        assert get.call_count == 2
+        assert subscriber.fetcher.stats.hits == 0
@@ -0,0 +1,71 @@
+import json
+import subprocess
+import sys
+
+import O365_notifications
+from O365_notifications.constants import O365EventType, O365Namespace
+from O365_notifications.decoders import O365NotificationDecoder
+from O365_notifications.notifications import O365Notification
+
+
+def imported(code: str) -> list:
+    """Heavy modules imported by running code in a fresh interpreter."""
+    probe = (
+        f"{code}\nimport json, sys\n"
+        "print(json.dumps([m for m in ('O365', 'marshmallow') if m in sys.modules]))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", probe], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(out)
+
+
+CORE = """
+from O365_notifications.constants import O365Namespace
+from O365_notifications.decoders import O365NotificationDecoder
+from O365_notifications.dedup import O365DedupHandler
+from O365_notifications.dispatch import O365NotificationDispatcher
+from O365_notifications.notifications import O365Notification
+from O365_notifications.routing import O365NotificationRouter
+
+decoder = O365NotificationDecoder(namespace=O365Namespace("#Microsoft.Graph"))
+decoder.register(decoder.namespace.O365NotificationType.NOTIFICATION, O365Notification)
+"""
+
+
+class TestImports:
+    def test_core(self):
+        # handling notifications requires neither O365 nor marshmallow
+        assert imported("import O365_notifications") == []
+        assert imported(CORE) == []
+        assert "O365" in imported("from O365_notifications import O365PushSubscriber")
+
+    def test_lazy_exports(self):
+        from O365_notifications.streaming import O365StreamingSubscriber
+
+        assert O365_notifications.O365StreamingSubscriber is O365StreamingSubscriber
+        assert O365_notifications.__version__
+        assert "O365PushReceiver" in dir(O365_notifications)
+
+    def test_schema_fallback(self):
+        ns = O365Namespace.from_type("#Microsoft.Graph")
+        decoder = O365NotificationDecoder(namespace=ns, validate=True)
+        decoder.register(ns.O365NotificationType.NOTIFICATION, O365Notification)
+        notification = decoder.decode(
+            {
+                "@odata.type": ns.O365NotificationType.NOTIFICATION.value,
+                "Id": "null",
+                "SubscriptionId": "ABC",
+                "SubscriptionExpirationDateTime": "2030-01-01T10:00:00Z",
+                "SequenceNumber": 1,
+                "ChangeType": O365EventType.CREATED.value,
+                "ResourceData": {
+                    "@odata.type": ns.O365ResourceDataType.MESSAGE.value,
+                    "@odata.id": "https://graph.microsoft.com/beta/Messages('1')",
+                    "@odata.etag": "XYZ000",
+                    "Id": "1",
+                },
+            }
+        )
+        assert notification.resource.id == "1"
+        assert O365Notification.schema is O365Notification.schema  # built once
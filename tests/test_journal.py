@@ -0,0 +1,200 @@
+import json
+import os
+
+import pytest
+from O365 import Account, MSGraphProtocol
+
+from O365_notifications.constants import O365KeepRaw
+from O365_notifications.dispatch import O365NotificationDispatcher
+from O365_notifications.journal import O365Journal, O365JournalHandler
+from O365_notifications.notifications import O365NotificationBatcher
+from tests.conftest import CollectingHandler, notification_payload
+from O365_notifications.streaming import O365StreamingSubscriber
+
+
+@pytest.fixture
+def subscriber(backend):
+    account = Account(
+        credentials=("user", "pass"),
+        tenant_id="foo",
+        main_resource="foo@bar.com",
+        auth_flow_type="credentials",
+        protocol=MSGraphProtocol(api_version="beta"),
+        token_backend=backend,
+    )
+    return O365StreamingSubscriber(parent=account, keep_raw=O365KeepRaw.BYTES)
+
+
+def frame(ns, sequence):
+    return json.dumps(notification_payload(ns, sequence)).encode()
+
+
+class Handler(CollectingHandler):
+    def __init__(self, fail_at=None):
+        super().__init__()
+        self.fail_at = fail_at
+
+    def process(self, notification):
+        if notification.sequence == self.fail_at:
+            raise RuntimeError("crash")
+        super().process(notification)
+
+
+class TestJournal:
+    def test_append_and_read(self, tmp_path):
+        with O365Journal(str(tmp_path)) as journal:
+            offsets = [journal.append(f"entry-{i}".encode()) for i in range(5)]
+            journal.commit("foo", 2)
+        assert offsets == [0, 1, 2, 3, 4]
+
+        with O365Journal(str(tmp_path)) as journal:
+            assert journal.end == 5
+            assert journal.committed("foo") == 2
+            assert journal.committed("bar") == 0
+            entries = list(journal.read(journal.committed("foo")))
+            assert entries == [(i, f"entry-{i}".encode()) for i in range(2, 5)]
+            assert journal.append(b"entry-5") == 5
+
+    def test_torn_tail(self, tmp_path):
+        with O365Journal(str(tmp_path)) as journal:
+            journal.append(b"complete")
+            journal.append(b"torn")
+        (path,) = tmp_path.glob("*.log")
+        with open(path, "r+b") as f:
+            f.seek(8 + len(b"complete") + 8)
+            f.write(b"xxxx")  # corrupt the last entry
+
+        with O365Journal(str(tmp_path)) as journal:
+            assert list(journal.read()) == [(0, b"complete")]
+            assert journal.append(b"next") == 1
+
+    def test_rotation_and_compaction(self, tmp_path):
+        with O365Journal(str(tmp_path), segment_size=40) as journal:
+            for i in range(10):
+                journal.append(f"entry-{i:02}".encode())  # 2 entries per segment
+            assert len(list(tmp_path.glob("*.log"))) == 5
+            assert [o for o, _ in journal.read()] == list(range(10))
+
+            journal.commit("foo", 5)
+            journal.compact()
+            assert journal.first == 4  # segment [4, 6) is not consumed yet
+            assert [o for o, _ in journal.read(journal.first)] == list(range(4, 10))
+
+            journal.append(b"x" * 100)  # larger than a segment
+            assert list(journal.read(10)) == [(10, b"x" * 100)]
+
+    def test_size_budget(self, tmp_path):
+        with O365Journal(str(tmp_path), segment_size=40, max_bytes=100) as journal:
+            for i in range(10):
+                journal.append(f"entry-{i:02}".encode())
+            assert sum(os.path.getsize(p) for p in tmp_path.glob("*.log")) <= 100 + 40
+            assert journal.first > 0
+
+
+class TestJournalHandler:
+    def test_replay(self, subscriber, tmp_path):
+        ns = subscriber.namespace
+        with O365Journal(str(tmp_path)) as journal:
+            handler = Handler()
+            journaled = O365JournalHandler(handler, journal, subscriber=subscriber)
+            for sequence in range(1, 4):
+                notification = subscriber.notification_factory(
+                    json.loads(frame(ns, sequence)), frame=frame(ns, sequence)
+                )
+                if sequence == 3:
+                    journaled._append(notification)
+                    break  # crashed while processing
+                journaled.process(notification)
+            assert handler.sequences == [1, 2]
+            assert journal.committed("default") == 2
+
+        with O365Journal(str(tmp_path)) as journal:
+            handler = Handler()
+            journaled = O365JournalHandler(handler, journal, subscriber=subscriber)
+            assert journaled.replay() == 1
+            assert handler.sequences == [3]
+            assert journal.committed("default") == 3
+            assert journaled.replay() == 0
+
+    def test_failed_handler(self, subscriber, tmp_path):
+        ns = subscriber.namespace
+        with O365Journal(str(tmp_path / "journal")) as journal, O365Journal(
+            str(tmp_path / "dead")
+        ) as dead_letters:
+            handler = Handler(fail_at=3)
+            journaled = O365JournalHandler(
+                handler, journal, subscriber=subscriber, dead_letters=dead_letters
+            )
+            for sequence in range(1, 1001):
+                notification = subscriber.notification_factory(
+                    json.loads(frame(ns, sequence)), frame=frame(ns, sequence)
+                )
+                try:
+                    journaled.process(notification)
+                except RuntimeError:
+                    pass
+            # the failed notification doesn't hold the journal back
+            assert len(handler.sequences) == 999
+            assert journal.committed("default") == 1000
+            assert not journaled._in_flight and not journaled._done
+            assert list(dead_letters.read()) == [(0, frame(ns, 3))]
+
+    def test_journals_on_receipt(self, subscriber, tmp_path):
+        ns = subscriber.namespace
+        with O365Journal(str(tmp_path)) as journal:
+            handler = Handler()
+            handler.max_batch_size = 3
+            handler.max_batch_linger = 60.0
+            journaled = O365JournalHandler(handler, journal, subscriber=subscriber)
+            batcher = O365NotificationBatcher(journaled)
+            for sequence in range(1, 3):
+                notification = subscriber.notification_factory(
+                    json.loads(frame(ns, sequence)), frame=frame(ns, sequence)
+                )
+                assert batcher.add(notification) == []
+            # lingering in the batch, but journaled already
+            assert [o for o, _ in journal.read()] == [0, 1]
+            assert handler.sequences == []
+
+            (batch,) = batcher.flush()
+            journaled.process_batch(batch)
+            assert handler.sequences == [1, 2]
+            assert journal.committed("default") == 2
+            assert not journaled._received and not journaled._in_flight
+
+    def test_journals_before_dispatch(self, subscriber, tmp_path):
+        ns = subscriber.namespace
+        with O365Journal(str(tmp_path)) as journal:
+            handler = Handler()
+            journaled = O365JournalHandler(handler, journal, subscriber=subscriber)
+            dispatcher = O365NotificationDispatcher(journaled, workers=1)
+            batcher = O365NotificationBatcher(dispatcher)
+            notification = subscriber.notification_factory(
+                json.loads(frame(ns, 1)), frame=frame(ns, 1)
+            )
+            for item in batcher.add(notification):
+                assert [o for o, _ in journal.read()] == [0]  # before queueing
+                dispatcher.process(item)
+            dispatcher.close()
+            assert handler.sequences == [1]
+            assert journal.committed("default") == 1
+            assert [o for o, _ in journal.read(1)] == []
+
+    def test_out_of_order_acks(self, subscriber, tmp_path):
+        ns = subscriber.namespace
+        with O365Journal(str(tmp_path)) as journal:
+            journaled = O365JournalHandler(Handler(), journal, subscriber=subscriber)
+            notifications = [
+                subscriber.notification_factory(json.loads(frame(ns, i)))
+                for i in range(3)
+            ]
+            offsets = [journaled._append(n) for n in notifications]
+            journaled._ack([offsets[1]])
+            assert journal.committed("default") == 0
+            journaled._ack([offsets[0]])
+            assert journal.committed("default") == 2
+
+    def test_requires_raw(self, subscriber):
+        subscriber.decoder.keep_raw = O365KeepRaw.OFF
+        with pytest.raises(ValueError):
+            O365JournalHandler(Handler(), None, subscriber=subscriber)
@@ -0,0 +1,40 @@
+import urllib.request
+
+from O365_notifications.metrics import O365Metrics, O365PrometheusExporter
+
+
+class TestMetrics:
+    def test_render(self):
+        metrics = O365Metrics()
+        metrics.bytes_read(100)
+        metrics.notification_decoded("NOTIFICATION", 0.00002)
+        metrics.request_completed("renew", 0.3)
+        metrics.request_completed("renew", 40.0)
+        metrics.error_suppressed(ValueError('bad "value"'))
+
+        text = metrics.render()
+        assert "# TYPE o365_stream_bytes_read_total counter\n" in text
+        assert "o365_stream_bytes_read_total 100\n" in text
+        assert "o365_stream_reconnects_total 0\n" in text
+        assert 'o365_notifications_decoded_total{type="NOTIFICATION"} 1\n' in text
+        assert 'o365_decode_seconds_bucket{le="1e-05"} 0\n' in text
+        assert 'o365_decode_seconds_bucket{le="5e-05"} 1\n' in text
+        assert 'o365_decode_seconds_bucket{le="+Inf"} 1\n' in text
+        assert 'o365_request_seconds_bucket{operation="renew",le="0.25"} 0\n' in text
+        assert 'o365_request_seconds_bucket{operation="renew",le="0.5"} 1\n' in text
+        assert 'o365_request_seconds_bucket{operation="renew",le="+Inf"} 2\n' in text
+        assert 'o365_request_seconds_sum{operation="renew"} 40.3\n' in text
+        assert 'o365_request_seconds_count{operation="renew"} 2\n' in text
+        assert 'o365_stream_errors_suppressed_total{error="ValueError"} 1\n' in text
+
+    def test_exporter(self):
+        metrics = O365Metrics()
+        metrics.reconnected()
+        exporter = O365PrometheusExporter(metrics)
+        host, port = exporter.start(port=0, host="127.0.0.1")
+        try:
+            with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+                assert response.headers["Content-Type"].startswith("text/plain")
+                assert b"o365_stream_reconnects_total 1\n" in response.read()
+        finally:
+            exporter.stop()
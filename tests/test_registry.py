@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+from O365_notifications.constants import O365EventType
+from O365_notifications.registry import O365SubscriptionRegistry
+
+
+def subscription(resource, id, events):
+    return SimpleNamespace(
+        resource=resource, id=id, events=events, expiration=None, raw={}
+    )
+
+
+class TestO365SubscriptionRegistry:
+    def test_indexes(self):
+        registry = O365SubscriptionRegistry()
+        created, deleted = O365EventType.CREATED, O365EventType.DELETED
+        for i in range(10000):
+            events = [created, deleted] if i % 2 else [created]
+            registry.upsert(subscription(f"folders/{i}", str(i), events))
+
+        assert len(registry) == 10000
+        assert registry.get("42") is registry.for_resource("folders/42")
+        assert registry[0].id == "0"
+        assert len(registry.for_event(created)) == 10000
+        assert len(registry.for_event(deleted)) == 5000
+
+    def test_upsert_in_place(self):
+        registry = O365SubscriptionRegistry()
+        first = registry.upsert(subscription("inbox", "1", [O365EventType.CREATED]))
+        renewed = registry.upsert(subscription("inbox", "2", [O365EventType.DELETED]))
+
+        assert renewed is first
+        assert len(registry) == 1
+        assert registry.get("1") is None
+        assert registry.get("2") is first
+        assert registry.for_event(O365EventType.CREATED) == []
+        assert registry.for_event(O365EventType.DELETED) == [first]
+
+    def test_remove(self):
+        registry = O365SubscriptionRegistry()
+        sub = registry.upsert(subscription("inbox", "1", [O365EventType.CREATED]))
+        assert sub in registry
+        assert registry.remove(sub)
+        assert not registry
+        assert registry.get("1") is None
+        assert not registry.remove(sub)
@@ -0,0 +1,111 @@
+import multiprocessing
+from collections import Counter
+
+from O365 import MSGraphProtocol
+
+from O365_notifications.constants import O365EventType, O365KeepRaw, O365Namespace
+from O365_notifications.streaming import O365StreamingSubscriber
+from O365_notifications.supervisor import O365HashRing, O365ShardedSupervisor
+from tests.conftest import (
+    CollectingHandler,
+    FakeConnection,
+    FakeResponse,
+    FakeStream,
+    notification_payload,
+)
+
+PROTOCOL = MSGraphProtocol(api_version="beta")
+NS = O365Namespace.from_protocol(protocol=PROTOCOL)
+NOTIFICATIONS = 3  # per stream
+
+
+class MailboxConnection(FakeConnection):
+    """Streams a few notifications of the mailbox, then closes."""
+
+    def __init__(self, main_resource):
+        super().__init__()
+        self.main_resource = main_resource
+
+    def respond(self, url, data):
+        if not url.endswith("/GetNotifications"):
+            return FakeResponse(
+                {
+                    "@odata.type": NS.O365SubscriptionType.STREAMING_SUBSCRIPTION.value,
+                    "Id": self.main_resource,
+                    "Resource": "me/mailfolders('inbox')/Messages",
+                    "ChangeType": "Created",
+                }
+            )
+        elements = [
+            notification_payload(
+                NS,
+                i,
+                subscription_id=self.main_resource,
+                url=f"Users('{self.main_resource}')/Messages('{i}')",
+                etag="E1",
+            )
+            for i in range(NOTIFICATIONS)
+        ]
+        return FakeStream(elements)
+
+
+def subscriber_factory(main_resource):
+    subscriber = O365StreamingSubscriber(
+        con=MailboxConnection(main_resource),
+        protocol=PROTOCOL,
+        main_resource=main_resource,
+        keep_raw=O365KeepRaw.BYTES,
+    )
+    subscriber.subscribe(resource="inbox", events=[O365EventType.CREATED])
+    return subscriber
+
+
+def counts(handler):
+    return Counter(n.subscription_id for n in handler.notifications)
+
+
+class TestSupervisor:
+    def test_hash_ring(self):
+        keys = [f"user{i}@bar.com" for i in range(1000)]
+        ring = O365HashRing(["a", "b", "c"])
+        before = {k: ring.node_for(k) for k in keys}
+        assert set(before.values()) == {"a", "b", "c"}
+
+        ring.add("d")
+        after = {k: ring.node_for(k) for k in keys}
+        moved = [k for k in keys if before[k] != after[k]]
+        assert all(after[k] == "d" for k in moved)
+        assert 100 < len(moved) < 400
+
+        ring.remove("d")
+        assert {k: ring.node_for(k) for k in keys} == before
+
+    def test_sharded_streaming(self):
+        handler = CollectingHandler()
+        mailboxes = [f"user{i}@bar.com" for i in range(6)]
+        supervisor = O365ShardedSupervisor(
+            subscriber_factory,
+            handler,
+            workers=2,
+            stream_kwargs={"refresh_after_expire": False},
+            restart_delay=60,
+        )
+        with supervisor:
+            supervisor.add(*mailboxes)
+            assert handler.wait_for(len(mailboxes) * NOTIFICATIONS, 30)
+            assert set(counts(handler)) == set(mailboxes)
+            owned = supervisor.assignments()
+            assert sorted(m for ms in owned.values() for m in ms) == mailboxes
+
+            # the mailboxes of a dead worker are streamed by the other one
+            dead, survivor = sorted(owned, key=lambda w: -len(owned[w]))
+            for process in multiprocessing.active_children():
+                if process.name == f"O365Supervisor-{dead}":
+                    process.kill()
+            moved = owned[dead]
+            assert handler.wait_for((len(mailboxes) + len(moved)) * NOTIFICATIONS, 30)
+            assert all(counts(handler)[m] == 2 * NOTIFICATIONS for m in moved)
+            assert sorted(supervisor.assignments()[survivor]) == mailboxes
+
+            supervisor.remove(*moved)
+            assert sorted(supervisor.assignments()[survivor]) == sorted(owned[survivor])